@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# backfill.py -- Import archived pinger stats files into the database
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Usage: backfill.py <directory>
+#
+# The directory should contain a subdirectory for each pinger, named after
+# the pinger.  Any file below a pinger's directory with 'mlist2' in its name
+# is read as a stats file, and any with 'pubring' in its name as a
+# pubring.mix.  Files are parsed in parallel by a pool of processes and the
+# results are written to the database by this process alone.  All the stats
+# files are recorded in the ping history, whilst only the newest for each
+# pinger is written to mlist2.  A pubring is only applied if it's newer
+# than the stats already held for its pinger.
+
+import datetime
+import logging
+import multiprocessing
+import os
+import sys
+
+import config
+import db
+import keys
+import statparse
+import stats
+
+# The stats logger is configured by stats.init_logging() before the pool
+# is started, and the pool processes inherit its handlers.
+logger = logging.getLogger('stats')
+
+MLIST2 = 'mlist2'
+PUBRING = 'pubring'
+
+def find_files(topdir):
+    """Walk a directory tree and return a list of (ping_name, kind, path)
+    jobs for every stats file and pubring found."""
+    jobs = []
+    for ping_name in sorted(os.listdir(topdir)):
+        pingdir = os.path.join(topdir, ping_name)
+        if not os.path.isdir(pingdir):
+            continue
+        for dirpath, dirnames, filenames in os.walk(pingdir):
+            for filename in filenames:
+                if MLIST2 in filename:
+                    kind = MLIST2
+                elif PUBRING in filename:
+                    kind = PUBRING
+                else:
+                    continue
+                jobs.append((ping_name, kind, os.path.join(dirpath, filename)))
+    return jobs
+
+def parse_file(job):
+    """Parse a single archived file.  This runs in a pool process so it
+    mustn't touch the database.  Returns (ping_name, kind, path, stamp,
+    content) where, for stats files, stamp is the Generated timestamp and
+    content is the (stat_lines, chains) to be written.  Pubrings have no
+    Generated timestamp so the file's modification time is used instead,
+    or None if that can't be read."""
+    ping_name, kind, path = job
+    try:
+        archive = open(path)
+        try:
+            if kind == MLIST2:
+                records = list(statparse.parse_stats(archive))
+                genstamp, stat_lines, chains = \
+                    stats.build_stats(ping_name, records)
+                return ping_name, kind, path, genstamp, (stat_lines, chains)
+            headers = list(keys.pubring_scan(archive))
+        finally:
+            archive.close()
+    except (IOError, OSError), e:
+        logger.warn("Unable to read %s: %s", path, e)
+        return ping_name, kind, path, 0, None
+    try:
+        mtime = datetime.datetime.utcfromtimestamp(os.path.getmtime(path))
+    except (OSError, ValueError):
+        return ping_name, kind, path, None, headers
+    return ping_name, kind, path, mtime.strftime("%Y-%m-%d %H:%M:%S"), headers
+
+def backfill(topdir):
+    jobs = find_files(topdir)
+    logger.info("Backfilling %d files from %s", len(jobs), topdir)
+
+    # Only the newest stats and pubring for each pinger end up in mlist2, so
+    # that's all the writer needs to hold on to.
+    newest = {}
+    skipped = 0
+    # One process per CPU unless configured otherwise.
+    workers = None
+    if hasattr(config, 'backfill_workers'):
+        workers = config.backfill_workers
+    pool = multiprocessing.Pool(workers)
+    for ping_name, kind, path, stamp, content in \
+        pool.imap_unordered(parse_file, jobs, 16):
+        if content is None:
+            skipped += 1
+            continue
+        if not stamp:
+            if kind == MLIST2:
+                logger.warn("No Generated timestamp in %s, skipping", path)
+            else:
+                logger.warn("Unable to date %s, skipping", path)
+            skipped += 1
+            continue
+        # Every set of stats goes into the history, not just the newest.
+        if kind == MLIST2:
+            stats.store_history(ping_name, stamp, content[0])
+        current = newest.get((ping_name, kind))
+        if current is None or stamp > current[0]:
+            newest[(ping_name, kind)] = (stamp, path, content)
+    pool.close()
+    pool.join()
+
+    # Archived stats must not overwrite anything more recent that's already
+    # in the database.
+    latest = db.pinger_latest()
+    written = 0
+    for (ping_name, kind), (stamp, path, content) in sorted(newest.items()):
+        if kind != MLIST2:
+            continue
+        if latest.has_key(ping_name) and \
+           stamp <= str(latest[ping_name]):
+            logger.info("%s is older than the stats held for %s",
+                        path, ping_name)
+            continue
+        stat_lines, chains = content
+        stats.store_stats(ping_name, stamp, stat_lines, chains)
+        written += len(stat_lines)
+
+    # Keys are applied after the stats, as they update the mlist2 rows
+    # written above.  The same guard applies, so an archived pubring can't
+    # replace keys taken from the live one.
+    for (ping_name, kind), (stamp, path, content) in sorted(newest.items()):
+        if kind != PUBRING:
+            continue
+        if latest.has_key(ping_name) and \
+           stamp <= str(latest[ping_name]):
+            logger.info("%s is older than the stats held for %s",
+                        path, ping_name)
+            continue
+        keys.pubring_process(ping_name, content)
+    logger.info("Backfill wrote %d stats entries from %d files "
+                "(%d skipped)", written, len(jobs), skipped)
+
+# Call main function.
+if (__name__ == "__main__"):
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: %s <directory>\n" % sys.argv[0])
+        sys.exit(2)
+    stats.init_logging()
+    backfill(sys.argv[1])
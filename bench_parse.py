@@ -0,0 +1,294 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# bench_parse.py -- Benchmark the mlist2 stats parser
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Usage: bench_parse.py [remailers ...]
+#
+# Generates synthetic Echolot mlist2 files with the given numbers of
+# remailers (10, 100 and 1000 by default) and reports how many lines per
+# second are turned into stats rows by statparse and stats.build_stats,
+# compared with url_process as it was before statparse existed.  That
+# baseline is copied below unchanged, except that its database writes are
+# collected in memory instead.  The current code also derives the values
+# stored from each line's histories, which the baseline didn't.
+
+import logging
+import random
+import re
+import sys
+import time
+
+import stats
+import statparse
+import timefunc
+
+HEADER = """Stats-Version: 2.0.1
+Generated: Tue, 18 Oct 2011 10:15:02 GMT
+Mixmaster    Latent-Hist   Latent  Uptime-Hist   Uptime  Options
+------------------------------------------------------------------------
+"""
+
+def synthetic_mlist2(remailers, seed=1):
+    """Return the text of an mlist2 file reporting on the given number of
+    remailers.  The same seed always produces the same file."""
+    rand = random.Random(seed)
+    names = ['rem%05d' % i for i in range(remailers)]
+    lines = [HEADER]
+    for name in names:
+        lat_hist = ''.join([rand.choice('0123456789ABCDEFGH?')
+                            for i in range(12)])
+        up_hist = ''.join([rand.choice('0123456789+?') for i in range(12)])
+        hours = rand.randint(0, 12)
+        if hours:
+            latency = '%2d:%02d' % (hours, rand.randint(0, 59))
+        else:
+            latency = '  :%02d' % rand.randint(0, 59)
+        uptime = '%5.1f%%' % (rand.randint(0, 1000) / 10.0)
+        options = rand.choice(['D', 'D  ', '', '   ']).ljust(15)
+        lines.append('%-8s %s  %s   %s  %s  %s\n'
+                     % (name, lat_hist, latency, up_hist, uptime, options))
+    lines.append('\nGroups of remailers sharing a machine or operator:\n\n')
+    lines.append('Broken type-I remailer chains:\n\n')
+    lines.append('Broken type-II remailer chains:\n')
+    for i in range(remailers / 5):
+        lines.append('(%s %s)\n' % (rand.choice(names), rand.choice(names)))
+    lines.append('\nRemailer-Capabilities:\n\n')
+    for name in names:
+        lines.append('$remailer{"%s"} = "<%s@example.net> cpunk mix";\n'
+                     % (name, name))
+    return ''.join(lines)
+
+# ----- The baseline, from stats.py before statparse -----
+
+logger = logging.getLogger('bench_parse')
+
+class BaselineDB(object):
+    """Stands in for the db module, keeping what the baseline would have
+    written."""
+    def __init__(self):
+        self.rows = []
+        self.chains = []
+
+    def delete(self, data):
+        pass
+
+    def insert(self, data):
+        self.rows.append(data)
+
+    def chainstat_update(self, chain):
+        self.chains.append(chain)
+
+db = BaselineDB()
+
+stat_re = re.compile('(\w{1,12})\s+([0-9A-H?]{12}\s.*)')
+addy_re = re.compile('\$remailer\{\"([0-9a-z]{1,12})\"\}\s\=\s\"\<(.*)\>\s')
+chain_re = re.compile('\((\S{1,12})\s(\S{1,12})\)')
+
+# Do some string to integer conversion
+def numeric(seq):
+    seq = seq.strip() # Get rid of spaces
+    if len(seq) == 0:
+        seq = 0
+    else:
+        try:
+            seq = int(seq)
+        except ValueError:
+            seq = 0
+            logger.warn("Expected a numeric, got %s", seq)
+    return seq
+
+# Process each line of a pinger url and write results to database
+def url_process(pinger_name,pinger):
+    genstamp = 0 # Timestamp extracted from URL
+    chainstat = False # Flag to indicate if we are in the Type2 Chainstats
+    address_hash = {}  # Key: Remailer Name, Content: Remailer Address
+    stats_hash = {} # Key: Remailer Name, Content: Stats line
+
+# The following sections assume the required elements of the stats url are in
+# the correct sequence:
+# Generated Timestamp, Stats lines, Address lines
+# Two hashes are used to store stats and address details, both keyed by
+# remailer name.
+    for row in pinger:
+        if row.startswith('Generated: ') and not genstamp:
+            gentime = row.split('ted: ')
+            genstamp = timefunc.arpa_check(gentime[1])
+            logger.debug("Found timestamp %s on stats from %s", genstamp, pinger_name)
+            continue
+
+        # Lets gather some information about chain stats.  If a stats line
+        # starts with 'Broken type-II' we'll assume the info we require follows
+        # immediately after and continues until we hit a line that does match
+        # a chainstat format.  We must find a timestamp to log against each
+        # stat.  Without this, it's future validity cannot be proven.
+        if row.startswith('Broken type-II') and genstamp:
+            chainstat = True
+            logger.debug("Found header for Broken Type-II chains from pinger %s", pinger_name)
+            continue
+        # Once chain2 flag is True, we assume each line that looks like a chain
+        # stat entry is a valid chain stat entry.
+        if chainstat:
+            is_chain = chain_re.match(row)
+            if is_chain:
+                chain = { 'from': is_chain.group(1),
+                          'to': is_chain.group(2),
+                          'stamp': genstamp,
+                          'pinger': pinger_name }
+                if chain['from'] == '*' and chain['to'] == '*':
+                    logger.warn("Pinger %s reports global broken chains (* *)", pinger_name)
+                elif chain['from'] == '*':
+                    logger.info("Pinger %s reports wildcard broken chains to %s", pinger_name, chain['to'])
+                elif chain['to'] == '*':
+                    logger.info("Pinger %s reports wildcard broken chains from %s", pinger_name, chain['from'])
+                db.chainstat_update(chain)
+                logger.debug("Processing broken chain from %(from)s to %(to)s", chain)
+            else:
+                # When we find a line that isn't a chainstat, reset the chain2
+                # flag to indicate we are no longer interested in lines that
+                # match the regex.
+                chainstat = False
+                logger.debug("Finished processing Broken Type-II chains for %s", pinger_name)
+            continue
+
+
+        is_stat = stat_re.match(row)
+        if is_stat:
+            rem_name = is_stat.group(1)
+            if len(rem_name) > 8:
+                logger.info("%s reports long remailer name %s", pinger_name, rem_name)
+            if stats_hash.has_key(rem_name):
+                logger.warn("Pinger %s reports multiple entries for %s", pinger_name, rem_name)
+            else:
+                stats_hash[rem_name] = is_stat.group(2)
+                logger.debug("Processing entry for remailer %s in %s stats", rem_name, pinger_name)
+            continue
+
+        is_addy = addy_re.match(row)
+        if is_addy:
+            rem_name = is_addy.group(1)
+            if address_hash.has_key(rem_name):
+                logger.warn("The address %s appears to be duplicated in %s stats", address_hash[rem_name], pinger_name)
+            else:
+                address_hash[rem_name] = is_addy.group(2)
+                logger.debug("Found email address of %s for %s in %s stats", address_hash[rem_name], rem_name, pinger_name)
+
+# Now we have populated the stats and address hashes, we need to work through
+# each stats entry and extract the components for writing to the database.
+    for remailer in stats_hash:
+        line = stats_hash[remailer]
+        if address_hash.has_key(remailer):
+            if len(line) == 59 or len(line) == 60:
+                try:
+                    lat_hist = line[0:13]
+                    lat_hour = numeric(line[14:16]) * 60
+                    lat_min = numeric(line[17:20])
+                    lat_time = int(lat_hour + lat_min)
+                    up_hist = line[22:34]
+                    up_dec = numeric(line[36:39]) * 10
+                    up_frac = numeric(line[40:41])
+                    up_time = int(up_dec + up_frac)
+                    options = line[44:59]
+                except:
+                    logger.warn("Malformed stats line for remailer %s whilst processing pinger %s", remailer, pinger_name)
+                    continue
+
+                data = {'url_ping_name':pinger_name,
+                        'url_rem_name':remailer,
+                        'url_rem_addy':address_hash[remailer],
+                        'url_lat_hist':lat_hist,
+                        'url_lat_time':lat_time,
+                        'url_up_hist':up_hist,
+                        'url_up_time':up_time,
+                        'url_options':options,
+                        'url_timestamp':genstamp}
+
+                logger.debug("Deleting database entries for remailer %s from pinger %s", remailer, pinger_name)
+                db.delete(data)  # Delete old matching entries
+                logger.debug("Inserting database entries for remailer %s from pinger %s", remailer, pinger_name)
+                db.insert(data)  # Insert new entry to replace those deleted
+
+            else:
+                # The stats line length is wrong, it must be 59 or 60
+                logger.warn("Incorrect stats line length (%d) in %s pinger stats for remailer %s.  Should be 59 or 60.", len(line), pinger_name, remailer)
+        else:
+            # For some reason we appear to have a remailer entry in stats with no matching address
+            logger.warn("No address found in %s stats for remailer %s", pinger_name, remailer)
+
+# ----- The comparison -----
+
+def baseline_parse(lines):
+    """Run the baseline over a list of lines.  Returns the rows and chains
+    it would have written."""
+    global db
+    db = BaselineDB()
+    url_process('bench', lines)
+    return db.rows, db.chains
+
+def current_parse(lines):
+    return stats.build_stats('bench', statparse.parse_stats(lines))
+
+def by_name(rows):
+    return sorted(rows, key=lambda row: row['url_rem_name'])
+
+def agree(lines):
+    """True if the baseline and current code produce the same stats rows
+    and broken chains from the lines.  Only the columns the baseline wrote
+    are compared."""
+    rows, chains = baseline_parse(lines)
+    genstamp, stat_lines, current_chains = current_parse(lines)
+    if len(rows) != len(stat_lines):
+        return False
+    for row, stat_line in zip(by_name(rows), by_name(stat_lines)):
+        for name in row:
+            if row[name] != stat_line[name]:
+                return False
+    return [(chain['from'], chain['to']) for chain in chains] == \
+           (current_chains or [])
+
+def best_time(parse, lines, repeat):
+    """Return the fastest of three runs, each parsing lines repeat
+    times."""
+    best = None
+    for i in range(3):
+        start = time.time()
+        for j in range(repeat):
+            parse(lines)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000]
+    print "%10s %10s %14s %14s %8s" % ("Remailers", "Lines",
+                                       "Baseline l/s", "Current l/s",
+                                       "Speedup")
+    for size in sizes:
+        lines = synthetic_mlist2(size).splitlines(True)
+        if not agree(lines):
+            print "Baseline and current disagree on %d remailers" % size
+            sys.exit(1)
+        # Aim for roughly 200,000 lines per timed run.
+        repeat = max(1, 200000 / len(lines))
+        count = len(lines) * repeat
+        baseline = count / best_time(baseline_parse, lines, repeat)
+        current = count / best_time(current_parse, lines, repeat)
+        print "%10d %10d %14.0f %14.0f %7.2fx" % (size, len(lines), baseline,
+                                                  current, current / baseline)
+
+if (__name__ == "__main__"):
+    main()
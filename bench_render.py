@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# bench_render.py -- Benchmark the rendering of the HTML reports
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Usage: bench_render.py [remailers ...]
+#
+# Generates synthetic data for each of the pages in pages.py with the given
+# numbers of remailers (100 and 1000 by default), reported on by 20
+# pingers, and reports how long each page takes to render.  Nothing is
+# written to disk and the database isn't used.
+
+import datetime
+import random
+import sys
+import time
+
+import pages
+
+PINGERS = 20
+
+def synthetic_pages(remailers, seed=1):
+    """Return a list of (page, function, args) for rendering each page with
+    data on the given number of remailers.  The same seed always produces
+    the same data."""
+    rand = random.Random(seed)
+    now = datetime.datetime(2011, 10, 18, 10, 15, 2)
+    pingers = [('ping%02d' % i, 'http://ping%02d.example.net/mlist2.txt' % i)
+               for i in range(PINGERS)]
+    names = ['rem%05d' % i for i in range(remailers)]
+    addys = ['%s@example.net' % name for name in names]
+    urls = ['%s.%s.txt' % (name, addy.replace('@', '.'))
+            for name, addy in zip(names, addys)]
+
+    index = []
+    for name, addy, url in zip(names, addys, urls):
+        uptimes = [rand.choice([None, rand.randint(0, 1000) / 10.0])
+                   for pinger in pingers]
+        index.append((name, addy, url, rand.randint(0, 5), rand.randint(0, 5),
+                      uptimes, rand.randint(0, 1000) / 10.0,
+                      rand.randint(0, 200) / 10.0, rand.randint(0, PINGERS)))
+    counts = [rand.randint(0, remailers) for pinger in pingers]
+
+    genealogy = []
+    for name, addy, url in zip(names, addys, urls):
+        last_seen = rand.choice(['', '2011-09-01'])
+        genealogy.append((name, addy, url, '2011-01-01', last_seen,
+                          rand.choice(['', '2011-08-01']),
+                          rand.choice(['', 'Operator retired'])))
+
+    uptimes = [(name, rand.randint(0, 1000) / 10.0, rand.randint(0, 12),
+                rand.randint(0, 59), rand.randint(0, PINGERS))
+               for name in names]
+    failed = [('%s.%s' % (name, addy.replace('@', '.')), addy, name,
+               rand.randint(0, 50)) for name, addy in zip(names, addys)]
+    keys = [(name, addy, 'key.' + url, PINGERS, rand.randint(0, PINGERS),
+             rand.randint(0, 2)) for name, addy, url in zip(names, addys, urls)]
+    key = [(pinger[0], '%032x' % rand.getrandbits(128), '3.0',
+            '2011-01-01', '2012-01-01') for pinger in pingers]
+    spans = ['Day', 'Week', 'Month', 'Year']
+    averages = lambda: [rand.choice([None, (rand.randint(0, 1000) / 10.0,
+                                            rand.randint(0, 12),
+                                            rand.randint(0, 59))])
+                        for span in spans]
+    trends = [(name, addy, averages()) for name, addy in zip(names, addys)]
+    trend_pingers = [(pinger[0], averages()) for pinger in pingers]
+
+    return [('index', pages.index_page, (pingers, index, counts, now)),
+            ('genealogy', pages.genealogy_page, (genealogy, now)),
+            ('uptimes', pages.uptimes_page, (uptimes, now)),
+            ('failed', pages.failed_page, (failed, now)),
+            ('keystats', pages.keys_page, (keys, now)),
+            ('trends', pages.trends_page,
+             (spans, trends, trend_pingers, now)),
+            # Every remailer has a key report of its own.
+            ('key x%d' % remailers,
+             lambda: ''.join([pages.key_page(name, addy, key, now)
+                              for name, addy in zip(names, addys)]), ())]
+
+def best_time(func, args, repeat):
+    """Return the fastest of three runs, each rendering repeat times."""
+    best = None
+    for i in range(3):
+        start = time.time()
+        for j in range(repeat):
+            func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / repeat
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000]
+    print "%10s %-12s %10s %12s" % ("Remailers", "Page", "Bytes", "Render ms")
+    for size in sizes:
+        repeat = max(1, 2000 / size)
+        for page, func, args in synthetic_pages(size):
+            content = func(*args)
+            print "%10d %-12s %10d %12.3f" % (size, page, len(content),
+                                              best_time(func, args, repeat) * 1000)
+
+if (__name__ == "__main__"):
+    main()
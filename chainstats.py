@@ -18,21 +18,26 @@
 
 
 import config
+import dirty
+import output
+import snapshot
 import timefunc
 import re
+from reportpool import report_map
 
-from db import distinct_rem_names
-from db import chain_from
-from db import chain_to
-
-# Write text files for the remailer chain reports.
-def write_remailer_chain_stats(name, addy, ago, ahead):
+# Return the filenames of the From and To broken chain files for a remailer.
+def chain_filenames(name, addy):
     noat = addy.replace('@',".")
     file_chfr = '%s/chfr.%s.%s.txt' % (config.reportdir, name, noat)
     file_chto = '%s/chto.%s.%s.txt' % (config.reportdir, name, noat)
+    return file_chfr, file_chto
+
+# Write text files for the remailer chain reports.
+def write_remailer_chain_stats(snap, name, addy):
+    file_chfr, file_chto = chain_filenames(name, addy)
     # Open the two files for the From and To broken chain files.
-    chain_fr_file = open("%s" % (file_chfr,), 'w')
-    chain_to_file = open("%s" % (file_chto,), 'w')
+    chain_fr_file = output.ReportFile(file_chfr)
+    chain_to_file = output.ReportFile(file_chto)
 
     # Write some headers for the two chainstat reports.
     chain_fr_file.write("Broken chain statistics from the %s remailer (%s)\n" % (name, addy))
@@ -54,16 +59,20 @@ def write_remailer_chain_stats(name, addy, ago, ahead):
     chain_fr_file.write(headers)
     chain_to_file.write(headers)
 
-    for row in chain_from(name, ago, ahead):
+    for row in snap.chains_from.get(name, []):
         chain_fr_file.write(chainstat_row_process(row))
 
-    for row in chain_to(name, ago, ahead):
+    for row in snap.chains_to.get(name, []):
         chain_to_file.write(chainstat_row_process(row))
 
     # Close the two chainstat files.
     chain_fr_file.close()
     chain_to_file.close()
 
+# Called by the report workers for each remailer.
+def remailer_chain_stats(remailer):
+    write_remailer_chain_stats(snapshot.current, remailer[0], remailer[1])
+
 def chainstat_row_process(entry):
     ping_name = entry[0].ljust(24)
     chain_from = entry[1].ljust(16)
@@ -78,11 +87,17 @@ def chainstats():
     #global chain_re
     #chain_re = re.compile('\((\w{1,12})\s(\w{1,12})\)')
 
-    ago = timefunc.hours_ago(config.active_age)
-    ahead = timefunc.hours_ahead(config.active_future)
-
-    for name, addy in distinct_rem_names():
-        write_remailer_chain_stats(name, addy, ago, ahead)
+    # Only the files of remailers whose broken chains have changed are
+    # rewritten.
+    snap = snapshot.get()
+    tracker = dirty.get()
+    changed = []
+    for name, addy in snap.remailers:
+        chains = (snap.chains_from.get(name, []), snap.chains_to.get(name, []))
+        if tracker.changed('chains', (name, addy), chains,
+                           *chain_filenames(name, addy)):
+            changed.append((name, addy))
+    report_map(remailer_chain_stats, changed)
 
 # Call main function.
 if (__name__ == "__main__"):
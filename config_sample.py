@@ -28,6 +28,12 @@ loglevel = "debug"
 # Keyindex is the filename within reportdir for keystats
 keyindex = "keystat.html"
 
+# Database engine, either "postgres" or "sqlite".
+dbengine = "postgres"
+
+# Filename of the database when using the sqlite engine.
+dbfile = "/home/crooks/metastats.db"
+
 # Name of the metastats database
 dbname = "metastats"
 
@@ -37,6 +43,10 @@ dbuser = "metastats"
 # Password for the dbuser account
 #dbpassword = ""
 
+# Number of idle database connections kept open for reuse.  Connections are
+# only opened when they're first needed.
+dbpool = 2
+
 # Number of hours old a timestamp can be and a pinger
 # entry still considered active.
 active_age = 8
@@ -76,6 +86,91 @@ failed_report_name = "failed.html"
 # The filename of the uptimes report
 uptime_report_name = "uptimes.html"
 
+# Reports are only rewritten when something on them other than their
+# timestamp changes, or when the copy on disk is older than this many
+# hours.
+report_refresh_hours = 24
+
+# The filename of the trends report, which averages uptimes and latencies
+# over the last day, week, month and year.  Comment it out to disable.
+trend_report_name = "trends.html"
+
 # Socket timeout, used to prevent url retrieval from hanging.
 # Value is the number of seconds to wait for a url to respond.
 timeout = 30
+
+# Number of threads used to fetch pinger urls concurrently.  Without this
+# and fetch_per_host, urls are fetched one at a time.
+fetch_workers = 8
+
+# Maximum number of simultaneous connections to any single host.  Several
+# pingers are often hosted on the same machine.
+fetch_per_host = 2
+
+# Directory used to cache the last response from each pinger url.  When set,
+# urls are requested conditionally and unchanged stats aren't reprocessed.
+# Comment it out to disable caching.
+cachedir = "/home/crooks/metacache"
+
+# Number of processes used by backfill.py to parse archived stats files.
+# Without this, one is started per CPU.
+backfill_workers = 4
+
+# Number of processes used to write the per-remailer reports.  Set it to 1
+# to write them all from the main process.
+report_workers = 4
+
+# Per-remailer reports are only rewritten when the data they show has
+# changed.  A fingerprint of each is kept in this file between cycles.
+# Comment it out to rewrite every report on every cycle, as --full does.
+statefile = "/home/crooks/metastate.json"
+
+# Every report file that's changed is appended to this manifest, relative
+# to reportdir.  Whatever copies the reports to the web servers can use it
+# as a list of files to send, eg. rsync --files-from, and then truncate it.
+# Comment it out to disable.
+manifest = "/home/crooks/metamanifest"
+
+# Number of months of ping history to keep, including the current one.
+# Older months are dropped, along with their hourly rollups.  The daily
+# rollups are kept indefinitely.
+history_months = 13
+
+# stats.py runs housekeeping if it hasn't been run within this many hours.
+# When housekeeping.py is run from cron, set this higher than the cron
+# interval so that stats.py leaves it alone.
+housekeeping_hours = 6
+
+# Stale mlist2 entries are deleted in batches of at most this many rows,
+# each in its own transaction.
+housekeeping_batch = 5000
+
+# Once housekeeping has deleted this fraction of mlist2, its statistics
+# are refreshed with ANALYZE, and beyond the second fraction it's also
+# vacuumed.
+analyze_churn = 0.1
+vacuum_churn = 0.3
+
+# Database queries taking at least this many seconds are logged, with their
+# parameters, to the main log and also to slow_query_log if it's set.
+slow_query_seconds = 1.0
+slow_query_log = "/home/crooks/slowquery.log"
+
+# At the end of each cycle, the number of calls, time taken and rows
+# returned by each database function are logged.  If this is set, they're
+# also written to it as JSON.  Comment it out to disable.
+query_stats_file = "/home/crooks/querystats.json"
+
+# At the end of each cycle, its duration, the time taken by each phase and
+# counts of pingers fetched and entries written are written to this file in
+# the Prometheus text format, for node_exporter's textfile collector.
+# Comment it out to disable.
+prometheus_textfile = "/var/lib/node_exporter/textfile/metastats.prom"
+
+# Once a cycle, the vitals of every remailer and its uptime with each pinger
+# are exported to these files within reportdir, as JSON and CSV, for other
+# tools to read.  With export_gzip set to True, both are gzipped and .gz is
+# added to their names.  Comment either out to disable it.
+export_json = "metastats.json"
+export_csv = "metastats.csv"
+export_gzip = False
@@ -16,436 +16,601 @@
 # or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
 # for more details.
 
+import contextlib
+import datetime
+import re
+import sys
+import threading
+import time
+
 import config
-import psycopg2
+import dbengine
 import timefunc
 
-try:
-    if hasattr(config, 'dbpassword'):
-        conn = psycopg2.connect('dbname=%s user=%s password=%s'
-                                % config.dbname,
-                                  config.dbuser,
-                                  config.dbpassword)
-    else:
-        conn = psycopg2.connect('dbname=%s user=%s'
-                                % config.dbname,
-                                  config.dbuser)
-except:
-    #TODO initialise logging so we don't have printed errors
-    print "Failed to connect to database"
-
-curs = conn.cursor()
-
-# Insert a new entry into the mlist2 table
-def insert(stat_line):
-    curs.execute("""INSERT INTO mlist2 
-                        (ping_name, rem_name, rem_addy, lat_hist, lat_time,
-                         up_hist, up_time, options, timestamp)
-                    VALUES (
-                        %(url_ping_name)s,
-                        %(url_rem_name)s,
-                        %(url_rem_addy)s,
-                        %(url_lat_hist)s,
-                        %(url_lat_time)s,
-                        %(url_up_hist)s,
-                        %(url_up_time)s,
-                        %(url_options)s,
-                        %(url_timestamp)s)""", stat_line)
-    conn.commit()
-
-# Delete entries from mlist2 that match ping_name and rem_name
-def delete(stat_line):
-    curs.execute("""DELETE FROM mlist2 WHERE 
-                        ping_name = %(url_ping_name)s AND
-                        rem_name = %(url_rem_name)s AND
-                        rem_addy = %(url_rem_addy)s""", stat_line)
-    conn.commit()
-
-# Called from stats.py to perform various housekeeping tasks.
-def housekeeping(age):
-    # First delete entries from mlist2 where the timestamp is > age (hours)
-    # Age defaults to 28 days but the sky is the limit on this one.
-    curs.execute("""DELETE FROM mlist2 WHERE
-                        timestamp < cast(%s AS timestamp)""", (age,))
-    
-    # Now we've deleted old entries from mlist2, this query will delete
-    # entries from pingers that don't exist in mlist2.
-    # Eg. If there are no entries in mlist2 for a pinger, delete that pinger.
-    curs.execute("""DELETE FROM pingers WHERE ping_name NOT IN (
-                    SELECT ping_name FROM mlist2)""")
-
-    # Look through the genealogy table for records where last_fail is
-    # more than 'age' old.  If it is, consider that remailer dead by
-    # setting last_seen to last_fail.
-    curs.execute("""UPDATE genealogy SET
-                    last_seen=last_fail WHERE
-                    last_seen IS NULL AND
-                    last_fail < cast(%s AS timestamp)""", (age,))
-    conn.commit()
-
-    #In genealogy once a remailer is dead (last_seen timestamped), it should
-    # no longer have a last_fail timestamp.
-    curs.execute("""UPDATE genealogy SET
-                    last_fail=NULL WHERE
-                    last_seen IS NOT NULL AND
-                    last_fail IS NOT NULL""")
-
-# Count the total number of pingers.  This is extracted from the mlist2 table
-# in order to exclude dead pingers.
-def count_total_pingers():
-    curs.execute("SELECT count(distinct ping_name) FROM mlist2")
-    total = curs.fetchone()
-    return total[0]
-
-# Count pingers that are conisdered active for a given remailer.  Active in
-# this context means they have shown a ping for that remailer within a
-# defined period of time.
-
-# Return a list of remailer names in mlist2.  Just that.
-def distinct_rem_names():
-    curs.execute("""SELECT DISTINCT rem_name,rem_addy FROM mlist2
-                    ORDER BY rem_name""")
-    return curs.fetchall()
+# The engine is chosen by config.dbengine, PostgreSQL unless told otherwise.
+# Nothing connects to the database until the first transaction, so importing
+# this module is cheap.
+engine = dbengine.get_engine()
+pool = None
+local = threading.local()
+
+# The class used to wrap each cursor.  schema.py swaps in its own to examine
+# query plans.
+cursor_class = dbengine.Cursor
+
+# Timings of the queries issued by each function in this module.  Queries
+# taking config.slow_query_seconds or longer are logged.
+queries = dbengine.QueryStats()
+if hasattr(config, 'slow_query_seconds'):
+    queries.slow = config.slow_query_seconds
+
+def get_pool():
+    global pool
+    if pool is None:
+        size = 2
+        if hasattr(config, 'dbpool'):
+            size = config.dbpool
+        pool = dbengine.Pool(engine, size)
+    return pool
+
+@contextlib.contextmanager
+def transaction():
+    """Run a block of statements as a single transaction.  A connection is
+    taken from the pool and a cursor for it is given to the block.  The
+    transaction is committed when the block completes and rolled back if it
+    raises.  A transaction started within another, on the same thread,
+    becomes part of the outer one.  Connections that fail are discarded, so
+    the next transaction reconnects.  The time taken to commit is counted
+    against the function that started the transaction."""
+    curs = getattr(local, 'curs', None)
+    if curs is not None:
+        yield curs
+        return
+    # Frame 1 is the context manager's __enter__ and 2 the with statement.
+    function = sys._getframe(2).f_code.co_name
+    pool = get_pool()
+    conn = pool.acquire()
+    curs = local.curs = cursor_class(engine, conn.cursor(), queries)
+    try:
+        try:
+            yield curs
+            curs.finish()
+            start = time.time()
+            conn.commit()
+            queries.record_commit(function, time.time() - start)
+        except engine.disconnect_errors():
+            pool.discard(conn)
+            conn = None
+            raise
+        except:
+            conn.rollback()
+            raise
+    finally:
+        local.curs = None
+        if conn is not None:
+            pool.release(conn)
+
+# Return a comma seperated list of parameter placeholders for a multi-row
+# VALUES clause.  Eg. values_list(2, 3) returns (%s,%s,%s),(%s,%s,%s)
+def values_list(rows, columns):
+    row = '(' + ','.join(['%s'] * columns) + ')'
+    return ','.join([row] * rows)
+
+# Turn a list of tuples into a flat list of parameters to go with
+# values_list.
+def flatten(rows):
+    params = []
+    for row in rows:
+        params.extend(row)
+    return params
+
+# Replace all the mlist2 entries reported by a pinger in one transaction.
+# Existing entries for the remailers in stat_lines are deleted and the new
+# entries written with a single multi-row insert.  Entries for remailers the
+# pinger no longer reports are left alone to age out.  The key columns come
+# from the pinger's pubring rather than its stats, which is only processed
+# when it changes.  They're filled in from the keys last read from the
+# pubring, kept in pubring_keys, so a remailer that's new to the pinger gets
+# its key straight away.  Failing that, they're carried over from the entry
+# being replaced.
+def replace_stats(ping_name, stat_lines):
+    if not stat_lines:
+        return
+    remailers = []
+    for stat_line in stat_lines:
+        remailers.extend((stat_line['url_rem_name'],
+                          stat_line['url_rem_addy']))
+    with transaction() as curs:
+        keys = {}
+        for table in 'mlist2', 'pubring_keys':
+            curs.execute("""SELECT rem_name, rem_addy, key, version, valid,
+                            expire FROM """ + table + """ WHERE
+                                ping_name = %s AND
+                                key IS NOT NULL AND
+                                (rem_name, rem_addy) IN (VALUES """ +
+                         values_list(len(stat_lines), 2) + ")",
+                         [ping_name] + remailers)
+            for row in curs.fetchall():
+                keys[tuple(row[0:2])] = tuple(row[2:6])
+        values = []
+        for stat_line in stat_lines:
+            key = keys.get((stat_line['url_rem_name'],
+                            stat_line['url_rem_addy']),
+                           (None, None, None, None))
+            values.extend((stat_line['url_ping_name'],
+                           stat_line['url_rem_name'],
+                           stat_line['url_rem_addy'],
+                           stat_line['url_lat_hist'],
+                           stat_line['url_lat_time'],
+                           stat_line['url_up_hist'],
+                           stat_line['url_up_time'],
+                           stat_line['url_options'],
+                           stat_line['url_timestamp'],
+                           stat_line['url_hist_dead'],
+                           stat_line['url_lat_today'],
+                           stat_line['url_up_today']) + key)
+        curs.execute("""DELETE FROM mlist2 WHERE
+                            ping_name = %s AND
+                            (rem_name, rem_addy) IN (VALUES """ +
+                     values_list(len(stat_lines), 2) + ")",
+                     [ping_name] + remailers)
+        curs.execute("""INSERT INTO mlist2
+                            (ping_name, rem_name, rem_addy, lat_hist, lat_time,
+                             up_hist, up_time, options, timestamp,
+                             hist_dead, lat_today, up_today,
+                             key, version, valid, expire)
+                        VALUES """ + values_list(len(stat_lines), 16), values)
+
+# Every set of stats is also appended to a history table for the month it
+# was generated in, named history_YYYYMM.  Nothing in them is replaced; a
+# pinger's entries are recorded once per Generated timestamp.  Old months
+# are dropped whole by drop_history.
+history_re = re.compile('history_(\d{6})$')
+
+history_columns = """(
+ping_name varchar(24) NOT NULL,
+timestamp timestamp NOT NULL,
+rem_name varchar(12) NOT NULL,
+rem_addy varchar(50) NOT NULL,
+lat_hist char(12),
+lat_time smallint,
+up_hist char(12),
+up_time smallint,
+options char(15),
+hist_dead boolean,
+lat_today smallint,
+up_today smallint,
+PRIMARY KEY (ping_name, timestamp, rem_name, rem_addy)
+)"""
+
+# History tables known to exist, so each is only created once per run.
+history_tables = set()
+
+def history_table(stamp):
+    return 'history_%s%s' % (stamp[0:4], stamp[5:7])
+
+# The stats are summarised into hourly and daily rollups, per remailer and
+# per pinger, as they're recorded.  Each rollup holds the number of pings,
+# how many of those had a known latency, and the totals of latency and
+# uptime, so averages over any span can be taken from a handful of rows.
+# Latencies of 5999 mean no pings have come back and aren't counted.
+rollups = [('remailer_hourly', ('rem_name', 'rem_addy')),
+           ('remailer_daily', ('rem_name', 'rem_addy')),
+           ('pinger_hourly', ('ping_name',)),
+           ('pinger_daily', ('ping_name',))]
+
+def rollup_counts(stat_lines):
+    """Return a tuple of (pings, lat_pings, lat_total, up_total)."""
+    lat_times = [stat_line['url_lat_time'] for stat_line in stat_lines
+                 if stat_line['url_lat_time'] < 5999]
+    return (len(stat_lines), len(lat_times), sum(lat_times),
+            sum([stat_line['url_up_time'] for stat_line in stat_lines]))
+
+def upsert_rollup(curs, table, keys, rows):
+    """Add each row of key values, period and counts to a rollup table."""
+    counts = ('pings', 'lat_pings', 'lat_total', 'up_total')
+    columns = keys + ('period',) + counts
+    updates = ['%s = %s.%s + excluded.%s' % (count, table, count, count)
+               for count in counts]
+    curs.execute("INSERT INTO " + table + " (" + ', '.join(columns) +
+                 ") VALUES " + values_list(len(rows), len(columns)) +
+                 " ON CONFLICT (" + ', '.join(keys + ('period',)) +
+                 ") DO UPDATE SET " + ', '.join(updates), flatten(rows))
+
+# Append a pinger's stats to the history and add them to the rollups.
+# Entries already recorded for this pinger and timestamp are skipped, so a
+# set of stats that's read more than once is only counted once.  Returns
+# the number of entries recorded.
+def record_history(ping_name, stamp, stat_lines):
+    if not stat_lines:
+        return 0
+    table = history_table(stamp)
+    with transaction() as curs:
+        if table not in history_tables:
+            curs.execute("CREATE TABLE IF NOT EXISTS " + table +
+                         " " + history_columns)
+            history_tables.add(table)
+        curs.execute("SELECT rem_name, rem_addy FROM " + table + """ WHERE
+                        ping_name = %s AND
+                        timestamp = cast(%s AS timestamp)""",
+                     (ping_name, stamp))
+        recorded = set(curs.fetchall())
+        new_lines = [stat_line for stat_line in stat_lines if
+                     (stat_line['url_rem_name'], stat_line['url_rem_addy'])
+                     not in recorded]
+        if not new_lines:
+            return 0
+        values = []
+        for stat_line in new_lines:
+            values.extend((ping_name, stamp,
+                           stat_line['url_rem_name'],
+                           stat_line['url_rem_addy'],
+                           stat_line['url_lat_hist'],
+                           stat_line['url_lat_time'],
+                           stat_line['url_up_hist'],
+                           stat_line['url_up_time'],
+                           stat_line['url_options'],
+                           stat_line['url_hist_dead'],
+                           stat_line['url_lat_today'],
+                           stat_line['url_up_today']))
+        curs.execute("INSERT INTO " + table + """
+                        (ping_name, timestamp, rem_name, rem_addy, lat_hist,
+                         lat_time, up_hist, up_time, options, hist_dead,
+                         lat_today, up_today)
+                        VALUES """ + values_list(len(new_lines), 12) + """
+                        ON CONFLICT DO NOTHING""", values)
+
+        hour = stamp[0:13] + ':00:00'
+        day = stamp[0:10] + ' 00:00:00'
+        for rollup, keys in rollups:
+            if rollup.endswith('_hourly'):
+                period = hour
+            else:
+                period = day
+            if keys == ('ping_name',):
+                rows = [(ping_name, period) + rollup_counts(new_lines)]
+            else:
+                rows = [(stat_line['url_rem_name'], stat_line['url_rem_addy'],
+                         period) + rollup_counts([stat_line])
+                        for stat_line in new_lines]
+            upsert_rollup(curs, rollup, keys, rows)
+    return len(new_lines)
+
+# Drop the history tables for months before the most recent number of
+# months, along with the hourly rollups for the same period.  The daily
+# rollups are kept.  Returns the names of the tables dropped.
+def drop_history(months):
+    today = datetime.datetime.utcnow()
+    month = today.year * 12 + today.month - months
+    oldest = '%04d%02d' % (month // 12, month % 12 + 1)
+    dropped = []
+    with transaction() as curs:
+        curs.execute(engine.tables_query)
+        for (table,) in curs.fetchall():
+            is_history = history_re.match(table)
+            if is_history and is_history.group(1) < oldest:
+                curs.execute("DROP TABLE " + table)
+                history_tables.discard(table)
+                dropped.append(table)
+        cutoff = '%s-%s-01 00:00:00' % (oldest[0:4], oldest[4:6])
+        for rollup in 'remailer_hourly', 'pinger_hourly':
+            curs.execute("DELETE FROM " + rollup + """ WHERE
+                            period < cast(%s AS timestamp)""", (cutoff,))
+    return sorted(dropped)
+
+# Sum the counts in a rollup table over the periods since a timestamp.
+# Returns a dictionary of (pings, lat_pings, lat_total, up_total) keyed by
+# remailer, as (rem_name, rem_addy), or by ping_name, depending on what the
+# rollup is kept by.
+def rollup_totals(table, since):
+    keys = dict(rollups)[table]
+    with transaction() as curs:
+        curs.execute("SELECT " + ', '.join(keys) + """, sum(pings),
+                        sum(lat_pings), sum(lat_total), sum(up_total)
+                        FROM """ + table + """ WHERE
+                        period >= cast(%s AS timestamp)
+                        GROUP BY """ + ', '.join(keys), (since,))
+        totals = {}
+        for row in curs.fetchall():
+            if len(keys) == 1:
+                totals[row[0]] = tuple(row[1:])
+            else:
+                totals[tuple(row[:len(keys)])] = tuple(row[len(keys):])
+        return totals
+
+# The housekeeping steps run by housekeeping.py.  Each runs in its own
+# transaction and returns the number of rows it changed.
+
+# Delete a batch of up to limit entries from mlist2 with a timestamp older
+# than age.  The batch is taken from the oldest entries, using the
+# timestamp index, so each transaction is kept short however much has aged
+# out.  Entries sharing the batch's newest timestamp are all deleted
+# together.
+def delete_stale_pings(age, limit):
+    with transaction() as curs:
+        curs.execute("""DELETE FROM mlist2 WHERE
+                            timestamp < cast(%s AS timestamp) AND
+                            timestamp <= (SELECT max(timestamp) FROM
+                                (SELECT timestamp FROM mlist2 WHERE
+                                 timestamp < cast(%s AS timestamp)
+                                 ORDER BY timestamp LIMIT %s) AS batch)""",
+                     (age, age, limit))
+        return curs.rowcount
+
+# Delete pingers that have no entries left in mlist2.
+def delete_idle_pingers():
+    with transaction() as curs:
+        curs.execute("""DELETE FROM pingers WHERE NOT EXISTS
+                        (SELECT 1 FROM mlist2 m WHERE
+                         m.ping_name = pingers.ping_name)""")
+        return curs.rowcount
+
+# Look through the genealogy table for records where last_fail is more than
+# 'age' old.  If it is, consider that remailer dead by setting last_seen to
+# last_fail.
+def gene_mark_dead(age):
+    with transaction() as curs:
+        curs.execute("""UPDATE genealogy SET
+                        last_seen=last_fail WHERE
+                        last_seen IS NULL AND
+                        last_fail < cast(%s AS timestamp)""", (age,))
+        return curs.rowcount
+
+# In genealogy once a remailer is dead (last_seen timestamped), it should no
+# longer have a last_fail timestamp.
+def gene_clear_failed():
+    with transaction() as curs:
+        curs.execute("""UPDATE genealogy SET
+                        last_fail=NULL WHERE
+                        last_seen IS NOT NULL AND
+                        last_fail IS NOT NULL""")
+        return curs.rowcount
+
+def count_pings():
+    with transaction() as curs:
+        curs.execute("SELECT count(*) FROM mlist2")
+        return curs.fetchone()[0]
+
+# Return the time housekeeping last completed, or None if it never has.
+def last_housekeeping():
+    with transaction() as curs:
+        curs.execute("SELECT max(run) FROM housekeeping_log")
+        return curs.fetchone()[0]
+
+# Record the rows changed and seconds taken by each step of a housekeeping
+# run.  metrics is a list of (step, rows, seconds) tuples.
+def log_housekeeping(run, metrics):
+    if not metrics:
+        return
+    with transaction() as curs:
+        curs.execute("""INSERT INTO housekeeping_log
+                            (run, step, rows, seconds)
+                        VALUES """ + values_list(len(metrics), 4),
+                     flatten([(run,) + metric for metric in metrics]))
+
+# Run maintenance statements, such as VACUUM, that can't be run within a
+# transaction.  The connection is returned to the pool afterwards, back in
+# its usual transactional mode.  Returns the number of statements run.
+def maintain(statements):
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        engine.set_autocommit(conn, True)
+        try:
+            curs = cursor_class(engine, conn.cursor(), queries)
+            for statement in statements:
+                curs.execute(statement)
+            curs.finish()
+        finally:
+            engine.set_autocommit(conn, False)
+    except engine.disconnect_errors():
+        pool.discard(conn)
+        raise
+    pool.release(conn)
+    return len(statements)
 
 # Return a list of the pinger entries in table pingers.  The check for
 # NULL entries is just to be on the safe side.
 def pinger_names():
-    curs.execute("""SELECT ping_name, mlist2 FROM pingers
-                    WHERE mlist2 IS NOT NULL
-                    ORDER BY ping_name""")
-    return curs.fetchall()
+    with transaction() as curs:
+        curs.execute("""SELECT ping_name, mlist2 FROM pingers
+                        WHERE mlist2 IS NOT NULL
+                        ORDER BY ping_name""")
+        return curs.fetchall()
 
 # Return all the pingers listed in pingers where they also exist in mlist2.
 # This accounts for dead pingers that have no entries at all in mlist2.
 def active_pinger_names():
-    curs.execute("""SELECT ping_name,mlist2 FROM pingers p WHERE EXISTS
-                    (SELECT ping_name FROM mlist2 m WHERE
-                    m.ping_name = p.ping_name) ORDER BY ping_name""")
-    return curs.fetchall()
+    with transaction() as curs:
+        curs.execute("""SELECT ping_name,mlist2 FROM pingers p WHERE EXISTS
+                        (SELECT ping_name FROM mlist2 m WHERE
+                        m.ping_name = p.ping_name) ORDER BY ping_name""")
+        return curs.fetchall()
     
-def remailer_avgs_all(conf):
-    curs.execute("""SELECT avg(lat_time), avg(up_time), stddev(lat_time),
-                    stddev(up_time), count(*) FROM mlist2 WHERE
-                    rem_name = %(rem_name)s AND
-                    rem_addy = %(rem_addy)s AND
-                    timestamp >= cast(%(max_age)s AS timestamp) AND
-                    timestamp <= cast(%(max_future)s AS timestamp) AND
-                    lat_time < 5999 AND
-                    up_time > 0""", conf)
-    return curs.fetchone()
-
-def remailer_stats(conf):
-    curs.execute("""SELECT min(lat_time), avg(lat_time), max(lat_time), stddev(lat_time),
-                    min(up_time), avg(up_time), max(up_time), stddev(up_time), count(*) FROM mlist2 WHERE
-                    rem_name = %(rem_name)s AND
-                    rem_addy = %(rem_addy)s AND
-                    timestamp >= cast(%(max_age)s AS timestamp) AND
-                    timestamp <= cast(%(max_future)s AS timestamp) AND
-                    up_time >= cast(%(rem_uptime_avg_all)s - %(rem_uptime_stddev_range)s AS int) AND
-                    up_time <= cast(%(rem_uptime_avg_all)s + %(rem_uptime_stddev_range)s AS int) AND
-                    lat_time >= cast(%(rem_latency_avg_all)s - %(rem_latency_stddev_range)s AS int) AND
-                    lat_time <= cast(%(rem_latency_avg_all)s + %(rem_latency_stddev_range)s AS int) AND
-                    up_hist !~ '^[0?]{12}$' and
-                    lat_time < 5999""", conf)
-    return curs.fetchone()
-
-def remailer_index_pings(name, addy):
-    curs.execute("""SELECT ping_name,up_time/10.0 FROM mlist2
-                    WHERE rem_name = %s AND
-                    rem_addy = %s AND
-                    timestamp >= cast(%s AS timestamp) AND
-                    timestamp <= cast(%s AS timestamp)""", (name, addy, ago, ahead))
-    return dict(curs.fetchall())
-
-def remailer_index_count():
-    curs.execute("""SELECT ping_name,count(rem_name) FROM mlist2 WHERE
-                    timestamp >= cast(%s AS timestamp) AND
-                    timestamp <= cast(%s AS timestamp)
-                    GROUP BY ping_name""", (ago, ahead))
-    return dict(curs.fetchall())
-
-def remailer_index_stats(name, addy):
-    curs.execute("""SELECT avg(up_time)/10.0, stddev(up_time)/10.0, count(up_time)
-                    FROM mlist2 WHERE rem_name = %s AND
-                    rem_addy = %s AND
-                    timestamp >= cast(%s AS timestamp) AND
-                    timestamp <= cast(%s AS timestamp) AND
-                    up_time > 0""",
-                    (name, addy, ago, ahead))
-    return curs.fetchone()
-
-# This routine collects all the pings that are considered 'Active'.  Active
-# implies they fall between defined boundaries of uptime and also are less
-# then a defined number of hours old.
-def remailer_active_pings(conf):
-    curs.execute("""SELECT * FROM mlist2 WHERE
-                    rem_name = %(rem_name)s AND
-                    rem_addy = %(rem_addy)s AND
-                    timestamp >= cast(%(max_age)s AS timestamp) AND
-                    timestamp <= cast(%(max_future)s AS timestamp) AND
-                    up_time >= cast(%(rem_uptime_avg_all)s - %(rem_uptime_stddev_range)s AS int) AND
-                    up_time <= cast(%(rem_uptime_avg_all)s + %(rem_uptime_stddev_range)s AS int) AND
-                    lat_time >= cast(%(rem_latency_avg_all)s - %(rem_latency_stddev_range)s AS int) AND
-                    lat_time <= cast(%(rem_latency_avg_all)s + %(rem_latency_stddev_range)s AS int) AND
-                    up_hist !~ '^[0?]{12}$' and
-                    lat_time < 5999
-                    ORDER BY up_time DESC, ping_name ASC""", conf)
-    return curs.fetchall()
-
-# Almost identical to remailer_active_pings, but this routine capures the
-# pings that fall outside the boundaries of uptime, although must still
-# comply with not exceeding a defined age in hours.
-def remailer_inactive_pings(conf):
-    curs.execute("""SELECT * FROM mlist2 WHERE
-                    rem_name = %(rem_name)s AND
-                    rem_addy = %(rem_addy)s AND
-                    (timestamp > cast(%(max_future)s AS timestamp) OR
-                    (timestamp < cast(%(max_age)s AS timestamp)))
-                    ORDER BY up_time DESC, ping_name ASC""", conf)
-    return curs.fetchall()
-
-# Last in the pinger series, this one doesn't care about uptime boundaries,
-# it simply checks to see if pings exceed an acceptable age.  If they do,
-# then they are inactive pings.
-def remailer_ignored_pings(conf):
-    curs.execute("""SELECT * FROM mlist2 WHERE
-                    rem_name = %(rem_name)s AND
-                    rem_addy = %(rem_addy)s AND
-                    timestamp >= cast(%(max_age)s AS timestamp) AND
-                    timestamp <= cast(%(max_future)s AS timestamp) AND
-                    (up_time < cast(%(rem_uptime_avg_all)s - %(rem_uptime_stddev_range)s AS int) OR
-                    up_time > cast(%(rem_uptime_avg_all)s + %(rem_uptime_stddev_range)s AS int) OR
-                    lat_time < cast(%(rem_latency_avg_all)s - %(rem_latency_stddev_range)s AS int) OR
-                    lat_time > cast(%(rem_latency_avg_all)s + %(rem_latency_stddev_range)s AS int) OR
-                    up_hist ~ '^[0?]{12}$' OR
-                    lat_time = 5999)
-                    ORDER BY up_time DESC, ping_name ASC""", conf)
-    return curs.fetchall()
-
-# Called from failed.py, this routine puts a last_fail timestamp in the
-# genealogy table providing there isn't already one set and last_seen
-# is also unset.  The mark_recovered routine removes the last_fail
-# timestamp when a remailer recovers.
-def mark_failed(name, addy, time):
-    details = { 'rem_name' : name,
-                'rem_addy' : addy,
-                'fail_time' : time }
-    curs.execute("""UPDATE genealogy SET
-                    last_fail = cast(%(fail_time)s AS timestamp) WHERE
-                    last_seen IS NULL AND
-                    last_fail IS NULL AND
-                    rem_name = %(rem_name)s AND
-                    rem_name <> 'bunker' AND
-                    rem_addy = %(rem_addy)s""", details)
-    conn.commit()
-
-# Remove a fail_time timestamp from the genealogy table providing
-# last_seen is not set.  This is called from failed.py.
-def mark_recovered(name, addy):
-    details = { 'rem_name' : name,
-                'rem_addy' : addy }
-    curs.execute("""UPDATE genealogy SET
-                    last_fail = NULL WHERE
-                    last_seen IS NULL and
-                    rem_name = %(rem_name)s AND
-                    rem_addy = %(rem_addy)s""", details)
-    conn.commit()
-                    
+# Return a dictionary of the most recent mlist2 timestamp for each pinger.
+def pinger_latest():
+    with transaction() as curs:
+        curs.execute("""SELECT ping_name, max(timestamp) FROM mlist2
+                        GROUP BY ping_name""")
+        return dict(curs.fetchall())
+
+# Return every entry in mlist2, for the snapshot.  The columns are listed
+# explicitly, in table order, as rows are rebuilt from the snapshot in the
+# same order.
+def remailer_pings():
+    with transaction() as curs:
+        curs.execute("""SELECT ping_name, rem_name, rem_addy, lat_hist,
+                        lat_time, up_hist, up_time, options, timestamp, key,
+                        version, valid, expire, hist_dead, lat_today, up_today
+                        FROM mlist2""")
+        return curs.fetchall()
+
+# Record remailers that have failed or recovered in the genealogy table, in
+# a single transaction.  A failed remailer gets a last_fail timestamp,
+# providing there isn't already one set and last_seen is also unset.  A
+# recovered one has its last_fail timestamp removed, providing last_seen is
+# not set.  Both are lists of (rem_name, rem_addy).
+def mark_genealogy(failed, recovered, time):
+    with transaction() as curs:
+        if failed:
+            curs.execute("""UPDATE genealogy SET
+                            last_fail = cast(%s AS timestamp) WHERE
+                            last_seen IS NULL AND
+                            last_fail IS NULL AND
+                            rem_name <> 'bunker' AND
+                            (rem_name, rem_addy) IN (VALUES """ +
+                         values_list(len(failed), 2) + ")",
+                         [time] + flatten(failed))
+        if recovered:
+            curs.execute("""UPDATE genealogy SET
+                            last_fail = NULL WHERE
+                            last_seen IS NULL AND
+                            (rem_name, rem_addy) IN (VALUES """ +
+                         values_list(len(recovered), 2) + ")",
+                         flatten(recovered))
+
 def update_contacts():
-    curs.execute("""SELECT DISTINCT rem_name,rem_addy FROM mlist2 EXCEPT
-                    (SELECT rem_name,rem_addy FROM contacts)""")
-    data = curs.fetchall()
-    
-    for entry in data:
-        print entry
-        curs.execute("""INSERT INTO contacts (rem_name,rem_addy)
-                        VALUES(%s, %s)""", (entry[0], entry[1]))
-        conn.commit()
+    with transaction() as curs:
+        curs.execute("""SELECT DISTINCT rem_name,rem_addy FROM mlist2 EXCEPT
+                        SELECT rem_name,rem_addy FROM contacts""")
+        data = curs.fetchall()
+
+        for entry in data:
+            print entry
+            curs.execute("""INSERT INTO contacts (rem_name,rem_addy)
+                            VALUES(%s, %s)""", (entry[0], entry[1]))
 
 # Get a list of all genealogy details for report production.
 def gene_get_stats():
-    curs.execute("""SELECT rem_name, rem_addy, first_seen,
-                    last_seen, last_fail, comments FROM
-                    genealogy WHERE
-                    rem_name IS NOT NULL AND
-                    rem_addy IS NOT NULL
-                    ORDER BY last_seen DESC,rem_name ASC""")
-    return curs.fetchall()
+    with transaction() as curs:
+        curs.execute("""SELECT rem_name, rem_addy, first_seen,
+                        last_seen, last_fail, comments FROM
+                        genealogy WHERE
+                        rem_name IS NOT NULL AND
+                        rem_addy IS NOT NULL
+                        ORDER BY last_seen DESC NULLS FIRST,rem_name ASC""")
+        return curs.fetchall()
 
 # Check to see if there are any remailer names in the mlist2 table that don't
 # exist in the genealogy table.  If there are any, then write them along with
 # the current time.  Entries in genealogy table are excluded if the already
 # have a last_seen address.  This accounts for remailers returning with the
-# same name and address.
+# same name and address.  Remailers whose uptime history shows no uptime at
+# all (hist_dead) are not considered new.
 def gene_find_new():
-    curs.execute("""SELECT rem_name,rem_addy FROM mlist2 WHERE
-                    rem_name IS NOT NULL AND
-                    rem_addy IS NOT NULL AND
-                    timestamp > cast(%s AS timestamp) AND
-                    up_hist !~ '^[0?]{12}$' EXCEPT
-                    (SELECT rem_name,rem_addy FROM genealogy WHERE
-                    last_seen IS NULL)""", (ago,))
-    new_remailers = curs.fetchall()
-    #TODO Non database functionality shouldn't be in here
-    for new_remailer in new_remailers:
-        new_data = {'new_remailer_name':new_remailer[0],
-                    'new_remailer_addy':new_remailer[1],
-                    'new_remailer_time':now}
-        #TODO Remove internall call to another function
-        gene_insert_new(new_data)
+    with transaction() as curs:
+        curs.execute("""SELECT rem_name,rem_addy FROM mlist2 WHERE
+                        rem_name IS NOT NULL AND
+                        rem_addy IS NOT NULL AND
+                        hist_dead = %s AND
+                        timestamp > cast(%s AS timestamp) EXCEPT
+                        SELECT rem_name,rem_addy FROM genealogy WHERE
+                        last_seen IS NULL""", (False, ago))
+        new_remailers = curs.fetchall()
+        #TODO Non database functionality shouldn't be in here
+        for new_remailer in new_remailers:
+            new_data = {'new_remailer_name':new_remailer[0],
+                        'new_remailer_addy':new_remailer[1],
+                        'new_remailer_time':now}
+            #TODO Remove internall call to another function
+            gene_insert_new(new_data)
 
 # This function is called from gene_find_new for each newly discovered
 # remailer.
 def gene_insert_new(remailer):
-    curs.execute("""INSERT INTO genealogy
-                        (rem_name, rem_addy, first_seen)
-                    VALUES (
-                        %(new_remailer_name)s,
-                        %(new_remailer_addy)s,
-                        %(new_remailer_time)s)""", remailer)
-    conn.commit()
-
-# First delete any entries from the chainstat2 table where the data matches
-# the new entry.  In theory there can be zero or one entry.  After deleting,
-# reinsert the new entry with an up to date timestamp.
-def chainstat_update(chain):
-    curs.execute("""DELETE FROM chainstat2 WHERE
-                    ping_name = %(pinger)s AND
-                    chain_from = %(from)s AND
-                    chain_to = %(to)s""", chain)
-    curs.execute("""INSERT INTO chainstat2
-                        (ping_name, last_seen, chain_from, chain_to)
-                    VALUES (
-                        %(pinger)s,
-                        %(stamp)s,
-                        %(from)s,
-                        %(to)s)""", chain)
-    conn.commit()
-
-# Count how many broken From chain entries there are for a given remailer
-def chain_from_count(conf):
-    curs.execute("""SELECT count(chain_from) FROM chainstat2 WHERE
-                    chain_from = %(rem_name)s AND
-                    last_seen >= cast(%(max_age)s AS timestamp) AND
-                    last_seen <= cast(%(max_future)s AS timestamp)""", conf)
-    return curs.fetchone()[0]
-
-def chain_from_count2():
-    curs.execute("""SELECT chain_from,count(chain_from) FROM chainstat2 WHERE
-                    last_seen >= cast(%s AS timestamp) AND
-                    last_seen <= cast(%s AS timestamp) GROUP BY
-                    chain_from""", (ago, ahead))
-    return dict(curs.fetchall())
-
-# Count how many broken To chain entries there are for a given remailer
-def chain_to_count(conf):
-    curs.execute("""SELECT count(chain_to) FROM chainstat2 WHERE
-                    chain_to = %(rem_name)s AND
-                    last_seen >= cast(%(max_age)s AS timestamp) AND
-                    last_seen <= cast(%(max_future)s AS timestamp)""", conf)
-    return curs.fetchone()[0]
-
-def chain_to_count2():
-    curs.execute("""SELECT chain_to,count(chain_to) FROM chainstat2 WHERE
-                    last_seen >= cast(%s AS timestamp) AND
-                    last_seen <= cast(%s AS timestamp) GROUP BY
-                    chain_to""", (ago, ahead))
-    return dict(curs.fetchall())
-
-# Return broken Fom chains for a given remailer
-def chain_from(name, ago, ahead):
-    curs.execute("""SELECT ping_name,chain_from,chain_to,last_seen
-                    FROM chainstat2 WHERE
-                    chain_from = %s AND
-                    last_seen >= cast(%s AS timestamp) AND
-                    last_seen <= cast(%s AS timestamp)
-                    ORDER BY chain_to, ping_name""", (name, ago, ahead))
-    return curs.fetchall()
-
-# Return broken Fom chains for a given remailer
-def chain_to(name, ago, ahead):
-    curs.execute("""SELECT ping_name,chain_from,chain_to,last_seen
-                    FROM chainstat2 WHERE
-                    chain_to = %s AND
-                    last_seen >= cast(%s AS timestamp) AND
-                    last_seen <= cast(%s AS timestamp)
-                    ORDER BY chain_from, ping_name""", (name, ago, ahead))
-    return curs.fetchall()
-
-def avg_uptime():
-    curs.execute("""SELECT rem_name,avg(up_time)/10,avg(lat_time),
-                    count(ping_name) FROM mlist2 WHERE
-                    timestamp >= cast(%s AS timestamp) AND
-                    timestamp <= cast(%s AS timestamp)
-                    GROUP BY rem_name
-                    ORDER BY avg(up_time) DESC""", (ago, ahead))
-    return curs.fetchall()
+    with transaction() as curs:
+        curs.execute("""INSERT INTO genealogy
+                            (rem_name, rem_addy, first_seen)
+                        VALUES (
+                            %(new_remailer_name)s,
+                            %(new_remailer_addy)s,
+                            %(new_remailer_time)s)""", remailer)
+
+# Replace the set of broken chains reported by a pinger in a single
+# transaction.  The new set is compared with what's already recorded for the
+# pinger: chains that are still broken only have last_seen updated, new ones
+# are inserted and those no longer reported are deleted.  Returns a tuple of
+# the number of chains added, updated and deleted.
+def chainstat_replace(ping_name, stamp, chains):
+    chains = set(chains)
+    with transaction() as curs:
+        curs.execute("""SELECT chain_from, chain_to FROM chainstat2 WHERE
+                        ping_name = %s""", (ping_name,))
+        existing = set(curs.fetchall())
+        added = list(chains - existing)
+        seen = list(chains & existing)
+        removed = list(existing - chains)
+        if removed:
+            curs.execute("""DELETE FROM chainstat2 WHERE
+                                ping_name = %s AND
+                                (chain_from, chain_to) IN (VALUES """ +
+                         values_list(len(removed), 2) + ")",
+                         [ping_name] + flatten(removed))
+        if seen:
+            curs.execute("""UPDATE chainstat2 SET
+                                last_seen = %s WHERE
+                                ping_name = %s AND
+                                (chain_from, chain_to) IN (VALUES """ +
+                         values_list(len(seen), 2) + ")",
+                         [stamp, ping_name] + flatten(seen))
+        if added:
+            values = []
+            for chain_from, chain_to in added:
+                values.extend((ping_name, stamp, chain_from, chain_to))
+            curs.execute("""INSERT INTO chainstat2
+                                (ping_name, last_seen, chain_from, chain_to)
+                            VALUES """ + values_list(len(added), 4), values)
+    return len(added), len(seen), len(removed)
+
+# Return the broken chains last seen within a window, for the snapshot.
+def chains(ago, ahead):
+    with transaction() as curs:
+        curs.execute("""SELECT ping_name,chain_from,chain_to,last_seen
+                        FROM chainstat2 WHERE
+                        last_seen >= cast(%s AS timestamp) AND
+                        last_seen <= cast(%s AS timestamp)""", (ago, ahead))
+        return curs.fetchall()
 
 def keyrings():
-    curs.execute("""SELECT ping_name,pubring FROM pingers WHERE
-                    pubring IS NOT NULL""")
-    return curs.fetchall()
-
-def insert_key(ping_name, rem_name, rem_addy, rem_key, rem_version,
-               valid, expire):
-    conf = {'ping_name' : ping_name,
-            'rem_name' : rem_name,
-            'rem_addy' : rem_addy,
-            'rem_key' : rem_key,
-            'rem_version' : rem_version,
-            'valid' : valid,
-            'expire' : expire }
-    curs.execute("""UPDATE mlist2 SET
-                    key = %(rem_key)s,
-                    version = %(rem_version)s,
-                    valid = %(valid)s,
-                    expire = %(expire)s
-                    WHERE rem_name = %(rem_name)s AND
-                    rem_addy = %(rem_addy)s AND
-                    ping_name = %(ping_name)s""", conf)
-    conn.commit()
-
-def count_active_keys():
-    """Count how many times each remailer name occurs in mlist2.
-    This gives us a count of how many pingers return a result for
-    each remailer.  We use this routine to check keys, so we're
-    only interested in results where keys are not null."""
-    curs.execute("""SELECT rem_name,rem_addy,count(rem_name)
-                    FROM mlist2 WHERE
-                    timestamp > cast(%s AS timestamp) AND
-                    timestamp < cast(%s AS timestamp)
-                    GROUP BY rem_name,rem_addy
-                    ORDER BY rem_name,rem_addy""", (ago, ahead))
-    return curs.fetchall()
-   
-
-def count_unique_keys(name, addy):
-    """Like count_active_keys, except this routine counts how many unique
-    keys there are for each remailer name.  In a perfect would, this routine
-    would return 1 for each remailer.  This would indicate that all pingers
-    were reporting the same key."""
-    curs.execute("""SELECT count(key),count(distinct key)
-                    FROM mlist2 WHERE
-                    rem_name=%s AND
-                    rem_addy=%s AND
-                    timestamp > cast(%s AS timestamp) AND
-                    timestamp < cast(%s AS timestamp) AND
-                    key IS NOT NULL
-                    GROUP BY rem_name,rem_addy""", (name, addy, ago, ahead))
-    return curs.fetchone()
-
-def remailer_keys(name, addy):
-    """Return all the ping_names and keys reported for a single remailer."""
-    curs.execute("""SELECT ping_name,key,version,valid,expire FROM mlist2 WHERE
-                    rem_name=%s AND
-                    rem_addy=%s AND
-                    timestamp > cast(%s AS timestamp) AND
-                    timestamp < cast(%s AS timestamp)
-                    ORDER BY ping_name""", (name, addy, ago, ahead))
-    return curs.fetchall()
+    with transaction() as curs:
+        curs.execute("""SELECT ping_name,pubring FROM pingers WHERE
+                        pubring IS NOT NULL""")
+        return curs.fetchall()
+
+# Write the key details reported in a pinger's pubring.mix to its mlist2
+# entries.  keys is a list of (rem_name, rem_addy, key, version, valid,
+# expire) tuples.  All the entries are updated by a single statement.  The
+# keys also replace those held for the pinger in pubring_keys, for
+# replace_stats to fill in entries for remailers it hasn't reported before.
+def update_keys(ping_name, keys):
+    # If a pinger reports a remailer more than once, the last entry wins.
+    latest = {}
+    for key in keys:
+        latest[key[0:2]] = key
+    if not latest:
+        return
+    with transaction() as curs:
+        # The columns of a VALUES list are named column1, column2, etc.
+        curs.execute("""UPDATE mlist2 SET
+                        key = v.column3,
+                        version = v.column4,
+                        valid = cast(v.column5 AS date),
+                        expire = cast(v.column6 AS date)
+                        FROM (VALUES """ + values_list(len(latest), 6) + """)
+                        AS v WHERE
+                        mlist2.rem_name = v.column1 AND
+                        mlist2.rem_addy = v.column2 AND
+                        mlist2.ping_name = %s""",
+                     flatten(latest.values()) + [ping_name])
+        curs.execute("DELETE FROM pubring_keys WHERE ping_name = %s",
+                     (ping_name,))
+        curs.execute("""INSERT INTO pubring_keys
+                            (ping_name, rem_name, rem_addy, key, version,
+                             valid, expire)
+                        VALUES """ + values_list(len(latest), 7),
+                     flatten([(ping_name,) + key for key in latest.values()]))
 
 global now, ago, ahead
 now = timefunc.utcnow()
 ago = timefunc.hours_ago(config.active_age)
 ahead = timefunc.hours_ahead(config.active_future)
-
@@ -0,0 +1,413 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# dbengine.py -- Database backends for db.py
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# The queries in db.py are written for PostgreSQL using pyformat parameters.
+# Each engine knows how to connect to its database and how to translate
+# those queries into its own dialect.
+
+import logging
+import math
+import re
+import sys
+import threading
+import time
+
+import config
+
+logger = logging.getLogger('stats')
+
+# Besides connecting and translating queries, each engine says which errors
+# mean a connection is broken and whether an idle connection is still
+# usable.  It also describes how to list the tables in its database and how
+# to ask for a query plan.  The statements in explain_setup are run within
+# the same transaction, before each plan is asked for.  Postgres is told to
+# avoid sequential scans, so its plans show whether an index could be used
+# even on tables too small to be worth using one.  Given the steps of a
+# plan, seq_scans returns those that read a whole table.
+#
+# VACUUM can't run within a transaction, so set_autocommit switches a
+# connection in and out of autocommit for it.  vacuum returns the
+# statements that reclaim space from the given tables.
+class PostgresEngine(object):
+    name = 'postgres'
+    tables_query = """SELECT table_name FROM information_schema.tables
+                      WHERE table_schema = current_schema()"""
+    explain = 'EXPLAIN '
+    explain_setup = ['SET LOCAL enable_seqscan = off']
+
+    def connect(self):
+        import psycopg2
+        params = 'dbname=%s user=%s' % (config.dbname, config.dbuser)
+        if hasattr(config, 'dbpassword'):
+            params += ' password=%s' % config.dbpassword
+        return psycopg2.connect(params)
+
+    def disconnect_errors(self):
+        import psycopg2
+        return (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+    def usable(self, conn):
+        return not conn.closed
+
+    def set_autocommit(self, conn, autocommit):
+        conn.autocommit = autocommit
+
+    def vacuum(self, tables):
+        return ['VACUUM %s' % table for table in tables]
+
+    def translate(self, query):
+        return query
+
+    def seq_scans(self, plan):
+        return [step for step in plan if 'Seq Scan' in step]
+
+# Translations from PostgreSQL to SQLite.  Parameters are translated first
+# so that casts no longer contain parentheses.  Timestamps are stored in
+# SQLite as ISO format text, so casts to timestamp or date are dropped;
+# casting them would give them numeric affinity.  Postgres rounds when it
+# casts to an integer, whereas SQLite truncates, so those casts become
+# round().  Regex matches are handled by the regexp function registered
+# below.
+sqlite_translations = [
+    (re.compile('%\((\w+)\)s'), r':\1'),
+    (re.compile('%s'), '?'),
+    (re.compile('%%'), '%'),
+    (re.compile('cast\(([^()]*?) AS (?:timestamp|date)\)', re.I), r'\1'),
+    (re.compile('cast\(([^()]*?) AS int\)', re.I), r'round(\1)'),
+    (re.compile('([\w.]+) !~ '), r'NOT \1 REGEXP '),
+    (re.compile('([\w.]+) ~ '), r'\1 REGEXP ')]
+
+# Pragmas applied to every SQLite connection.  WAL allows the report
+# modules to read whilst stats are being written, and with WAL, NORMAL
+# synchronous is still safe against corruption.
+sqlite_pragmas = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -32000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA busy_timeout = 30000']
+
+regexp_cache = {}
+
+def regexp(pattern, value):
+    """Implements SQLite's REGEXP operator.  Compiled patterns are cached as
+    the same few patterns are used over and over."""
+    if value is None:
+        return False
+    try:
+        compiled = regexp_cache[pattern]
+    except KeyError:
+        compiled = regexp_cache[pattern] = re.compile(pattern)
+    return compiled.search(value) is not None
+
+class StdDev(object):
+    """Sample standard deviation aggregate, matching PostgreSQL's stddev.
+    Uses Welford's method so it's a single pass over the values."""
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def finalize(self):
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+class SQLiteEngine(object):
+    name = 'sqlite'
+    tables_query = "SELECT name FROM sqlite_master WHERE type = 'table'"
+    explain = 'EXPLAIN QUERY PLAN '
+    explain_setup = []
+
+    def __init__(self):
+        self.translated = {}
+
+    def connect(self):
+        import sqlite3
+        # Pooled connections may be used by whichever thread takes them.
+        conn = sqlite3.connect(config.dbfile,
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               cached_statements=256,
+                               check_same_thread=False)
+        conn.text_factory = str
+        conn.create_function('regexp', 2, regexp)
+        conn.create_aggregate('stddev', 1, StdDev)
+        for pragma in sqlite_pragmas:
+            conn.execute(pragma)
+        return conn
+
+    def disconnect_errors(self):
+        # A local database file doesn't disconnect, but a connection that's
+        # been closed can't be used again.
+        import sqlite3
+        return (sqlite3.ProgrammingError,)
+
+    def usable(self, conn):
+        return True
+
+    def set_autocommit(self, conn, autocommit):
+        if autocommit:
+            conn.isolation_level = None
+        else:
+            conn.isolation_level = ''
+
+    def vacuum(self, tables):
+        # SQLite can only vacuum the whole database.
+        return ['VACUUM']
+
+    def translate(self, query):
+        # The sqlite3 module keeps a cache of prepared statements keyed on
+        # the query text, so each query is translated once and the same
+        # string handed back every time.
+        try:
+            return self.translated[query]
+        except KeyError:
+            pass
+        sqlite_query = query
+        for pattern, replacement in sqlite_translations:
+            sqlite_query = pattern.sub(replacement, sqlite_query)
+        self.translated[query] = sqlite_query
+        return sqlite_query
+
+    def seq_scans(self, plan):
+        # Scanning a covering index is fine, it's still an index.  So is
+        # scanning the result of a subquery or CTE, as the plan shows how
+        # that was produced separately.
+        subqueries = set()
+        for step in plan:
+            if step.startswith('MATERIALIZE ') or step.startswith('CO-ROUTINE '):
+                subqueries.add(step.split()[1])
+        return [step for step in plan if step.startswith('SCAN ') and
+                'INDEX' not in step and step.split()[1] not in subqueries]
+
+class QueryStats(object):
+    """Totals of the queries issued by each function in db.py: the number
+    of queries, their total and longest seconds and the rows they returned
+    or changed.  A query is timed from being executed until the next is, or
+    the transaction ends, so fetching its results is included.  Committing
+    a transaction is timed against the function that started it, and
+    included in its total seconds.  Queries or commits taking slow seconds
+    or more are logged, with any parameters, to the stats.slow logger."""
+    def __init__(self, slow=None):
+        self.slow = slow
+        self.functions = {}
+        self.lock = threading.Lock()
+        self.slow_logger = logging.getLogger('stats.slow')
+
+    def record(self, function, seconds, rows, query, params):
+        self.lock.acquire()
+        try:
+            totals = self.totals(function)
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            totals[3] += rows
+        finally:
+            self.lock.release()
+        if self.slow is not None and seconds >= self.slow:
+            self.slow_logger.warn("%s took %.3f seconds: %s %r", function,
+                                  seconds, " ".join(query.split()), params)
+
+    def record_commit(self, function, seconds):
+        self.lock.acquire()
+        try:
+            totals = self.totals(function)
+            totals[1] += seconds
+            totals[4] += seconds
+        finally:
+            self.lock.release()
+        if self.slow is not None and seconds >= self.slow:
+            self.slow_logger.warn("%s took %.3f seconds to commit", function,
+                                  seconds)
+
+    def totals(self, function):
+        # Called with the lock held.
+        try:
+            return self.functions[function]
+        except KeyError:
+            totals = self.functions[function] = [0, 0.0, 0.0, 0, 0.0]
+            return totals
+
+    def summary(self):
+        """Return a list of (function, calls, seconds, max_seconds, rows,
+        commit_seconds) tuples, the slowest function first."""
+        self.lock.acquire()
+        try:
+            rows = [(function,) + tuple(totals) for function, totals
+                    in self.functions.items()]
+        finally:
+            self.lock.release()
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        return rows
+
+class Cursor(object):
+    """Wraps a DB-API cursor so that queries are translated for the engine
+    before they're executed.  Given a QueryStats, each query is timed and
+    counted against the function that issued it."""
+    def __init__(self, engine, cursor, queries=None):
+        self.engine = engine
+        self.cursor = cursor
+        self.queries = queries
+        self.call = None
+
+    def caller(self):
+        # The first frame that isn't a method of a cursor.
+        frame = sys._getframe(1)
+        while isinstance(frame.f_locals.get('self'), Cursor):
+            frame = frame.f_back
+        return frame.f_code.co_name
+
+    def execute(self, query, params=None):
+        if self.queries is None:
+            return self.run(query, params)
+        self.finish()
+        start = time.time()
+        # Function, query, parameters, seconds and rows fetched.
+        self.call = [self.caller(), query, params, 0.0, 0]
+        try:
+            return self.run(query, params)
+        finally:
+            self.call[3] += time.time() - start
+
+    def run(self, query, params):
+        query = self.engine.translate(query)
+        if params is None:
+            return self.cursor.execute(query)
+        return self.cursor.execute(query, params)
+
+    def fetch(self, method, *args):
+        if self.call is None:
+            return method(*args)
+        start = time.time()
+        try:
+            result = method(*args)
+        finally:
+            self.call[3] += time.time() - start
+        if isinstance(result, list):
+            self.call[4] += len(result)
+        elif result is not None:
+            self.call[4] += 1
+        return result
+
+    def fetchone(self):
+        return self.fetch(self.cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self.fetch(self.cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self.fetch(self.cursor.fetchall)
+
+    def finish(self):
+        """Record the query in progress, if there is one.  Rows changed are
+        counted for queries that returned none."""
+        if self.call is None:
+            return
+        function, query, params, seconds, rows = self.call
+        self.call = None
+        if not rows and self.cursor.rowcount > 0:
+            rows = self.cursor.rowcount
+        self.queries.record(function, seconds, rows, query, params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class Pool(object):
+    """A small pool of database connections.  No connection is opened
+    until one is first asked for.  Up to size idle connections are kept for
+    reuse and any more are closed when they're released."""
+    def __init__(self, engine, size, retries=3, retry_delay=2):
+        self.engine = engine
+        self.size = size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        attempt = 1
+        while True:
+            try:
+                return self.engine.connect()
+            except self.engine.disconnect_errors(), e:
+                if attempt >= self.retries:
+                    logger.error("Failed to connect to the %s database: %s",
+                                 self.engine.name, e)
+                    raise
+                logger.warn("Failed to connect to the %s database, "
+                            "retrying: %s", self.engine.name, e)
+                attempt += 1
+                time.sleep(self.retry_delay)
+
+    def acquire(self):
+        """Return an idle connection, or a new one if none are left."""
+        self.lock.acquire()
+        try:
+            while self.idle:
+                conn = self.idle.pop()
+                if self.engine.usable(conn):
+                    return conn
+                self.discard(conn)
+        finally:
+            self.lock.release()
+        return self.connect()
+
+    def release(self, conn):
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        self.discard(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Close all the idle connections."""
+        self.lock.acquire()
+        try:
+            idle, self.idle = self.idle, []
+        finally:
+            self.lock.release()
+        for conn in idle:
+            self.discard(conn)
+
+engines = {'postgres': PostgresEngine,
+           'sqlite': SQLiteEngine}
+
+def get_engine():
+    """Return an instance of the engine named by config.dbengine.  Postgres
+    is the default."""
+    if hasattr(config, 'dbengine'):
+        return engines[config.dbengine]()
+    return PostgresEngine()
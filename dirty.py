@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# dirty.py -- Track which per-remailer reports need rewriting
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Each per-remailer report is written from a small part of the snapshot.  A
+# fingerprint of that part is kept in config.statefile from one cycle to
+# the next, and a report is only rewritten when its fingerprint changes or
+# its file is missing.  New or changed pings, chains and keys all change
+# the fingerprint, as do pings ageing out of the active window, which no
+# new stats would reveal.  Reports are also rewritten once they're older
+# than config.report_refresh_hours, so their timestamps don't go stale.
+
+import hashlib
+import json
+import os
+
+import config
+import output
+
+class Tracker(object):
+    def __init__(self, statefile=None, full=False):
+        """Load the fingerprints saved by the last cycle from statefile.
+        Without a statefile, or when full is True, every report is taken
+        to have changed."""
+        self.statefile = statefile
+        self.full = full or statefile is None
+        self.previous = {}
+        self.fingerprints = {}
+        if not self.full and os.path.exists(statefile):
+            state = open(statefile)
+            try:
+                self.previous = json.load(state)
+            except ValueError:
+                self.full = True
+            state.close()
+
+    def changed(self, kind, remailer, data, *filenames):
+        """Record the fingerprint of the data a remailer's report of the
+        given kind is written from.  Returns True if the report, written to
+        filenames, needs writing."""
+        key = '%s %s' % remailer
+        fingerprint = hashlib.md5(repr(data)).hexdigest()
+        self.fingerprints.setdefault(kind, {})[key] = fingerprint
+        if self.full:
+            return True
+        for filename in filenames:
+            if output.stale(filename):
+                return True
+        return self.previous.get(kind, {}).get(key) != fingerprint
+
+    def save(self):
+        """Write the fingerprints recorded this cycle to the statefile,
+        once all the reports they describe have been written."""
+        if self.statefile is None:
+            return
+        tmpname = self.statefile + '.tmp'
+        state = open(tmpname, 'w')
+        json.dump(self.fingerprints, state, sort_keys=True)
+        state.close()
+        os.rename(tmpname, self.statefile)
+
+current = None
+
+def load(full=False):
+    """Make a tracker, using config.statefile if it's set, the current one."""
+    global current
+    statefile = None
+    if hasattr(config, 'statefile'):
+        statefile = config.statefile
+    current = Tracker(statefile, full)
+    return current
+
+def get():
+    """Return the current tracker.  If there isn't one, every report is
+    written."""
+    if current is None:
+        return Tracker(full=True)
+    return current
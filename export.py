@@ -0,0 +1,138 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# export.py -- Export the remailer vitals as JSON and CSV
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Once a cycle, the vitals of every remailer are exported from the snapshot
+# to config.export_json and config.export_csv, within reportdir, so other
+# tools don't have to scrape the reports.  Each remailer has the fields
+# below, followed by its uptime with each pinger, or nothing where the
+# pinger has no stats for it within the window.  As in the vitals, uptimes
+# are in tenths of a percent and latencies in minutes.
+#
+# The JSON is a single object holding the time it was generated, the
+# active window, the pinger names and a list of remailers, each an object
+# with the fields below and an "uptimes" list in the same order as the
+# pingers.  The CSV has a header row naming the fields, followed by a
+# column for each pinger, and one row per remailer.
+#
+# With config.export_gzip set, both files are gzipped and .gz is added to
+# their names.
+
+import csv
+import cStringIO
+import gzip
+import json
+import os
+
+import config
+import output
+import timefunc
+from keys import key_counts
+from keys import remailer_keys
+
+fields = ['rem_name', 'rem_addy',
+          # Pingers reporting on the remailer, and how many of those pings
+          # are in-scope, out-of-scope and dead.
+          'rem_count_all', 'rem_active_count', 'rem_ignored_count',
+          'rem_dead_count',
+          # Over the in-scope pings.
+          'rem_uptime_min', 'rem_uptime_avg', 'rem_uptime_max',
+          'rem_uptime_stddev', 'rem_latency_min', 'rem_latency_avg',
+          'rem_latency_max', 'rem_latency_stddev',
+          # Over all the pings, and the ranges that define the scope.
+          'rem_uptime_avg_all', 'rem_uptime_stddev_all',
+          'rem_latency_avg_all', 'rem_latency_stddev_all',
+          'rem_uptime_stddev_range', 'rem_latency_stddev_range',
+          # Broken chains from and to the remailer.
+          'chain_from', 'chain_to',
+          # Pingers reporting on the remailer, those with a key for it and
+          # the number of different keys between them.
+          'key_pingers', 'key_count', 'key_distinct']
+
+def remailer_export(snap, vitals):
+    """Return the values of fields for a remailer."""
+    values = dict(vitals)
+    values['rem_ignored_count'] = len(vitals['ignored_pings'])
+    values['rem_dead_count'] = len(vitals['dead_pings'])
+    values['key_pingers'], values['key_count'], values['key_distinct'] = \
+        key_counts(remailer_keys(snap, vitals['rem_name'], vitals['rem_addy']))
+    row = []
+    for field in fields:
+        value = values[field]
+        if isinstance(value, float):
+            value = round(value, 2)
+        row.append(value)
+    return row
+
+def write(filename, content):
+    """Write content to filename within reportdir, gzipped if configured,
+    under another name and renamed into place."""
+    filename = os.path.join(config.reportdir, filename)
+    compress = hasattr(config, 'export_gzip') and config.export_gzip
+    if compress:
+        filename += '.gz'
+    tmpname = filename + '.tmp'
+    exportfile = open(tmpname, 'wb')
+    try:
+        if compress:
+            gzfile = gzip.GzipFile(os.path.basename(filename[:-3]), 'wb',
+                                   fileobj=exportfile)
+            gzfile.write(content)
+            gzfile.close()
+        else:
+            exportfile.write(content)
+    finally:
+        exportfile.close()
+    os.rename(tmpname, filename)
+    output.record(filename)
+
+def export_json(snap, rows, matrix):
+    remailers = []
+    for row, uptimes in zip(rows, matrix):
+        entry = dict(zip(fields, row))
+        entry['uptimes'] = uptimes
+        remailers.append(entry)
+    content = json.dumps({'generated': str(timefunc.utcnow()),
+                          'max_age': str(snap.max_age),
+                          'max_future': str(snap.max_future),
+                          'pingers': snap.pingers,
+                          'remailers': remailers},
+                         separators=(',', ':'), sort_keys=True)
+    write(config.export_json, content)
+
+def export_csv(snap, rows, matrix):
+    content = cStringIO.StringIO()
+    writer = csv.writer(content)
+    writer.writerow(fields + snap.pingers)
+    for row, uptimes in zip(rows, matrix):
+        writer.writerow(row + uptimes)
+    write(config.export_csv, content.getvalue())
+
+def export(snap, all_vitals):
+    """Write the exports that are configured, from the snapshot and the
+    vitals calculated from it."""
+    want_json = hasattr(config, 'export_json')
+    want_csv = hasattr(config, 'export_csv')
+    if not want_json and not want_csv:
+        return
+    rows = [remailer_export(snap, all_vitals[remailer])
+            for remailer in snap.remailers]
+    matrix = [uptimes for uptimes, summary in snap.uptime_matrix()[0]]
+    if want_json:
+        export_json(snap, rows, matrix)
+    if want_csv:
+        export_csv(snap, rows, matrix)
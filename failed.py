@@ -19,8 +19,11 @@
 import config
 import logging
 import db
+import output
+import pages
+import snapshot
 
-from stats import gen_remailer_vitals
+from stats import gen_all_vitals
 
 from timefunc import utcnow
 from timefunc import hours_ago
@@ -28,44 +31,18 @@ from timefunc import hours_ahead
 
 def failed(report_name):
     filename = "%s/%s" % (config.reportdir, config.failed_report_name)
-    htmlfile = open(filename, 'w')
+    htmlfile = output.ReportFile(filename)
+    failing = []
 
-# Write standard html header section
-    htmlfile.write("""<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" "http://www.w3.org/TR/html4/loose.dtd">
-<html>
-<head>
-<meta http-equiv="Content-Type" content="text/html; charset=ISO-8859-1">
-<meta http-equiv="Content-Style-Type" content="text/css2" />
-<meta name="keywords" content="Mixmaster,Remailer,Banana,Bananasplit">
-<title>Bananasplit Website - Failing Remailers</title>
-<link rel="StyleSheet" href="stats.css" type="text/css">
-</head>
-
-<body>
-<h1>Failing Remailers</h1>
-Remailer stats are normally biased away from the current day.  This is because
-different latencies would skew results due to outstanding pings.  However the
-current day does provide a rapid insight into remailers that are currently
-experiencing problems.<br>
-<p>The following table lists remailers that are <u>currently</u> averaging less
-than %d%% return on pings. Please consider that this could be due to very high
-latency rather than actual remailer failure.</p>
-<p><i>Note: Bunker is not actually failing.  It's a Middleman remailer with no
-current stats which means it cannot random hop pings back to the pinger.</i></P>
-<table border="0" bgcolor="#000000">
-<tr bgcolor="#F08080">
-<th>Remailer Name</th><th>Ping Responses</th>
-</tr>""" % (config.failpoint * 10))
-
-    rotate_color = 0
-
-    for name, addy in db.distinct_rem_names():
-        remailer_vitals = gen_remailer_vitals(name, addy)
+    snap = snapshot.get()
+    all_vitals = gen_all_vitals(snap)
+    for name, addy in snap.remailers:
+        remailer_vitals = all_vitals[(name, addy)]
         logger.debug("Checking remailer %s %s", name, addy)
         addy_noat = addy.replace('@',".")
         full_name = "%s.%s" % (name, addy_noat)
 
-        active_pings = db.remailer_active_pings(remailer_vitals)
+        active_pings = remailer_vitals["active_pings"]
         if len(active_pings) == 0:
             logger.info("We have no active pings for %s %s", name, addy)
             continue
@@ -74,42 +51,23 @@ current stats which means it cannot random hop pings back to the pinger.</i></P>
 
         if remailer_vitals['uptime'] < config.failpoint:
             logger.info("Remailer %s %s is failed.", name, addy)
-            # Rotate background colours for rows
-            if rotate_color:
-                bgcolor = "#ADD8E6"
-            else:
-                bgcolor = "#E0FFFF"
-            rotate_color = not rotate_color
-            
-            htmlfile.write('<tr bgcolor="%s"><th class="tableleft"><a href="%s.txt" title="%s">%s</a></th>' % (bgcolor, full_name, addy, name))
-            htmlfile.write('<td>%d%%</td></tr>\n' % (remailer_vitals['uptime'] * 10))
+            failing.append((full_name, addy, name,
+                            remailer_vitals['uptime'] * 10))
 
 #        if remailer_vitals('uptime'] > config.goodpoint:
 #            # Stats are greater than 50%, so delete any entries for this
 #            # remailer from the failed table.
 #            logger.debug("%s is healthy, deleting any DB entries it might have", name)
 
-    htmlfile.write('</table>\n')
-
-    htmlfile.write('<br>Last update: %s (UTC)<br>\n' % utcnow())
-    htmlfile.write('<br><a href="index.html">Return to Index</a>')
-
-    htmlfile.write('</body></html>')
+    htmlfile.write(pages.failed_page(failing, utcnow()))
+    htmlfile.close()
 
-# For a given remailer name, return the average uptime for today from up_hist.
-# In up_hist, a '+' indicates a score of 10.
+# For a given remailer name, return the average uptime for today.  Today's
+# score from up_hist is decoded when the stats are stored, as up_today.
 def up_today(entries):
     total = 0
     for line in entries:
-        uptime = line[5]
-        uptime_now = uptime[-1]
-        if uptime_now == '+':
-            score = 10
-        elif uptime_now == '?':
-            score = 0
-        else:
-            score = int(uptime_now)
-        total += score
+        total += line[15]
     return int(total / len(entries))
 
 def init_logging():
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# harvest.py -- Concurrent retrieval of pinger urls
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import logging
+import Queue
+import threading
+import time
+import urlparse
+
+import config
+import urlcache
+
+logger = logging.getLogger('stats')
+
+def url_host(url):
+    """Return the hostname part of a url, lowercased so that per-host limits
+    apply regardless of how the url was written in the pingers table."""
+    return urlparse.urlparse(url)[1].lower()
+
+def fetch_worker(jobs, results, host_limits, fetch):
+    """Take (ping_name, url) jobs from the queue until it's empty.  Each url
+    is retrieved using the supplied fetch function whilst holding the
+    semaphore for its host."""
+    while True:
+        try:
+            ping_name, url = jobs.get_nowait()
+        except Queue.Empty:
+            return
+        limit = host_limits[url_host(url)]
+        limit.acquire()
+        try:
+            start = time.time()
+            try:
+                content = fetch(url)
+            except:
+                logger.exception("Unexpected error retrieving %s", url)
+                content = 0
+            elapsed = time.time() - start
+        finally:
+            limit.release()
+        results.put((ping_name, url, content, elapsed))
+
+def harvest(jobs, fetch, process):
+    """Retrieve a list of (ping_name, url) jobs concurrently.  Fetching is
+    done by a pool of worker threads, but process is only ever called from
+    the calling thread, so database writes remain serialised.  Returns a
+    list of (ping_name, url, seconds, status) tuples where status is one
+    of 'ok', 'unchanged' or 'failed'."""
+    jobs = [job for job in jobs if job[1]]
+    if not jobs:
+        return []
+    queue = Queue.Queue()
+    results = Queue.Queue()
+    # Without settings for them, urls are fetched one at a time as they
+    # were before the workers.
+    workers = 1
+    per_host = 1
+    if hasattr(config, 'fetch_workers'):
+        workers = config.fetch_workers
+    if hasattr(config, 'fetch_per_host'):
+        per_host = config.fetch_per_host
+    host_limits = {}
+    for job in jobs:
+        queue.put(job)
+        host = url_host(job[1])
+        if not host_limits.has_key(host):
+            host_limits[host] = threading.BoundedSemaphore(per_host)
+
+    threads = []
+    for i in range(min(workers, len(jobs))):
+        worker = threading.Thread(target=fetch_worker,
+                                  args=(queue, results, host_limits, fetch))
+        worker.setDaemon(True)
+        worker.start()
+        threads.append(worker)
+
+    # Process the results in whatever order they arrive.  Whilst one pinger
+    # is being processed, the workers carry on fetching the others.
+    timings = []
+    for i in range(len(jobs)):
+        ping_name, url, content, elapsed = results.get()
+        if content is urlcache.UNCHANGED:
+            logger.debug("Skipping %s, its content is unchanged", ping_name)
+            urlcache.commit(url)
+            status = 'unchanged'
+        elif content:
+            # The url is only cached once its content has been stored.
+            try:
+                process(ping_name, content)
+            except:
+                urlcache.discard(url)
+                raise
+            urlcache.commit(url)
+            status = 'ok'
+        else:
+            urlcache.discard(url)
+            status = 'failed'
+        timings.append((ping_name, url, elapsed, status))
+
+    for worker in threads:
+        worker.join()
+    log_timings(timings)
+    return timings
+
+def log_timings(timings):
+    """Write a summary of how long each pinger took to retrieve, slowest
+    first."""
+    total = 0.0
+    counts = {'ok': 0, 'unchanged': 0, 'failed': 0}
+    timings = sorted(timings, key=lambda timing: timing[2], reverse=True)
+    for ping_name, url, elapsed, status in timings:
+        total += elapsed
+        counts[status] += 1
+        if status == 'failed':
+            logger.info("Fetch of %s failed after %.2f seconds",
+                        ping_name, elapsed)
+        else:
+            logger.info("Fetch of %s took %.2f seconds (%s)",
+                        ping_name, elapsed, status)
+    logger.info("Fetched %d urls (%d unchanged, %d failed), "
+                "%.2f seconds of fetch time", len(timings),
+                counts['unchanged'], counts['failed'], total)
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# housekeeping.py -- Age out old stats and tidy the metastats database
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Usage: housekeeping.py
+#
+# Run from cron, housekeeping is carried out every time.  stats.py also
+# calls scheduled() on each cycle, which only runs it if it hasn't been run
+# within config.housekeeping_hours, six by default.  The rows changed by
+# each step and the time it took are recorded in the housekeeping_log
+# table.
+
+import datetime
+import logging
+import time
+
+import config
+import db
+import timefunc
+
+logger = logging.getLogger('stats')
+
+# The settings used when config doesn't give them, the same as in
+# config_sample.py.  scheduled() is called on every stats.py cycle, so a
+# config written before housekeeping existed has to keep working.
+defaults = {'housekeeping_hours': 6,
+            'housekeeping_batch': 5000,
+            'history_months': 13,
+            'analyze_churn': 0.1,
+            'vacuum_churn': 0.3}
+
+def setting(name):
+    if hasattr(config, name):
+        return getattr(config, name)
+    return defaults[name]
+
+def timed(metrics, step, func, *args):
+    """Call func, recording the number of rows it returns and how long it
+    took against the step's name."""
+    start = time.time()
+    rows = func(*args)
+    metrics.append((step, rows, time.time() - start))
+    return rows
+
+def delete_stale_pings(age):
+    """Delete the entries in mlist2 older than age, a batch at a time.
+    Returns the total number deleted."""
+    batch = setting('housekeeping_batch')
+    deleted = 0
+    while True:
+        rows = db.delete_stale_pings(age, batch)
+        deleted += rows
+        if rows < batch:
+            return deleted
+
+def drop_history():
+    dropped = db.drop_history(setting('history_months'))
+    for table in dropped:
+        logger.info("Dropped history table %s", table)
+    return len(dropped)
+
+def housekeeping():
+    # Runs are identified by when they started.  Microseconds are kept so
+    # that two runs within the same second, from cron and stats.py say,
+    # don't collide in housekeeping_log.
+    run = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
+    metrics = []
+    age = timefunc.hours_ago(config.dead_after_hours)
+    pings = db.count_pings()
+
+    # First delete entries from mlist2 older than dead_after_hours, then
+    # any pingers left without entries.  Remailers that have been failing
+    # for as long are marked dead in genealogy, and dead ones no longer
+    # have a last_fail timestamp.
+    deleted = timed(metrics, 'stale_pings', delete_stale_pings, age)
+    timed(metrics, 'idle_pingers', db.delete_idle_pingers)
+    timed(metrics, 'gene_dead', db.gene_mark_dead, age)
+    timed(metrics, 'gene_failed', db.gene_clear_failed)
+    timed(metrics, 'history', drop_history)
+
+    # mlist2 is only vacuumed and its statistics refreshed once enough of
+    # it has changed to make it worthwhile.
+    churn = float(deleted) / max(pings, 1)
+    statements = []
+    if churn >= setting('vacuum_churn'):
+        statements.extend(db.engine.vacuum(['mlist2']))
+    if churn >= setting('analyze_churn'):
+        statements.append('ANALYZE mlist2')
+    if statements:
+        timed(metrics, 'maintenance', db.maintain, statements)
+
+    for step, rows, seconds in metrics:
+        logger.debug("Housekeeping step %s changed %d rows in %.3f seconds",
+                     step, rows, seconds)
+    db.log_housekeeping(run, metrics)
+    logger.info("Housekeeping deleted %d of %d stats entries (%.1f%%)",
+                deleted, pings, churn * 100)
+
+def scheduled():
+    """Run housekeeping if it hasn't been run within the configured number
+    of hours."""
+    last = db.last_housekeeping()
+    if last is not None and \
+       str(last) > timefunc.hours_ago(setting('housekeeping_hours')):
+        logger.debug("Housekeeping last ran at %s, skipping", last)
+        return
+    housekeeping()
+
+# Call main function.
+if (__name__ == "__main__"):
+    import stats
+    stats.init_logging()
+    housekeeping()
@@ -16,103 +16,109 @@
 # or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
 # for more details.
 
-import urllib2
 import re
 import sys
 import socket
 
 import config
+import dirty
+import output
+import pages
+import snapshot
 import timefunc
+import urlcache
+from harvest import harvest
+from reportpool import report_map
 from db import keyrings
-from db import insert_key
-from db import count_active_keys
-from db import count_unique_keys
-from db import remailer_keys
-
-# Fetch stats url from a pinger
-def url_fetch(url):
-    pubring = urllib2.Request(url)
-    failed = 0
+from db import update_keys
+
+name_re = re.compile('[0-9a-z]{1,8}')
+addy_re = re.compile('\S+@\S+')
+key_re = re.compile('[0-9a-z]{32}')
+ver_re = re.compile('[0-9]\S+')
+date_re = re.compile('[0-9]{4}\-[0-9]{2}\-[0-9]{2}')
+
+# Fetch and scan a pubring url from a pinger.  This runs in a harvest worker
+# thread and returns a list of the key headers found.  As with stats urls,
+# urlcache.UNCHANGED is returned if the pubring hasn't changed since the last
+# fetch.
+def url_parse(url):
+    content = urlcache.fetch(url)
+    if not content:
+        return content
     try:
-        opener = urllib2.urlopen(pubring)
-    except:
-        failed = 1
-    if failed:
+        headers = list(pubring_scan(content))
+    except (IOError, socket.error):
         return 0
-    else:
-        try:
-            content = opener.readlines()
-            return content
-        except:
-            return 0
-
-def pubring_process(ping_name, content):
+    if urlcache.unchanged(content):
+        return urlcache.UNCHANGED
+    return headers
+
+def pubring_scan(content):
+    """Generator that yields a (name, addy, key, ver, valid, expire) tuple
+    for each key header in a pubring.mix.  The base64 body of each key is
+    skipped over without being examined."""
+    in_key = False
     for line in content:
-
-        # Elements is a list of the elements in the content we're reading
-        # seperated by spaces.  Note, this is every line in a pubring.mix,
-        # not just the headers!
-        elements = line.split(' ')
-        num_elements = len(elements)
-
-        if num_elements < 2:
+        if in_key:
+            if line.startswith('-----End Mix Key-----'):
+                in_key = False
             continue
-
-        name = None
-        addy = None
-        key = None
-        ver = None
-        valid = None
-        expire = None
-
-        # First element is the remailer name
-        name_element = elements[0]
-        is_name = name_re.match(name_element)
-        if is_name: name = name_element
-
-        # Second element is the remailer address
-        addy_element = elements[1]
-        is_addy = addy_re.match(addy_element)
-        if is_addy: addy = addy_element
-
-        # If we don't have a name and an address there's no point in
-        # trying to process the line.
-        if not name or not addy:
+        if line.startswith('-----Begin Mix Key-----'):
+            in_key = True
             continue
-
-        if num_elements >= 3:
-            # Third element is the remailer key
-            key_element = elements[2]
-            is_key = key_re.match(key_element)
-            if is_key: key = key_element
-            else: key = None
-
-        if num_elements >= 4:
-            # Forth element is the mixmaster version
-            ver_element = elements[3]
-            is_ver = ver_re.match(ver_element)
-            if is_ver: ver = ver_element
-            else: ver = None
-
-        # Fifth element is the remailer capstring.  At the moment we
-        # don't use this during key checking.  Perhaps one day.
-
-        if num_elements >= 6:
-            # Sixth element is the key's valid-from date
-            valid_element = elements[5]
-            is_valid = date_re.match(valid_element)
-            if is_valid: valid = valid_element
-            else: valid = None
-
-        if num_elements >= 7:
-            # Seventh element is the key's expiry date
-            expire_element = elements[6]
-            is_expire = date_re.match(expire_element)
-            if is_expire: expire = expire_element
-            else: expire = None
-        # With the key header fully analysed, we now insert it into
-        # the keys database.
-        insert_key(ping_name, name, addy, key, ver, valid, expire)
+        header = pubring_header(line)
+        if header:
+            yield header
+
+def pubring_header(line):
+    """Analyse a single pubring.mix header line.  Returns None unless the
+    line has at least a valid name and address."""
+    # Elements is a list of the elements in the header seperated by spaces.
+    elements = line.rstrip().split(' ')
+    num_elements = len(elements)
+
+    if num_elements < 2:
+        return None
+
+    key = None
+    ver = None
+    valid = None
+    expire = None
+
+    # First element is the remailer name, the second is the remailer
+    # address.  If we don't have a name and an address there's no point in
+    # trying to process the line.
+    name = elements[0]
+    addy = elements[1]
+    if not name_re.match(name) or not addy_re.match(addy):
+        return None
+
+    # Third element is the remailer key
+    if num_elements >= 3 and key_re.match(elements[2]):
+        key = elements[2]
+
+    # Forth element is the mixmaster version
+    if num_elements >= 4 and ver_re.match(elements[3]):
+        ver = elements[3]
+
+    # Fifth element is the remailer capstring.  At the moment we
+    # don't use this during key checking.  Perhaps one day.
+
+    # Sixth element is the key's valid-from date
+    if num_elements >= 6 and date_re.match(elements[5]):
+        valid = elements[5]
+
+    # Seventh element is the key's expiry date
+    if num_elements >= 7 and date_re.match(elements[6]):
+        expire = elements[6]
+
+    return name, addy, key, ver, valid, expire
+
+# With the pubring fully analysed, write all the keys reported by the pinger
+# to the database in one go.
+def pubring_process(ping_name, headers):
+    update_keys(ping_name, headers)
 
 def filenames(name, addy):
     noat = addy.replace('@',".")
@@ -120,124 +126,67 @@ def filenames(name, addy):
     url = 'key.%s.%s.html' % (name, noat)
     return url, file
 
-def write_remailer_stats(filename, name, addy):
-    stat = open(filename, 'w')
-    stat.write('''<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" "http://www.w3.org/TR/html4/loose.dtd">
-<html>
-<head>
-<meta http-equiv="Content-Type" content="text/html; charset=ISO-8859-1">
-<meta http-equiv="Content-Style-Type" content="text/css2" />
-<meta name="keywords" content="Mixmaster,Echolot,Remailer,Banana,Bananasplit">
-<title>Bananasplit Website - Meta Statistics</title>
-<link rel="StyleSheet" href="stats.css" type="text/css">
-</head>
-<body>''')
-    stat.write('<h1>Keystats Report for the %s remailer</h1>\n' % (name,))
-    stat.write('<h2>%s</h2>' % (addy,))
-    stat.write('<table border="0" bgcolor="#000000">')
-    stat.write('<tr bgcolor="#F08080"><th>Pinger</th>')
-    stat.write('<th>Remailer Key</th><th>Version</th>')
-    stat.write('<th>Valid</th><th>Expire</th></tr>\n''')
-    colorflag = False
-    for ping_name, key, version, valid, expire in \
-        remailer_keys(name, addy):
-
-        if colorflag: bgcolor = "#ADD8E6"
-        else: bgcolor = "#E0FFFF"
-        colorflag = not colorflag
-
-        stat.write('<tr bgcolor=%s>' % (bgcolor,))
-        stat.write('<th class="tableleft">%s</th>\n' % (ping_name,))
-        stat.write('<td>%s</td><td>%s</td>\n' % (key, version))
-        stat.write('<td>%s</td><td>%s</td></tr>\n' % (valid, expire))
-    stat.write('</table>\n')
-    stat.write('<br>Last Updated: %s (UTC)\n' % now)
-    stat.write('</body></html>')
+def remailer_keys(snap, name, addy):
+    """Return all the ping_names and keys reported for a single remailer."""
+    keys = []
+    for position in snap.pings((name, addy)):
+        keys.append((snap.ping_name(position), snap.key[position],
+                     snap.version[position], snap.valid[position],
+                     snap.expire[position]))
+    keys.sort(key=lambda key: key[0])
+    return keys
+
+def key_counts(keys):
+    """Return (count, count_keys, distinct_keys) for the keys reported for
+    a remailer.  count is how many pingers report on the remailer,
+    count_keys how many of them have a key for it and distinct_keys how
+    many different keys they have between them."""
+    reported = [key[1] for key in keys if key[1] is not None]
+    return len(keys), len(reported), len(set(reported))
+
+def write_remailer_stats(filename, name, addy, keys):
+    stat = output.ReportFile(filename)
+    stat.write(pages.key_page(name, addy, keys, now))
     stat.close()
 
+# Write the key report for a remailer.  This runs in a report worker.
+def remailer_key_stats(remailer):
+    rem_name, rem_addy = remailer
+    url, filename = filenames(rem_name, rem_addy)
+    write_remailer_stats(filename, rem_name, rem_addy,
+                         remailer_keys(snapshot.current, rem_name, rem_addy))
+
 def write_stats():
     indexname = "%s/%s" % (config.reportdir, config.keyindex)
-    index = open(indexname, 'w')
-    index.write('''<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" "http://www.w3.org/TR/html4/loose.dtd">
-<html>
-<head>
-<meta http-equiv="Content-Type" content="text/html; charset=ISO-8859-1">
-<meta http-equiv="Content-Style-Type" content="text/css2" />
-<meta name="keywords" content="Mixmaster,Echolot,Remailer,Banana,Bananasplit">
-<title>Bananasplit Website - Meta Statistics</title>
-<link rel="StyleSheet" href="stats.css" type="text/css">
-</head>
-<body>
-<h1>Remailer Keystats Report</h1>
-<p>This report provides stats on remailer keys held by each pinger.
-In normal circumstances every pinger should provide a key, but exceptions
-may occur if a pinger doesn't return a pubring.mix, or we haven't defined
-what the url for the file is on a given pinger.  Unique Keys should be 1,
-but during key expiration, some pingers will update before others, so 2 can
-occur.  During these transitional periods, both keys should be valid. More
-than two keys being reported for a single remailer is very bad.</p>
-<table border="0" bgcolor="#000000">
-<tr bgcolor="#F08080"><th>Remailer</th><th>Address</th><th>Pingers Reporting</th>
-<th>Pingers with Keys</th><th>Unique Keys</th></tr>\n''')
-    colorflag = False
-    for rem_name, rem_addy, count in count_active_keys():
+    index = output.ReportFile(indexname)
+    snap = snapshot.get()
+    tracker = dirty.get()
+    # The index rows are rendered here, whilst the key reports of remailers
+    # whose keys have changed are written by the report workers.
+    remailers = []
+    changed = []
+    for rem_name, rem_addy in snap.remailers:
+        keys = remailer_keys(snap, rem_name, rem_addy)
+        count, count_keys, distinct_keys = key_counts(keys)
+        if not count:
+            continue
         url, filename = filenames(rem_name, rem_addy)
-        # We need the Try/Except here as a return of None cannot be unpacked.
-        # None occurs when no pingers have a valid return.  Eg. Dead remailer.
-        try:
-            count_keys,distinct_keys = count_unique_keys(rem_name, rem_addy)
-        except TypeError:
-            count_keys = 0
-            distinct_keys = 0
-        write_remailer_stats(filename, rem_name, rem_addy)
-
-        if colorflag: bgcolor = "#ADD8E6"
-        else: bgcolor = "#E0FFFF"
-        colorflag = not colorflag
-
-        index.write('<tr bgcolor="%s"><th class="tableleft">' % (bgcolor,))
-        if distinct_keys > 0:
-            index.write('<a href="%s">%s</a>' % (url, rem_name))
-        else:
-            index.write('%s' % (rem_name,))
-        index.write('</th><td>%s</td>' % (rem_addy,))
-        index.write('<td>%s</td>' % (count, ))
-        if count == count_keys:
-            index.write('<td>%s</td>' % (count_keys,))
-        else:
-            index.write('<td bgcolor="#FF0000">%s</td>' % (count_keys, ))
-        if distinct_keys > 1:
-            index.write('<td bgcolor="#FF0000">%s</td>' % (distinct_keys,))
-        else:
-            index.write('<td>%s</td>' % (distinct_keys,))
-        index.write('</tr>\n')
-
-    index.write('</table><br>\n')
-    index.write('Last Updated: %s (UTC)\n' % now)
-    index.write('</body>\n</html>\n')
+        if tracker.changed('keys', (rem_name, rem_addy), keys, filename):
+            changed.append((rem_name, rem_addy))
+        remailers.append((rem_name, rem_addy, url, count, count_keys,
+                          distinct_keys))
+
+    index.write(pages.keys_page(remailers, now))
     index.close()
+    report_map(remailer_key_stats, changed)
 
 def getkeystats():
-    global name_re, addy_re, key_re, ver_re, date_re
-    name_re = re.compile('[0-9a-z]{1,8}')
-    addy_re = re.compile('\S+@\S+')
-    key_re = re.compile('[0-9a-z]{32}')
-    ver_re = re.compile('[0-9]\S+')
-    date_re = re.compile('[0-9]{4}\-[0-9]{2}\-[0-9]{2}')
-
     socket.setdefaulttimeout(config.timeout)
-    for url in keyrings():
-        ping_name = url[0]
-        pubring = url[1]
-        content = url_fetch(pubring)
-        if content:
-            pubring_process(ping_name, content)
+    harvest(keyrings(), url_parse, pubring_process)
 
 def writekeystats():
-    global now, ago, ahead
+    global now
     now = timefunc.utcnow()
-    ago = timefunc.hours_ago(config.active_age)
-    ahead = timefunc.hours_ahead(config.active_future)
     write_stats()
 
 
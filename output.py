@@ -0,0 +1,109 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# output.py -- Write report files atomically, and only when they change
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# The reports are built in memory by a ReportFile, which is used in place
+# of a file opened for writing.  When it's closed, the report is compared
+# with the file already on disk.  If they differ, the new report is written
+# to a temporary file alongside and renamed over the old one, so the web
+# server never sees a partly written page.  Reports that differ only in
+# their "Last update" timestamp are considered unchanged and left alone,
+# unless the file on disk is more than config.report_refresh_hours old (a
+# day by default).  So a page's timestamp is never more than that out of
+# date, even when nothing on it has changed.
+#
+# The name of each file that's written is appended to config.manifest, if
+# it's set, for whatever copies the reports to the web servers to read and
+# then truncate.
+
+import hashlib
+import os
+import re
+import time
+
+import config
+
+# The update timestamp found at the foot of every report.
+timestamp_re = re.compile('Last [Uu]pdated?: [^(\n]*\(UTC\)')
+
+def fingerprint(content):
+    """Return a hash of a report, ignoring its update timestamp."""
+    return hashlib.md5(timestamp_re.sub('', content)).hexdigest()
+
+def stale(filename):
+    """True if a report on disk was last written more than
+    config.report_refresh_hours ago, or is missing."""
+    hours = 24
+    if hasattr(config, 'report_refresh_hours'):
+        hours = config.report_refresh_hours
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return True
+    return time.time() - mtime > hours * 3600
+
+def disk_fingerprint(filename):
+    try:
+        existing = open(filename)
+    except IOError:
+        return None
+    try:
+        return fingerprint(existing.read())
+    finally:
+        existing.close()
+
+def record(filename):
+    """Add a file to the manifest of those that have changed.  Each name is
+    appended in a single write, so report workers can share the manifest."""
+    if not hasattr(config, 'manifest'):
+        return
+    name = os.path.relpath(filename, config.reportdir)
+    manifest = open(config.manifest, 'a')
+    try:
+        manifest.write(name + '\n')
+    finally:
+        manifest.close()
+
+class ReportFile(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.parts = []
+        self.closed = False
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def close(self):
+        """Write the report to disk, if it's changed.  Returns True if it
+        was written."""
+        if self.closed:
+            return False
+        self.closed = True
+        content = ''.join(self.parts)
+        self.parts = None
+        if fingerprint(content) == disk_fingerprint(self.filename) and \
+           not stale(self.filename):
+            return False
+        tmpname = self.filename + '.tmp'
+        report = open(tmpname, 'w')
+        try:
+            report.write(content)
+        finally:
+            report.close()
+        os.rename(tmpname, self.filename)
+        record(self.filename)
+        return True
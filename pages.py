@@ -0,0 +1,339 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# pages.py -- Templates for the HTML reports
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Every HTML report is rendered here from data prepared by the module that
+# owns it.  The fixed parts of each page are put together once, when this
+# module is imported, leaving only the rows to format on each cycle.  Each
+# table is rendered as a single join over its rows, and each page returned
+# as one string for an output.ReportFile.
+#
+# The pages must stay byte for byte the same as they've always been, oddities
+# included; the index rows aren't closed and the genealogy rows end with a
+# second <tr>.
+
+import itertools
+
+import config
+
+keywords = 'Mixmaster,Echolot,Remailer,Banana,Bananasplit'
+# The keywords of the pages that aren't derived from Echolot stats.
+plain_keywords = 'Mixmaster,Remailer,Banana,Bananasplit'
+
+head_template = '''<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" "http://www.w3.org/TR/html4/loose.dtd">
+<html>
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=ISO-8859-1">
+<meta http-equiv="Content-Style-Type" content="text/css2" />
+<meta name="keywords" content="%s">
+<title>Bananasplit Website - %s</title>
+<link rel="StyleSheet" href="stats.css" type="text/css">
+</head>
+'''
+
+def head(title, words=keywords):
+    return head_template % (words, title)
+
+# Table rows alternate between these background colours, starting with the
+# first.
+row_colors = ('#E0FFFF', '#ADD8E6')
+
+def striped(rows):
+    """Yield each of rows with its background colour prepended."""
+    for color, row in itertools.izip(itertools.cycle(row_colors), rows):
+        yield (color,) + tuple(row)
+
+def table(template, rows):
+    """Render a table row from template for each of rows, striped."""
+    return ''.join([template % row for row in striped(rows)])
+
+# ----- index.html -----
+
+index_top = head('Meta Statistics') + '''<body>
+<table border="0" bgcolor="#000000">
+<tr bgcolor="#F08080"><th></th><th>Chain From</th><th>Chain To</th>
+'''
+index_pinger = '<th><a href="%s">%s</a></th>\n'
+index_columns = '<th>Average</th><th>StdDev</th><th>Count</th></tr>\n'
+index_row = '''<tr bgcolor="%s"><th class="tableleft">
+<a href="%s" title="%s">%s</a></th>
+<td align="center"><a href="chfr.%s" title="Broken Chains from %s">%s</a></td>
+<td align="center"><a href="chto.%s" title="Broken Chains to %s">%s</a></td>
+%s<td>%3.2f</td><td>%3.2f</td><td>%d</td>'''
+index_uptime = '<td align="center" title="Remailer: %s Pinger: %s">%s</td>\n'
+index_counts = '</tr>\n<tr bgcolor="#F08080"><th class="tableleft">Count</th><td></td><td></td>\n'
+index_count = '<td title="%s">%s</td>\n'
+index_foot = '''<td></td><td></td><td></td></tr>
+</table>
+<br>Last update: %%s (UTC)<br>
+<br><a href="%s">Remailer Genealogy</a><br><a href="%s">Failing Remailers</a><br><a href="%s">Uptime Averages</a><br><a href="%s">Keyring Stats</a></body></html>'''
+
+def index_uptimes(name, ping_names, uptimes):
+    """Render the uptime cells of an index row.  uptimes holds a percentage
+    or None for each of ping_names."""
+    cells = []
+    for ping_name, uptime in itertools.izip(ping_names, uptimes):
+        if uptime is None:
+            uptime = ''
+        else:
+            uptime = '%3.1f' % uptime
+        cells.append(index_uptime % (name, ping_name, uptime))
+    return ''.join(cells)
+
+def index_page(pingers, remailers, counts, now):
+    """Render the index.  pingers is a list of (ping_name, url) for the
+    columns.  remailers is a list of (name, addy, url, chains_from,
+    chains_to, uptimes, avg, stddev, count) for the rows, where uptimes is
+    a list of the remailer's uptime with each pinger, or None.  counts is
+    the number of remailers known to each pinger."""
+    ping_names = [pinger[0] for pinger in pingers]
+    rows = []
+    for name, addy, url, fr_count, to_count, uptimes, avg, stddev, count \
+            in remailers:
+        rows.append((url, addy, name, url, addy, fr_count, url, addy,
+                     to_count, index_uptimes(name, ping_names, uptimes),
+                     avg, stddev, count))
+    foot = index_foot % (config.gene_report_name, config.failed_report_name,
+                         config.uptime_report_name, config.keyindex)
+    return ''.join([index_top,
+                    ''.join([index_pinger % (url, ping_name)
+                             for ping_name, url in pingers]),
+                    index_columns,
+                    table(index_row, rows),
+                    index_counts,
+                    ''.join([index_count % pinger_count for pinger_count
+                             in itertools.izip(ping_names, counts)]),
+                    foot % now])
+
+# ----- Genealogy -----
+
+genealogy_top = head('Remailer Genealogy') + '''
+<body>
+<h1>Remailer Genealogy</h1>
+When pingers report a remailer as below %s0%%, it is timestamped with a failed date.  If it recovers to above %s0%%, the timestamp is removed. Should the remailer fail to recover after %s days, it is considered dead.  If it returns after this it will be considered a new remailer.<br><br>
+<table border="0" bgcolor="#000000">
+<tr bgcolor="#F08080">
+<th>Remailer Name</th><th>Remailer Address</th><th>First Seen Date</th><th>Died On Date</th><th>Failed Date</th><th>Comments</th>
+</tr>
+'''
+genealogy_cells = '<td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><tr>\n'
+genealogy_live = '<tr bgcolor="%s"><th class="tableleft"><a href="%s" title="%s">%s</a></th>\n' + genealogy_cells
+genealogy_dead = '<tr bgcolor="%s"><th class="tableleft">%s</th>\n' + genealogy_cells
+genealogy_foot = '''</table>
+<br>Last update: %%s (UTC)<br>
+<br><a href="index.html">Index</a>
+<br><a href="%s">Failing Remailers</a>
+</body></html>'''
+
+def genealogy_page(remailers, now):
+    """Render the genealogy.  remailers is a list of (name, addy, url,
+    first_seen, last_seen, last_fail, comments), with an empty string for
+    anything unknown.  Remailers with a last_seen date are dead and aren't
+    linked to their stats."""
+    rows = []
+    for color, name, addy, url, first_seen, last_seen, last_fail, comments \
+            in striped(remailers):
+        if last_seen:
+            rows.append(genealogy_dead % (color, name, addy, first_seen,
+                                          last_seen, last_fail, comments))
+        else:
+            rows.append(genealogy_live % (color, url, addy, name, addy,
+                                          first_seen, last_seen, last_fail,
+                                          comments))
+    top = genealogy_top % (config.deadpoint, config.livepoint,
+                           config.dead_after_hours / 24)
+    foot = genealogy_foot % config.failed_report_name
+    return ''.join([top, ''.join(rows), foot % now])
+
+# ----- Uptime averages -----
+
+uptimes_top = head('Failing Remailers', plain_keywords) + '''
+<body>
+<h1>Remailer Uptimes</h1>
+<p>This report provides an overview of the average uptime for each remailer
+based on the results from all currently responding pingers.  Consider that this
+report doesn't define a scope for acceptable ping results; all are considered
+good.  This means a single pinger can skew the average.</p>
+<table border="0" bgcolor="#000000">
+<tr bgcolor="#F08080">
+<th>Remailer Name</th>
+<th>Average Uptime</th>
+<th>Average Latency</th>
+<th>Pingers Reporting</th></tr>
+'''
+uptimes_row = '<tr bgcolor="%s"><th class="tableleft">%s</th><td>%3.2f</td><td>%d:%02d</td><td>%d</td></tr>\n'
+uptimes_foot = '''</table>
+<br>Last update: %s (UTC)<br>
+<br><a href="index.html">Index</a>
+</body></html>'''
+
+def uptimes_page(remailers, now):
+    """Render the uptime averages.  remailers is a list of (name, uptime,
+    latency hours, latency minutes, pingers reporting)."""
+    return ''.join([uptimes_top, table(uptimes_row, remailers),
+                    uptimes_foot % now])
+
+# ----- Failing remailers -----
+
+failed_top = head('Failing Remailers', plain_keywords) + '''
+<body>
+<h1>Failing Remailers</h1>
+Remailer stats are normally biased away from the current day.  This is because
+different latencies would skew results due to outstanding pings.  However the
+current day does provide a rapid insight into remailers that are currently
+experiencing problems.<br>
+<p>The following table lists remailers that are <u>currently</u> averaging less
+than %d%% return on pings. Please consider that this could be due to very high
+latency rather than actual remailer failure.</p>
+<p><i>Note: Bunker is not actually failing.  It's a Middleman remailer with no
+current stats which means it cannot random hop pings back to the pinger.</i></P>
+<table border="0" bgcolor="#000000">
+<tr bgcolor="#F08080">
+<th>Remailer Name</th><th>Ping Responses</th>
+</tr>'''
+failed_row = '<tr bgcolor="%s"><th class="tableleft"><a href="%s.txt" title="%s">%s</a></th><td>%d%%</td></tr>\n'
+failed_foot = '''</table>
+<br>Last update: %s (UTC)<br>
+<br><a href="index.html">Return to Index</a></body></html>'''
+
+def failed_page(remailers, now):
+    """Render the failing remailers.  remailers is a list of (full_name,
+    addy, name, percentage of pings returned)."""
+    return ''.join([failed_top % (config.failpoint * 10),
+                    table(failed_row, remailers), failed_foot % now])
+
+# ----- Keystats -----
+
+keys_top = head('Meta Statistics') + '''<body>
+<h1>Remailer Keystats Report</h1>
+<p>This report provides stats on remailer keys held by each pinger.
+In normal circumstances every pinger should provide a key, but exceptions
+may occur if a pinger doesn't return a pubring.mix, or we haven't defined
+what the url for the file is on a given pinger.  Unique Keys should be 1,
+but during key expiration, some pingers will update before others, so 2 can
+occur.  During these transitional periods, both keys should be valid. More
+than two keys being reported for a single remailer is very bad.</p>
+<table border="0" bgcolor="#000000">
+<tr bgcolor="#F08080"><th>Remailer</th><th>Address</th><th>Pingers Reporting</th>
+<th>Pingers with Keys</th><th>Unique Keys</th></tr>
+'''
+keys_row = '<tr bgcolor="%s"><th class="tableleft">%s</th><td>%s</td><td>%s</td>%s%s</tr>\n'
+keys_link = '<a href="%s">%s</a>'
+keys_cell = '<td>%s</td>'
+# Cells highlighting a problem with a remailer's keys.
+keys_alert = '<td bgcolor="#FF0000">%s</td>'
+keys_foot = '''</table><br>
+Last Updated: %s (UTC)
+</body>
+</html>
+'''
+
+def keys_page(remailers, now):
+    """Render the keystats index.  remailers is a list of (name, addy, url,
+    count, count_keys, distinct_keys), where count is how many pingers
+    report on the remailer, count_keys how many of them have a key for it
+    and distinct_keys how many different keys they have between them."""
+    rows = []
+    for name, addy, url, count, count_keys, distinct_keys in remailers:
+        if distinct_keys > 0:
+            name = keys_link % (url, name)
+        if count == count_keys:
+            count_keys = keys_cell % count_keys
+        else:
+            count_keys = keys_alert % count_keys
+        if distinct_keys > 1:
+            distinct_keys = keys_alert % distinct_keys
+        else:
+            distinct_keys = keys_cell % distinct_keys
+        rows.append((name, addy, count, count_keys, distinct_keys))
+    return ''.join([keys_top, table(keys_row, rows), keys_foot % now])
+
+key_top = head('Meta Statistics') + '''<body><h1>Keystats Report for the %s remailer</h1>
+<h2>%s</h2><table border="0" bgcolor="#000000"><tr bgcolor="#F08080"><th>Pinger</th><th>Remailer Key</th><th>Version</th><th>Valid</th><th>Expire</th></tr>
+'''
+key_row = '''<tr bgcolor=%s><th class="tableleft">%s</th>
+<td>%s</td><td>%s</td>
+<td>%s</td><td>%s</td></tr>
+'''
+key_foot = '''</table>
+<br>Last Updated: %s (UTC)
+</body></html>'''
+
+def key_page(name, addy, keys, now):
+    """Render the key report for a remailer.  keys is a list of (ping_name,
+    key, version, valid, expire)."""
+    return ''.join([key_top % (name, addy), table(key_row, keys),
+                    key_foot % now])
+
+# ----- Trends -----
+
+trends_top = head('Remailer Trends') + '''<body>
+<h1>Remailer Trends</h1>
+<p>The average uptime and latency of each remailer over the last day, week,
+month and year, taken from every set of stats the pingers have published in
+that time rather than only their latest.  Below them are the same averages
+over all the remailers reported on by each pinger.</p>
+<table border="0" bgcolor="#000000">
+<tr bgcolor="#F08080"><th>Remailer</th><th>Address</th>%s</tr>
+'''
+trends_span = '<th>%s Uptime</th><th>%s Latency</th>'
+trends_remailer = '<tr bgcolor="%s"><th class="tableleft">%s</th><td>%s</td>%s</tr>\n'
+trends_pingers = '''</table>
+<br><table border="0" bgcolor="#000000">
+<tr bgcolor="#F08080"><th>Pinger</th>%s</tr>
+'''
+trends_pinger = '<tr bgcolor="%s"><th class="tableleft">%s</th>%s</tr>\n'
+trends_uptime = '<td>%3.2f</td>'
+trends_latency = '<td>%d:%02d</td>'
+trends_empty = '<td></td>'
+trends_foot = '''</table>
+<br>Last update: %s (UTC)<br>
+<br><a href="index.html">Index</a>
+</body></html>'''
+
+def trends_averages(averages):
+    """Render the uptime and latency cells of a row.  averages holds an
+    (uptime, latency hours, latency minutes) for each span, or None where
+    there's nothing to average.  A latency can be None on its own when none
+    of the pings came back."""
+    cells = []
+    for average in averages:
+        if average is None:
+            cells.append(trends_empty * 2)
+            continue
+        uptime, lathrs, latmin = average
+        cells.append(trends_uptime % uptime)
+        if lathrs is None:
+            cells.append(trends_empty)
+        else:
+            cells.append(trends_latency % (lathrs, latmin))
+    return ''.join(cells)
+
+def trends_page(spans, remailers, pingers, now):
+    """Render the trends.  spans names each period averaged over.
+    remailers is a list of (name, addy, averages) and pingers a list of
+    (ping_name, averages), where averages is as for trends_averages."""
+    heading = ''.join([trends_span % (span, span) for span in spans])
+    return ''.join([trends_top % heading,
+                    table(trends_remailer,
+                          [(name, addy, trends_averages(averages))
+                           for name, addy, averages in remailers]),
+                    trends_pingers % heading,
+                    table(trends_pinger,
+                          [(ping_name, trends_averages(averages))
+                           for ping_name, averages in pingers]),
+                    trends_foot % now])
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# profiler.py -- Time and profile the phases of a stats cycle
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import contextlib
+import cProfile
+import os
+import pstats
+import time
+
+def cpu_time():
+    """Return the CPU seconds used by this process so far, in user and
+    system mode.  This includes the time of every thread, not just the one
+    calling it."""
+    times = os.times()
+    return times[0] + times[1]
+
+class Profiler(object):
+    """Records the wall clock and CPU seconds taken by each phase of a cycle.
+    Given a directory, each phase is also run under cProfile and the results
+    written there as <phase>.prof, for pstats, and <phase>.txt, listing the
+    functions that took the most cumulative time."""
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.start = time.time()
+        # (name, wall, cpu) for each phase, in the order they ran.
+        self.phases = []
+        if profile_dir is not None and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        profile = None
+        if self.profile_dir is not None:
+            profile = cProfile.Profile()
+        wall = time.time()
+        cpu = cpu_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.phases.append((name, time.time() - wall, cpu_time() - cpu))
+            if profile is not None:
+                self.dump(name, profile)
+
+    def dump(self, name, profile):
+        path = os.path.join(self.profile_dir, name)
+        profile.dump_stats(path + '.prof')
+        report = open(path + '.txt', 'w')
+        try:
+            stats = pstats.Stats(profile, stream=report)
+            stats.sort_stats('cumulative').print_stats(40)
+        finally:
+            report.close()
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def log(self, logger):
+        for name, wall, cpu in self.phases:
+            logger.info("Phase %s took %.3f seconds (%.3f CPU)",
+                        name, wall, cpu)
+        logger.info("Cycle took %.3f seconds", self.elapsed())
+
+    def write_textfile(self, filename, counts):
+        """Write the phase timings and the supplied counts to filename in
+        the Prometheus text format, for node_exporter's textfile collector.
+        counts is a list of (metric, help, value) tuples.  The file is
+        written under another name and renamed into place so it's never
+        read half written."""
+        lines = ['# HELP metastats_cycle_seconds Wall clock time of the last stats cycle.',
+                 '# TYPE metastats_cycle_seconds gauge',
+                 'metastats_cycle_seconds %.6f' % self.elapsed(),
+                 '# HELP metastats_cycle_timestamp_seconds When the last stats cycle finished.',
+                 '# TYPE metastats_cycle_timestamp_seconds gauge',
+                 'metastats_cycle_timestamp_seconds %d' % time.time(),
+                 '# HELP metastats_phase_seconds Wall clock time of each phase of the last cycle.',
+                 '# TYPE metastats_phase_seconds gauge']
+        for name, wall, cpu in self.phases:
+            lines.append('metastats_phase_seconds{phase="%s"} %.6f' %
+                         (name, wall))
+        lines.extend(['# HELP metastats_phase_cpu_seconds CPU time of each phase of the last cycle.',
+                      '# TYPE metastats_phase_cpu_seconds gauge'])
+        for name, wall, cpu in self.phases:
+            lines.append('metastats_phase_cpu_seconds{phase="%s"} %.6f' %
+                         (name, cpu))
+        for metric, help, value in counts:
+            lines.extend(['# HELP %s %s' % (metric, help),
+                          '# TYPE %s gauge' % metric,
+                          '%s %d' % (metric, value)])
+        tmpname = filename + '.tmp'
+        textfile = open(tmpname, 'w')
+        try:
+            textfile.write('\n'.join(lines) + '\n')
+        finally:
+            textfile.close()
+        os.rename(tmpname, filename)
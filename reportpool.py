@@ -0,0 +1,50 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# reportpool.py -- Share report generation between processes
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# The per-remailer reports are formatted in Python from the snapshot, so
+# they're shared between processes rather than threads.  The processes are
+# forked once the snapshot has been loaded and read it from memory.  They
+# never use the database; anything that needs writing is returned to the
+# calling process, which writes it.
+
+import multiprocessing
+
+import config
+
+def report_map(func, items):
+    """Call func on each of items, returning a list of the results in the
+    same order.  With config.report_workers set above one, the calls are
+    shared between that many processes, otherwise they're made in this
+    one.  func must be a module level function."""
+    workers = 1
+    if hasattr(config, 'report_workers'):
+        workers = min(config.report_workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    # Several items are handed to a process at a time, but small enough
+    # batches that the processes finish at about the same time.
+    chunksize = len(items) // (workers * 4) + 1
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(func, items, chunksize)
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return results
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# schema.py -- Create and upgrade the metastats database
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Usage: schema.py [--explain]
+#
+# Without arguments, any migrations not yet applied to the database are run
+# in order.  The schema_version table records each one as it's applied.  A
+# database created before schema.py existed (one with an mlist2 table but no
+# schema_version) is taken to be at version 1.
+#
+# With --explain, the queries run on each cycle are explained against the
+# current data and any that read a whole table instead of using an index
+# are listed.  Statements that change the database, such as those run by
+# housekeeping, are explained but not executed.
+
+import os
+import sys
+
+import config
+import db
+import dbengine
+import statparse
+import timefunc
+
+templatedir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'templates')
+
+# Tables created from templates/template.<name> by the first migration.
+tables = ['pingers', 'mlist2', 'chainstat2', 'genealogy', 'contacts', 'failed']
+
+# Widths of the key columns used in the rollups, as in mlist2.
+key_widths = {'ping_name': 24, 'rem_name': 12, 'rem_addy': 50}
+
+# Rows updated per statement when migrating existing data.
+batch_size = 500
+
+def template(table):
+    sqlfile = open(os.path.join(templatedir, 'template.' + table))
+    try:
+        return sqlfile.read()
+    finally:
+        sqlfile.close()
+
+def create_tables(curs):
+    for table in tables:
+        curs.execute(template(table))
+
+# Indexes matched to the queries in db.py.  Remailer reports select on
+# rem_name, rem_addy and a timestamp range, each pinger replaces its own
+# entries by ping_name and remailer, and the index and key reports take
+# everything within a timestamp range.  Broken chains are looked up from
+# either end within a range of last_seen, and replaced per pinger.
+def create_indexes(curs):
+    curs.execute("""CREATE INDEX mlist2_remailer_idx ON mlist2
+                       (rem_name, rem_addy, timestamp)""")
+    curs.execute("""CREATE INDEX mlist2_pinger_idx ON mlist2
+                       (ping_name, rem_name, rem_addy)""")
+    curs.execute("""CREATE INDEX mlist2_timestamp_idx ON mlist2
+                       (timestamp)""")
+    curs.execute("""CREATE INDEX chainstat2_from_idx ON chainstat2
+                       (chain_from, last_seen)""")
+    curs.execute("""CREATE INDEX chainstat2_to_idx ON chainstat2
+                       (chain_to, last_seen)""")
+    curs.execute("""CREATE INDEX chainstat2_pinger_idx ON chainstat2
+                       (ping_name, chain_from, chain_to)""")
+    curs.execute("""CREATE INDEX genealogy_remailer_idx ON genealogy
+                       (rem_name, rem_addy)""")
+
+# The snapshot reads the broken chains within the window in one go.
+def index_chain_window(curs):
+    curs.execute("""CREATE INDEX chainstat2_last_seen_idx ON chainstat2
+                       (last_seen)""")
+
+# Values derived from each entry's histories are stored alongside it, so the
+# reports needn't decode them again: whether up_hist shows no uptime at all,
+# and today's latency class and uptime score.  Existing entries are filled
+# in using the same decoding as new stats, one update per distinct pair of
+# histories.  Remailers are found in genealogy by hist_dead and timestamp.
+def derive_histories(curs):
+    curs.execute("ALTER TABLE mlist2 ADD COLUMN hist_dead boolean")
+    curs.execute("ALTER TABLE mlist2 ADD COLUMN lat_today smallint")
+    curs.execute("ALTER TABLE mlist2 ADD COLUMN up_today smallint")
+    curs.execute("""SELECT DISTINCT lat_hist, up_hist FROM mlist2 WHERE
+                    lat_hist IS NOT NULL AND up_hist IS NOT NULL""")
+    derived = [(lat_hist, up_hist) +
+               statparse.history_vitals(lat_hist, up_hist)
+               for lat_hist, up_hist in curs.fetchall()]
+    for start in range(0, len(derived), batch_size):
+        batch = derived[start:start + batch_size]
+        curs.execute("""UPDATE mlist2 SET
+                        hist_dead = cast(v.column3 AS boolean),
+                        lat_today = cast(v.column4 AS smallint),
+                        up_today = cast(v.column5 AS smallint)
+                        FROM (VALUES """ + db.values_list(len(batch), 5) + """)
+                        AS v WHERE
+                        mlist2.lat_hist = v.column1 AND
+                        mlist2.up_hist = v.column2""", db.flatten(batch))
+    curs.execute("""CREATE INDEX mlist2_live_idx ON mlist2
+                       (hist_dead, timestamp)""")
+
+# The rollups maintained by db.record_history.  The history tables
+# themselves are created as each month's stats arrive.  Hourly rollups are
+# pruned by period.
+def create_rollups(curs):
+    for table, keys in db.rollups:
+        columns = ["%s varchar(%d) NOT NULL" % (key, key_widths[key])
+                   for key in keys]
+        curs.execute("CREATE TABLE " + table + " (" + ", ".join(columns) +
+                     """, period timestamp NOT NULL,
+                        pings integer,
+                        lat_pings integer,
+                        lat_total bigint,
+                        up_total bigint,
+                        PRIMARY KEY (""" + ", ".join(keys) + ", period))")
+        if table.endswith('_hourly'):
+            curs.execute("CREATE INDEX " + table + "_period_idx ON " +
+                         table + " (period)")
+
+# Each housekeeping run records the rows changed by each of its steps and
+# how long they took.
+def create_housekeeping_log(curs):
+    curs.execute("""CREATE TABLE housekeeping_log (
+                    run timestamp NOT NULL,
+                    step varchar(24) NOT NULL,
+                    rows integer,
+                    seconds real,
+                    PRIMARY KEY (run, step))""")
+
+# The keys last read from each pinger's pubring, so that stats for a
+# remailer that's new to the pinger can be given its key without waiting
+# for the pubring to change.  It starts with the keys already in mlist2.
+# Names aren't limited to the widths used in mlist2, as a pubring can list
+# remailers the pinger has no stats for.
+def create_pubring_keys(curs):
+    curs.execute("""CREATE TABLE pubring_keys (
+                    ping_name varchar(24) NOT NULL,
+                    rem_name varchar NOT NULL,
+                    rem_addy varchar NOT NULL,
+                    key varchar,
+                    version varchar,
+                    valid date,
+                    expire date,
+                    PRIMARY KEY (ping_name, rem_name, rem_addy))""")
+    curs.execute("""INSERT INTO pubring_keys
+                        (ping_name, rem_name, rem_addy, key, version, valid,
+                         expire)
+                    SELECT ping_name, rem_name, rem_addy, max(key),
+                           max(version), max(valid), max(expire)
+                    FROM mlist2 WHERE
+                        ping_name IS NOT NULL AND
+                        rem_name IS NOT NULL AND
+                        rem_addy IS NOT NULL AND
+                        key IS NOT NULL
+                    GROUP BY ping_name, rem_name, rem_addy""")
+
+# Housekeeping marks remailers dead and clears their last_fail by last_seen,
+# and new remailers are found by excluding those without one.
+def index_genealogy_seen(curs):
+    curs.execute("""CREATE INDEX genealogy_seen_idx ON genealogy
+                       (last_seen, last_fail)""")
+
+# Trends are read from the daily rollups by period, as the hourly ones
+# already are by drop_history.
+def index_daily_rollups(curs):
+    for table in 'remailer_daily', 'pinger_daily':
+        curs.execute("CREATE INDEX " + table + "_period_idx ON " + table +
+                     " (period)")
+
+# Each migration is a (version, description, function) tuple.  The function
+# is given a cursor and runs within the transaction that records the new
+# version.  New ones are appended to the end of the list and existing ones
+# are never changed.
+migrations = [
+    (1, "Create tables", create_tables),
+    (2, "Index mlist2, chainstat2 and genealogy", create_indexes),
+    (3, "Index chainstat2 by last_seen", index_chain_window),
+    (4, "Store values derived from mlist2 histories", derive_histories),
+    (5, "Create hourly and daily rollups", create_rollups),
+    (6, "Create housekeeping_log", create_housekeeping_log),
+    (7, "Keep the keys read from each pubring", create_pubring_keys),
+    (8, "Index genealogy by last_seen", index_genealogy_seen),
+    (9, "Index the daily rollups by period", index_daily_rollups)]
+
+def existing_tables(curs):
+    curs.execute(db.engine.tables_query)
+    return set([row[0] for row in curs.fetchall()])
+
+def current_version():
+    """Return the version the database is at, creating the schema_version
+    table if this is the first time schema.py has been run against it."""
+    with db.transaction() as curs:
+        found = existing_tables(curs)
+        if 'schema_version' in found:
+            curs.execute("SELECT max(version) FROM schema_version")
+            return curs.fetchone()[0] or 0
+        curs.execute("""CREATE TABLE schema_version (
+                        version integer PRIMARY KEY,
+                        applied timestamp)""")
+        version = 0
+        if 'mlist2' in found:
+            version = 1
+            curs.execute("""INSERT INTO schema_version (version, applied)
+                            VALUES (1, %s)""", (db.now,))
+        return version
+
+def upgrade():
+    version = current_version()
+    latest = migrations[-1][0]
+    if version >= latest:
+        print "Database is at version %d, nothing to do" % version
+        return
+    for number, description, migrate in migrations:
+        if number <= version:
+            continue
+        print "Migrating to version %d: %s" % (number, description)
+        with db.transaction() as curs:
+            migrate(curs)
+            curs.execute("""INSERT INTO schema_version (version, applied)
+                            VALUES (%s, %s)""", (number, db.now))
+    print "Database is at version %d" % latest
+
+# Statements whose plans are examined, and of those, the ones that change
+# the database and so are only explained.
+explained = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+explain_only = ('INSERT', 'UPDATE', 'DELETE')
+
+# Functions that read a whole table by design.  Their scans are listed but
+# not counted as problems.  The snapshot is a copy of the whole of mlist2,
+# and pingers has just a row for each pinger.
+whole_table = ['remailer_pings', 'keyrings', 'delete_idle_pingers']
+
+class ExplainCursor(dbengine.Cursor):
+    """Used in place of the usual cursor wrapper.  Before each query is
+    executed, its plan is fetched and any steps that scan a whole table are
+    recorded against the db function that issued the query.  Statements
+    that would change the database are not executed."""
+    scans = []
+
+    def execute(self, query, params=None):
+        statement = query.split(None, 1)[0].upper()
+        if statement in explained:
+            caller = sys._getframe(1).f_code.co_name
+            for setup in self.engine.explain_setup:
+                dbengine.Cursor.execute(self, setup)
+            dbengine.Cursor.execute(self, self.engine.explain + query, params)
+            plan = [str(step[-1]).strip() for step in self.fetchall()]
+            for step in self.engine.seq_scans(plan):
+                self.scans.append((caller, step))
+        if statement in explain_only:
+            return None
+        return dbengine.Cursor.execute(self, query, params)
+
+def cycle_queries():
+    """Run each of the queries that a stats cycle reads the database with,
+    and explain those that housekeeping changes it with.  Returns False if
+    there's no data in mlist2 to run them against."""
+    if not db.pinger_latest():
+        return False
+    # Harvesting and the reports.
+    db.pinger_names()
+    db.keyrings()
+    db.remailer_pings()
+    db.chains(db.ago, db.ahead)
+    db.gene_find_new()
+    db.gene_get_stats()
+    for table, keys in db.rollups:
+        db.rollup_totals(table, db.ago)
+    # Housekeeping.
+    age = timefunc.hours_ago(config.dead_after_hours)
+    db.count_pings()
+    db.delete_stale_pings(age, 1)
+    db.delete_idle_pingers()
+    db.gene_mark_dead(age)
+    db.gene_clear_failed()
+    db.last_housekeeping()
+    return True
+
+def explain():
+    """Print the queries that read a whole table.  Returns the number of
+    queries flagged, not counting those that do so by design."""
+    db.cursor_class = ExplainCursor
+    try:
+        found = cycle_queries()
+    finally:
+        db.cursor_class = dbengine.Cursor
+    if not found:
+        print "There's nothing in mlist2 to explain queries against"
+        return 0
+    flagged = {}
+    expected = {}
+    for caller, step in ExplainCursor.scans:
+        if caller in whole_table:
+            expected.setdefault(caller, []).append(step)
+        else:
+            flagged.setdefault(caller, []).append(step)
+    for caller in sorted(expected.keys()):
+        print "%s (reads the whole table by design):" % caller
+        for step in expected[caller]:
+            print "    %s" % step
+    for caller in sorted(flagged.keys()):
+        print "%s:" % caller
+        for step in flagged[caller]:
+            print "    %s" % step
+    if not flagged:
+        print "All other queries use indexes"
+    return len(flagged)
+
+# Call main function.
+if (__name__ == "__main__"):
+    if '--explain' in sys.argv[1:]:
+        sys.exit(explain() and 1)
+    upgrade()
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# snapshot.py -- In-memory copy of mlist2 and chainstat2 for reporting
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Every report works from the same pings within the same active window.
+# Rather than each of them querying mlist2, the table is read once per
+# cycle into a Snapshot.  The data is held a column at a time: numbers in
+# arrays, strings in lists with repeated values shared, and the remailer
+# and pinger of each ping as small integer codes.  Rows can still be
+# rebuilt in mlist2 column order for code that formats them.
+
+import array
+import datetime
+import math
+
+import config
+import db
+import timefunc
+
+# Summaries returned by summarise and group_by are tuples of
+# (count, min, avg, max, stddev).  As with SQL aggregates, everything but
+# the count is None when there are no values, and stddev is None for fewer
+# than two values.
+COUNT, MIN, AVG, MAX, STDDEV = range(5)
+
+def summarise(values):
+    """Return a summary tuple for a sequence of numbers."""
+    count = len(values)
+    if count == 0:
+        return 0, None, None, None, None
+    avg = float(sum(values)) / count
+    stddev = None
+    if count > 1:
+        squares = 0.0
+        for value in values:
+            squares += (value - avg) ** 2
+        stddev = math.sqrt(squares / (count - 1))
+    return count, min(values), avg, max(values), stddev
+
+def window_time(stamp):
+    return datetime.datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S")
+
+class Snapshot(object):
+    def __init__(self, rows, chains, max_age, max_future):
+        """Build a snapshot from mlist2 rows, as returned by
+        db.remailer_pings, and chainstat2 rows.  Pings timestamped between
+        max_age and max_future are within the window."""
+        self.max_age = max_age
+        self.max_future = max_future
+        start = window_time(max_age)
+        end = window_time(max_future)
+
+        # Lookup tables for the remailer and pinger codes.
+        self.remailers = sorted(set([(row[1], row[2]) for row in rows]))
+        self.pingers = sorted(set([row[0] for row in rows]))
+        self.remailer_code = dict([(remailer, code) for code, remailer
+                                   in enumerate(self.remailers)])
+        self.pinger_code = dict([(ping_name, code) for code, ping_name
+                                 in enumerate(self.pingers)])
+
+        self.remailer = array.array('i')
+        self.pinger = array.array('i')
+        self.lat_time = array.array('i')
+        self.up_time = array.array('i')
+        self.in_window = array.array('b')
+        self.hist_dead = array.array('b')
+        self.up_today = array.array('b')
+        self.lat_hist = []
+        self.up_hist = []
+        self.options = []
+        self.timestamp = []
+        self.key = []
+        self.version = []
+        self.valid = []
+        self.expire = []
+        self.lat_today = []
+        # Positions of each remailer's pings, all and within the window.
+        self.remailer_rows = [[] for remailer in self.remailers]
+        self.remailer_window = [[] for remailer in self.remailers]
+        self.window = []
+        # The uptime matrix, once it's been built.
+        self.matrix = None
+        strings = {}
+        for position, row in enumerate(rows):
+            ping_name, rem_name, rem_addy, lat_hist, lat_time, up_hist, \
+                up_time, options, timestamp, key, version, valid, expire, \
+                hist_dead, lat_today, up_today = row
+            code = self.remailer_code[(rem_name, rem_addy)]
+            self.remailer.append(code)
+            self.pinger.append(self.pinger_code[ping_name])
+            self.lat_time.append(lat_time or 0)
+            self.up_time.append(up_time or 0)
+            in_window = timestamp is not None and start <= timestamp <= end
+            self.in_window.append(in_window)
+            self.lat_hist.append(strings.setdefault(lat_hist, lat_hist))
+            self.up_hist.append(strings.setdefault(up_hist, up_hist))
+            self.options.append(strings.setdefault(options, options))
+            self.timestamp.append(timestamp)
+            self.key.append(strings.setdefault(key, key))
+            self.version.append(strings.setdefault(version, version))
+            self.valid.append(valid)
+            self.expire.append(expire)
+            self.hist_dead.append(bool(hist_dead))
+            self.lat_today.append(lat_today)
+            self.up_today.append(up_today or 0)
+            self.remailer_rows[code].append(position)
+            if in_window:
+                self.remailer_window[code].append(position)
+                self.window.append(position)
+
+        # Broken chains within the window, as (ping_name, chain_from,
+        # chain_to, last_seen) tuples indexed by each end of the chain.
+        self.chains_from = {}
+        self.chains_to = {}
+        for chain in chains:
+            self.chains_from.setdefault(chain[1], []).append(chain)
+            self.chains_to.setdefault(chain[2], []).append(chain)
+        for chains in self.chains_from.values():
+            chains.sort(key=lambda chain: (chain[2], chain[0]))
+        for chains in self.chains_to.values():
+            chains.sort(key=lambda chain: (chain[1], chain[0]))
+
+    def ping_name(self, position):
+        return self.pingers[self.pinger[position]]
+
+    def row(self, position):
+        """Rebuild the mlist2 row at a position."""
+        rem_name, rem_addy = self.remailers[self.remailer[position]]
+        return (self.pingers[self.pinger[position]], rem_name, rem_addy,
+                self.lat_hist[position], self.lat_time[position],
+                self.up_hist[position], self.up_time[position],
+                self.options[position], self.timestamp[position],
+                self.key[position], self.version[position],
+                self.valid[position], self.expire[position],
+                self.hist_dead[position], self.lat_today[position],
+                self.up_today[position])
+
+    def pings(self, remailer, window=True):
+        """Return the positions of a remailer's pings, only those within the
+        window unless told otherwise."""
+        code = self.remailer_code.get(remailer)
+        if code is None:
+            return []
+        if window:
+            return self.remailer_window[code]
+        return self.remailer_rows[code]
+
+    def group_by(self, codes, labels, values, positions):
+        """Summarise a column of values, grouped by a column of codes, over
+        the given positions.  labels turns each code back into the value it
+        stands for.  Returns a dictionary of label: summary."""
+        groups = {}
+        for position in positions:
+            code = codes[position]
+            try:
+                groups[code].append(values[position])
+            except KeyError:
+                groups[code] = array.array(values.typecode,
+                                           [values[position]])
+        summaries = {}
+        for code, group in groups.items():
+            summaries[labels[code]] = summarise(group)
+        return summaries
+
+    def by_remailer(self, values, positions=None):
+        """Summarise a column for each remailer, keyed by
+        (rem_name, rem_addy).  Defaults to the pings within the window."""
+        if positions is None:
+            positions = self.window
+        return self.group_by(self.remailer, self.remailers, values, positions)
+
+    def by_pinger(self, values, positions=None):
+        """Summarise a column for each pinger, keyed by ping_name.  Defaults
+        to the pings within the window."""
+        if positions is None:
+            positions = self.window
+        return self.group_by(self.pinger, self.pingers, values, positions)
+
+    def uptime_matrix(self):
+        """Pivot the uptimes within the window into a row for each remailer
+        with a column for each pinger, in a single pass.  Returns a list of
+        (uptimes, summary), in the order of self.remailers, where uptimes
+        holds the remailer's uptime with each of self.pingers, or None, and
+        summary summarises those uptimes above zero.  Also returns a list
+        of how many remailers each pinger has an uptime for.  The matrix
+        is built the first time it's asked for and kept."""
+        if self.matrix is not None:
+            return self.matrix
+        columns = len(self.pingers)
+        cells = [[None] * columns for remailer in self.remailers]
+        positive = [[] for remailer in self.remailers]
+        counts = [0] * columns
+        for position in self.window:
+            code = self.remailer[position]
+            pinger = self.pinger[position]
+            up_time = self.up_time[position]
+            cells[code][pinger] = up_time
+            counts[pinger] += 1
+            if up_time > 0:
+                positive[code].append(up_time)
+        rows = [(uptimes, summarise(values))
+                for uptimes, values in zip(cells, positive)]
+        self.matrix = rows, counts
+        return self.matrix
+
+current = None
+
+def load(max_age=None, max_future=None):
+    """Read mlist2 and the broken chains within the window and make them
+    the current snapshot.  The window defaults to the configured active
+    age and future."""
+    global current
+    if max_age is None:
+        max_age = timefunc.hours_ago(config.active_age)
+    if max_future is None:
+        max_future = timefunc.hours_ahead(config.active_future)
+    current = Snapshot(db.remailer_pings(), db.chains(max_age, max_future),
+                       max_age, max_future)
+    return current
+
+def get():
+    """Return the current snapshot, loading one if this is the first time
+    it's been asked for."""
+    if current is None:
+        return load()
+    return current
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# statparse.py -- Incremental parser for Echolot mlist2 stats files
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import re
+import string
+
+import timefunc
+
+# Record types yielded by parse_stats.  Each record is a tuple with the type
+# as its first element:
+#   (TIMESTAMP, stamp)
+#   (STAT, rem_name, stats_line, fields)
+#   (ADDRESS, rem_name, rem_addy)
+#   (CHAINS,)
+#   (CHAIN, chain_from, chain_to)
+# The fields of a STAT record are the decoded stats line; a tuple of
+# (lat_hist, lat_time, up_hist, up_time, options), or None if the line
+# isn't the expected length.  A CHAINS record marks the start of the broken
+# type-II chains, so an empty list of chains can be told apart from a file
+# that doesn't report chains at all.
+TIMESTAMP = 'timestamp'
+STAT = 'stat'
+ADDRESS = 'address'
+CHAINS = 'chains'
+CHAIN = 'chain'
+
+stat_re = re.compile('(\w{1,12})\s+([0-9A-H?]{12}\s.*)')
+addy_re = re.compile('\$remailer\{\"([0-9a-z]{1,12})\"\}\s\=\s\"\<(.*)\>\s')
+chain_re = re.compile('\((\S{1,12})\s(\S{1,12})\)')
+
+# A stats line of the correct length (59 or 60 characters following the
+# remailer name), matched and split into its columns in one step.  The groups
+# are: remailer name, the whole stats line, latency history (including the
+# trailing space, as it always has), latency hours, latency minutes, uptime
+# history, uptime percent, uptime tenths and options.
+stat_cols_re = re.compile('(\w{1,12})\s+(([0-9A-H?]{12}\s).(..).(...)..'
+                          '(.{12})..(...).(.)...(.{15}).?)$')
+
+# Lines are dispatched on their first character.  Only lines starting with
+# one of these can be stats lines.
+WORD_START = frozenset(string.ascii_letters + string.digits + '_')
+
+def lenient_int(field):
+    """Convert a stats column to an integer.  Blank or non-numeric columns
+    are treated as zero."""
+    try:
+        return int(field)
+    except ValueError:
+        return 0
+
+def decode_stat(is_stat):
+    """Convert the columns of a stat_cols_re match into a tuple of
+    (lat_hist, lat_time, up_hist, up_time, options)."""
+    lat_hist, lat_hour, lat_min, up_hist, up_dec, up_frac, options = \
+        is_stat.group(3, 4, 5, 6, 7, 8, 9)
+    try:
+        if lat_hour == '  ':
+            lat_time = int(lat_min)
+        else:
+            lat_time = int(lat_hour) * 60 + int(lat_min)
+        up_time = int(up_dec) * 10 + int(up_frac)
+    except ValueError:
+        # Something didn't convert cleanly.  Take the slow path and treat
+        # each unreadable column as zero.
+        lat_time = lenient_int(lat_hour) * 60 + lenient_int(lat_min)
+        up_time = lenient_int(up_dec) * 10 + lenient_int(up_frac)
+    return lat_hist, lat_time, up_hist, up_time, options
+
+# Each character of a latency history is the latency class of one day, from
+# '0' (best) to 'H' (worst), and each character of an uptime history is the
+# uptime of one day in tenths, with '+' for 100%.  Either can be '?' when
+# there were no results that day.  Today is the last character.
+LAT_CLASSES = '0123456789ABCDEFGH'
+
+def history_vitals(lat_hist, up_hist):
+    """Decode today's values from a pair of histories.  Returns a tuple of
+    (hist_dead, lat_today, up_today) where hist_dead is True if no day in
+    up_hist shows any uptime, lat_today is today's latency class, or None if
+    it's unknown, and up_today is today's uptime score from 0 to 10."""
+    up_hist = up_hist.rstrip()
+    hist_dead = not up_hist.strip('0?')
+    lat_now = lat_hist.rstrip()[-1:]
+    lat_today = None
+    if lat_now and lat_now in LAT_CLASSES:
+        lat_today = LAT_CLASSES.index(lat_now)
+    up_now = up_hist[-1:]
+    if up_now == '+':
+        up_today = 10
+    else:
+        up_today = lenient_int(up_now)
+    return hist_dead, lat_today, up_today
+
+def source_lines(source):
+    """Return an iterator over the lines of a stats source.  The source can
+    be a string, a list of lines, a file-like object such as an open file or
+    a urllib2 response, or a connected socket.  File-like objects and sockets
+    are read a line at a time so the whole file is never held in memory."""
+    if isinstance(source, basestring):
+        return iter(source.splitlines(True))
+    if hasattr(source, 'makefile'):
+        source = source.makefile('rb')
+    if hasattr(source, 'readline'):
+        return iter(source.readline, '')
+    return iter(source)
+
+def parse_stats(source):
+    """Generator that reads an mlist2 stats source and yields a record for
+    each element of interest as soon as it's found.  The file is assumed to
+    contain, in order, a Generated timestamp, stats lines, broken chains and
+    remailer addresses.  Each line is dispatched on its first character so
+    that most lines are only tested against a single regex."""
+    genstamp = 0 # Timestamp extracted from the source
+    chainstat = False # Flag to indicate if we are in the Type2 Chainstats
+    for row in source_lines(source):
+        first = row[:1]
+        if first == 'G' and not genstamp and row.startswith('Generated: '):
+            gentime = row.split('ted: ')
+            genstamp = timefunc.arpa_check(gentime[1])
+            yield (TIMESTAMP, genstamp)
+            continue
+
+        # If a stats line starts with 'Broken type-II' we'll assume the
+        # chains follow immediately after and continue until we hit a line
+        # that doesn't match a chainstat format.  Chains are only of use if
+        # we've already found a timestamp to log against them.
+        if first == 'B' and genstamp and row.startswith('Broken type-II'):
+            chainstat = True
+            yield (CHAINS,)
+            continue
+        if chainstat:
+            is_chain = first == '(' and chain_re.match(row)
+            if is_chain:
+                yield (CHAIN, is_chain.group(1), is_chain.group(2))
+            else:
+                chainstat = False
+            continue
+
+        if first == '$':
+            is_addy = addy_re.match(row)
+            if is_addy:
+                yield (ADDRESS, is_addy.group(1), is_addy.group(2))
+            continue
+
+        if first in WORD_START:
+            is_stat = stat_cols_re.match(row)
+            if is_stat:
+                yield (STAT, is_stat.group(1), is_stat.group(2),
+                       decode_stat(is_stat))
+                continue
+            # Stats lines of the wrong length are still reported, but
+            # without any decoded fields.
+            is_stat = stat_re.match(row)
+            if is_stat:
+                yield (STAT, is_stat.group(1), is_stat.group(2), None)
@@ -17,22 +17,39 @@
 # for more details.
 
 import datetime
+import json
 import socket
-import urllib2
 import logging
-import re
+import optparse
+import os
 import sys
+import time
 
 import config
 import db
+import dirty
+import export
+import housekeeping
+import output
+import profiler
+import snapshot
+import statparse
 import timefunc
+import urlcache
+from harvest import harvest
+from reportpool import report_map
 from index import index
 from genealogy import genealogy
 from uptimes import uptimes
+from trends import trends
 from chainstats import chainstats
 from keys import getkeystats
 from keys import writekeystats
 
+# Handlers are added by init_logging.  Until then, build_stats can still be
+# used, by backfill.py and bench_parse.py, without logging anywhere.
+logger = logging.getLogger('stats')
+
 # --- Configuration ends here -----
 
 def init_logging():
@@ -48,137 +65,104 @@ def init_logging():
     hdlr.setFormatter(formatter)
     logger.addHandler(hdlr)
     logger.setLevel(level)
-
-# Fetch stats url from a pinger
+    # Slow queries are also written to a log of their own.
+    if hasattr(config, 'slow_query_log'):
+        slowhdlr = logging.FileHandler(config.slow_query_log)
+        slowhdlr.setFormatter(formatter)
+        logging.getLogger('stats.slow').addHandler(slowhdlr)
+
+# Fetch stats url from a pinger.  Returns the open response, 0 on failure or
+# urlcache.UNCHANGED if the pinger hasn't regenerated its stats.
 def url_fetch(url):
     if url.endswith(".htm") or url.endswith(".html"):
         logger.warn("%s is probably html, not text.  Trying anyway", url)
     else:
         logger.debug("Attempting to retreive %s", url)
-    pingurl = urllib2.Request(url)
-    failed = 0
+    return urlcache.fetch(url)
+
+# Fetch and parse a pinger's stats.  This runs in a harvest worker thread so
+# the stats are parsed as they're read from the network.  The returned list
+# of records is small; one per remailer, chain and address.
+def url_parse(url):
+    content = url_fetch(url)
+    if not content:
+        return content
     try:
-        opener = urllib2.urlopen(pingurl)
-    except:
-        failed = 1
-    if failed:
-        logger.info("Retrieval of %s failed", url)
+        records = list(statparse.parse_stats(content))
+    except (IOError, socket.error), e:
+        logger.info("Retrieval of %s failed whilst reading: %s", url, e)
         return 0
-    else:
-        try:
-            content = opener.readlines()
-            return content
-        except:
-            return 0
-
-# Do some string to integer conversion
-def numeric(seq):
-    seq = seq.strip() # Get rid of spaces
-    if len(seq) == 0:
-        seq = 0
-    else:
-        try:
-            seq = int(seq)
-        except ValueError:
-            seq = 0
-            logger.warn("Expected a numeric, got %s", seq)
-    return seq
-
-# Process each line of a pinger url and write results to database
-def url_process(pinger_name,pinger):
+    if urlcache.unchanged(content):
+        return urlcache.UNCHANGED
+    return records
+
+# Process the records parsed from a pinger url and write results to database
+def url_process(pinger_name, records):
+    genstamp, stat_lines, chains = build_stats(pinger_name, records)
+    store_stats(pinger_name, genstamp, stat_lines, chains)
+
+# Turn the records parsed from a pinger's stats into the rows to be written
+# to the database.  Returns a tuple of (genstamp, stat_lines, chains) where
+# chains is None if the pinger didn't report any chain stats.  Nothing here
+# touches the database, so it's safe to call from a worker process.
+def build_stats(pinger_name, records):
     genstamp = 0 # Timestamp extracted from URL
-    chainstat = False # Flag to indicate if we are in the Type2 Chainstats
     address_hash = {}  # Key: Remailer Name, Content: Remailer Address
     stats_hash = {} # Key: Remailer Name, Content: Stats line
+    chains = None # List of (from, to) broken chains
 
-# The following sections assume the required elements of the stats url are in
-# the correct sequence:
-# Generated Timestamp, Stats lines, Address lines
+# The records arrive in the same sequence as the elements of the stats url:
+# Generated Timestamp, Stats lines, Broken chains, Address lines
 # Two hashes are used to store stats and address details, both keyed by
 # remailer name.
-    for row in pinger:
-        if row.startswith('Generated: ') and not genstamp:
-            gentime = row.split('ted: ')
-            genstamp = timefunc.arpa_check(gentime[1])
+    for record in records:
+        if record[0] == statparse.TIMESTAMP:
+            genstamp = record[1]
             logger.debug("Found timestamp %s on stats from %s", genstamp, pinger_name)
-            continue
 
-        # Lets gather some information about chain stats.  If a stats line
-        # starts with 'Broken type-II' we'll assume the info we require follows
-        # immediately after and continues until we hit a line that does match
-        # a chainstat format.  We must find a timestamp to log against each
-        # stat.  Without this, it's future validity cannot be proven.
-        if row.startswith('Broken type-II') and genstamp:
-            chainstat = True
+        elif record[0] == statparse.CHAINS:
+            chains = []
             logger.debug("Found header for Broken Type-II chains from pinger %s", pinger_name)
-            continue
-        # Once chain2 flag is True, we assume each line that looks like a chain
-        # stat entry is a valid chain stat entry.
-        if chainstat:
-            is_chain = chain_re.match(row)
-            if is_chain:
-                chain = { 'from': is_chain.group(1),
-                          'to': is_chain.group(2),
-                          'stamp': genstamp,
-                          'pinger': pinger_name }
-                if chain['from'] == '*' and chain['to'] == '*':
-		    logger.warn("Pinger %s reports global broken chains (* *)", pinger_name)
-                elif chain['from'] == '*':
-		    logger.info("Pinger %s reports wildcard broken chains to %s", pinger_name, chain['to'])
-                elif chain['to'] == '*':
-		    logger.info("Pinger %s reports wildcard broken chains from %s", pinger_name, chain['from'])
-                db.chainstat_update(chain)
-                logger.debug("Processing broken chain from %(from)s to %(to)s", chain)
-            else:
-                # When we find a line that isn't a chainstat, reset the chain2
-                # flag to indicate we are no longer interested in lines that
-                # match the regex.
-                chainstat = False
-                logger.debug("Finished processing Broken Type-II chains for %s", pinger_name)
-            continue
-
 
-        is_stat = stat_re.match(row)
-        if is_stat:
-            rem_name = is_stat.group(1)
+        elif record[0] == statparse.CHAIN:
+            chain_from, chain_to = record[1:3]
+            if chain_from == '*' and chain_to == '*':
+                logger.warn("Pinger %s reports global broken chains (* *)", pinger_name)
+            elif chain_from == '*':
+                logger.info("Pinger %s reports wildcard broken chains to %s", pinger_name, chain_to)
+            elif chain_to == '*':
+                logger.info("Pinger %s reports wildcard broken chains from %s", pinger_name, chain_from)
+            chains.append((chain_from, chain_to))
+            logger.debug("Processing broken chain from %s to %s", chain_from, chain_to)
+
+        elif record[0] == statparse.STAT:
+            rem_name = record[1]
             if len(rem_name) > 8:
                 logger.info("%s reports long remailer name %s", pinger_name, rem_name)
             if stats_hash.has_key(rem_name):
                 logger.warn("Pinger %s reports multiple entries for %s", pinger_name, rem_name)
             else:
-                stats_hash[rem_name] = is_stat.group(2)
+                stats_hash[rem_name] = record[2:4]
                 logger.debug("Processing entry for remailer %s in %s stats", rem_name, pinger_name)
-            continue
 
-        is_addy = addy_re.match(row)
-        if is_addy:
-            rem_name = is_addy.group(1)
+        elif record[0] == statparse.ADDRESS:
+            rem_name = record[1]
             if address_hash.has_key(rem_name):
                 logger.warn("The address %s appears to be duplicated in %s stats", address_hash[rem_name], pinger_name)
             else:
-                address_hash[rem_name] = is_addy.group(2)
+                address_hash[rem_name] = record[2]
                 logger.debug("Found email address of %s for %s in %s stats", address_hash[rem_name], rem_name, pinger_name)
 
 # Now we have populated the stats and address hashes, we need to work through
 # each stats entry and extract the components for writing to the database.
+    stat_lines = []
     for remailer in stats_hash:
-        line = stats_hash[remailer]
+        line, fields = stats_hash[remailer]
         if address_hash.has_key(remailer):
-            if len(line) == 59 or len(line) == 60:
-                try:
-                    lat_hist = line[0:13]
-                    lat_hour = numeric(line[14:16]) * 60
-                    lat_min = numeric(line[17:20])
-                    lat_time = int(lat_hour + lat_min)
-                    up_hist = line[22:34]
-                    up_dec = numeric(line[36:39]) * 10
-                    up_frac = numeric(line[40:41])
-                    up_time = int(up_dec + up_frac)
-                    options = line[44:59]
-                except:
-                    logger.warn("Malformed stats line for remailer %s whilst processing pinger %s", remailer, pinger_name)
-                    continue
-
+            if fields:
+                lat_hist, lat_time, up_hist, up_time, options = fields
+                hist_dead, lat_today, up_today = \
+                    statparse.history_vitals(lat_hist, up_hist)
                 data = {'url_ping_name':pinger_name,
                         'url_rem_name':remailer,
                         'url_rem_addy':address_hash[remailer],
@@ -187,13 +171,13 @@ def url_process(pinger_name,pinger):
                         'url_up_hist':up_hist,
                         'url_up_time':up_time,
                         'url_options':options,
-                        'url_timestamp':genstamp}
+                        'url_timestamp':genstamp,
+                        'url_hist_dead':hist_dead,
+                        'url_lat_today':lat_today,
+                        'url_up_today':up_today}
+
+                stat_lines.append(data)
 
-                logger.debug("Deleting database entries for remailer %s from pinger %s", remailer, pinger_name)
-                db.delete(data)  # Delete old matching entries
-                logger.debug("Inserting database entries for remailer %s from pinger %s", remailer, pinger_name)
-                db.insert(data)  # Insert new entry to replace those deleted
-                
             else:
                 # The stats line length is wrong, it must be 59 or 60
                 logger.warn("Incorrect stats line length (%d) in %s pinger stats for remailer %s.  Should be 59 or 60.", len(line), pinger_name, remailer)
@@ -201,6 +185,32 @@ def url_process(pinger_name,pinger):
             # For some reason we appear to have a remailer entry in stats with no matching address
             logger.warn("No address found in %s stats for remailer %s", pinger_name, remailer)
 
+    return genstamp, stat_lines, chains
+
+# Write a pinger's stats and broken chains to the database.
+def store_stats(pinger_name, genstamp, stat_lines, chains):
+    global rows_written
+    # The pinger's set of broken chains replaces whatever it reported last
+    # time, providing this time it reported any chain stats at all.
+    if chains is not None:
+        added, seen, removed = db.chainstat_replace(pinger_name, genstamp, chains)
+        logger.debug("Pinger %s reports %d new, %d existing and %d fixed broken chains", pinger_name, added, seen, removed)
+
+    # All the entries for this pinger are written in a single transaction.
+    start = time.time()
+    db.replace_stats(pinger_name, stat_lines)
+    rows_written += len(stat_lines)
+    logger.debug("Wrote %d entries for pinger %s in %.3f seconds", len(stat_lines), pinger_name, time.time() - start)
+    store_history(pinger_name, genstamp, stat_lines)
+
+# Append a pinger's stats to the history tables and rollups.  Stats without a
+# Generated timestamp can't be placed in the history, so they're left out.
+def store_history(pinger_name, genstamp, stat_lines):
+    if not genstamp:
+        return
+    added = db.record_history(pinger_name, genstamp, stat_lines)
+    logger.debug("Recorded %d history entries for pinger %s at %s", added, pinger_name, genstamp)
+
 # Convert latent time in minutes to timestamp string (HH:MM)
 def latent_timestamp(mins):
     hours = int(mins / 60)
@@ -225,26 +235,21 @@ def db_process(row):
     line = " " + ping_name + lat_hist + lat_time + up_hist + up_time + options + timestamp + "\n"
     return line
 
-# For a given remailer name, return the average uptime for today from up_hist.
-# In up_hist, a '+' indicates a score of 10.
+# For a given remailer name, return the average uptime for today.  Today's
+# score from up_hist is decoded when the stats are stored, as up_today.
 def up_today(entries):
     total = 0.0
     for line in entries:
-        uptime = line[5]
-        uptime_now = uptime[-1]
-        if uptime_now == '+':
-            score = 10
-        elif uptime_now == '?':
-            score = 0
-        else:
-            score = int(uptime_now)
-        total += score
+        total += line[15]
     return total / len(entries)
 
+# Decide whether a remailer has failed or recovered.  Returns a tuple of
+# (failed, recovered) flags, for the genealogy table to be updated with.
 def fail_recover(name, addy, active_pings):
+    failed = recovered = False
     if len(active_pings) == 0:
         logger.info("We have no active pingers for %s", name)
-        db.mark_failed(name, addy, timefunc.utcnow())
+        failed = True
     else:
         uptime = up_today(active_pings)
         # If a remailers uptime is < 20%, then we mark it as failed and
@@ -252,91 +257,174 @@ def fail_recover(name, addy, active_pings):
         # be a low percentage or bunker would be considered dead.
         if uptime < config.deadpoint:
             logger.debug("%s is under %d%%, flagging it failed", name, config.deadpoint * 10)
-            db.mark_failed(name, addy, timefunc.utcnow())
+            failed = True
         # Stats are greater than 50%, so delete any entries for this
         # remailer from the failed table.
         if uptime > config.livepoint:
             logger.debug("%s is healthy, deleting any failed flags it might have", name)
-            db.mark_recovered(name, addy)
-
-# Are we running in testmode (without --live)
-def live_or_test(mode):
-    if len(mode) > 1:
-        if mode[1].startswith('--'):
-            option = mode[1] [2:]
-            if option == 'live':
-                logger.debug("Running with 'live' flag set, url's will be retreived")
-                return False
-    logger.debug("Running in test mode, urls will not be retreived")
-    return True
-
-def gen_remailer_vitals(name, addy):
-    vitals = {}
-    vitals["rem_name"] = name
-    vitals["rem_addy"] = addy
-    vitals["max_age"] = ago
-    vitals["max_future"] = ahead
-    vitals["chain_from"] = db.chain_from_count(vitals)
-    vitals["chain_to"] = db.chain_to_count(vitals)
-    # First we get some stats based on all responding pingers
-    vitals["rem_latency_avg_all"], \
-    vitals["rem_uptime_avg_all"], \
-    vitals["rem_latency_stddev_all"], \
-    vitals["rem_uptime_stddev_all"], \
-    vitals["rem_count_all"] = db.remailer_avgs_all(vitals)
-    # If any of the above stats return None, set them to an arbitrary default.
-    if not vitals["rem_latency_avg_all"]:
-        vitals["rem_latency_avg_all"] = 5999
-    if not vitals["rem_uptime_avg_all"]:
-        vitals["rem_uptime_avg_all"] = 0
-    if not vitals["rem_latency_stddev_all"]:
-        vitals["rem_latency_stddev_all"] = 0
-    if not vitals["rem_uptime_stddev_all"]:
-        vitals["rem_uptime_stddev_all"] = 0
-    # Use a configured multiplier to broaden/narrow out accepted ranges
-    vitals["rem_latency_stddev_range"] = \
-     float(vitals["rem_latency_stddev_all"]) * config.latency_stddev_multiplier
-    vitals["rem_uptime_stddev_range"] = \
-     float(vitals["rem_uptime_stddev_all"]) * config.uptime_stddev_multiplier
-    # Now we get some stats for active pings using the criteria defined above.
-    vitals["rem_latency_min"], \
-    vitals["rem_latency_avg"], \
-    vitals["rem_latency_max"], \
-    vitals["rem_latency_stddev"], \
-    vitals["rem_uptime_min"], \
-    vitals["rem_uptime_avg"], \
-    vitals["rem_uptime_max"], \
-    vitals["rem_uptime_stddev"], \
-    vitals["rem_active_count"]= db.remailer_stats(vitals)
-    # If any of the above stats return None, set them to an arbitrary default.
-    if not vitals["rem_latency_min"]:
-        vitals["rem_latency_min"] = 0
-    if not vitals["rem_latency_avg"]:
-        vitals["rem_latency_avg"] = 0
-    if not vitals["rem_latency_max"]:
-        vitals["rem_latency_max"] = 5999
-    if not vitals["rem_latency_stddev"]:
-        vitals["rem_latency_stddev"] = 0
-    if not vitals["rem_uptime_min"]:
-        vitals["rem_uptime_min"] = 0
-    if not vitals["rem_uptime_avg"]:
-        vitals["rem_uptime_avg"] = 0
-    if not vitals["rem_uptime_max"]:
-        vitals["rem_uptime_max"] = 0
-    if not vitals["rem_uptime_stddev"]:
-        vitals["rem_uptime_stddev"] = 0
-    return vitals
-
-def write_remailer_stats(name, addy, vitals):
-    # Create a filename for the remailer details, open it and write a title and timestamp.
+            recovered = True
+    return failed, recovered
+
+# Write the report for a single remailer.  This runs in a report worker,
+# which reads the vitals calculated for this cycle from memory.
+def remailer_report(remailer):
+    name, addy = remailer
+    logger.debug("Writing stats file for %s %s", name, addy)
+    write_remailer_stats(name, addy, all_vitals[remailer],
+                         len(snapshot.current.pingers))
+
+# Parse the command line.  Without --live, stats are not retrieved and the
+# reports are produced from what's already in the database.
+def parse_args(args):
+    parser = optparse.OptionParser(usage="%prog [--live] [--profile] [--full]")
+    parser.add_option('--live', action='store_true', default=False,
+                      help="retrieve stats and keys from the pingers")
+    parser.add_option('--full', action='store_true', default=False,
+                      help="rewrite every report, not only those that have "
+                           "changed")
+    parser.add_option('--profile', action='store_true', default=False,
+                      help="profile each phase of the cycle into the "
+                           "profile directory under reportdir")
+    options, args = parser.parse_args(args)
+    return options
+
+def gen_all_vitals(snap):
+    """Return a dictionary, keyed by (rem_name, rem_addy), of the vitals of
+    every remailer in the snapshot.  Each entry is a dictionary of the
+    averages and standard deviations over all pings, the ranges they define
+    and the statistics of the pings falling within those ranges.  The pings
+    themselves, sorted by partition_pings, are included as active_pings,
+    ignored_pings and dead_pings."""
+    # Averages over all pings only take those with a known latency and
+    # some uptime.
+    usable = [position for position in snap.window if
+              snap.lat_time[position] < 5999 and snap.up_time[position] > 0]
+    latency_all = snap.by_remailer(snap.lat_time, usable)
+    uptime_all = snap.by_remailer(snap.up_time, usable)
+    all_vitals = {}
+    for name, addy in snap.remailers:
+        vitals = {}
+        vitals["rem_name"] = name
+        vitals["rem_addy"] = addy
+        vitals["max_age"] = snap.max_age
+        vitals["max_future"] = snap.max_future
+        vitals["chain_from"] = len(snap.chains_from.get(name, []))
+        vitals["chain_to"] = len(snap.chains_to.get(name, []))
+        # First we get some stats based on all responding pingers
+        latency = latency_all.get((name, addy), snapshot.summarise([]))
+        uptime = uptime_all.get((name, addy), snapshot.summarise([]))
+        vitals["rem_latency_avg_all"] = latency[snapshot.AVG]
+        vitals["rem_uptime_avg_all"] = uptime[snapshot.AVG]
+        vitals["rem_latency_stddev_all"] = latency[snapshot.STDDEV]
+        vitals["rem_uptime_stddev_all"] = uptime[snapshot.STDDEV]
+        vitals["rem_count_all"] = latency[snapshot.COUNT]
+        # If any of the above stats return None, set them to an arbitrary
+        # default.
+        if not vitals["rem_latency_avg_all"]:
+            vitals["rem_latency_avg_all"] = 5999
+        if not vitals["rem_uptime_avg_all"]:
+            vitals["rem_uptime_avg_all"] = 0
+        if not vitals["rem_latency_stddev_all"]:
+            vitals["rem_latency_stddev_all"] = 0
+        if not vitals["rem_uptime_stddev_all"]:
+            vitals["rem_uptime_stddev_all"] = 0
+        # Use a configured multiplier to broaden/narrow out accepted ranges
+        vitals["rem_latency_stddev_range"] = \
+         float(vitals["rem_latency_stddev_all"]) * config.latency_stddev_multiplier
+        vitals["rem_uptime_stddev_range"] = \
+         float(vitals["rem_uptime_stddev_all"]) * config.uptime_stddev_multiplier
+        # Now sort the pings and get some stats for the active ones.
+        active, ignored, dead = \
+            partition_pings(snap, vitals, snap.pings((name, addy), False))
+        latency = snapshot.summarise([snap.lat_time[p] for p in active])
+        uptime = snapshot.summarise([snap.up_time[p] for p in active])
+        vitals["rem_latency_min"] = latency[snapshot.MIN]
+        vitals["rem_latency_avg"] = latency[snapshot.AVG]
+        vitals["rem_latency_max"] = latency[snapshot.MAX]
+        vitals["rem_latency_stddev"] = latency[snapshot.STDDEV]
+        vitals["rem_uptime_min"] = uptime[snapshot.MIN]
+        vitals["rem_uptime_avg"] = uptime[snapshot.AVG]
+        vitals["rem_uptime_max"] = uptime[snapshot.MAX]
+        vitals["rem_uptime_stddev"] = uptime[snapshot.STDDEV]
+        vitals["rem_active_count"] = latency[snapshot.COUNT]
+        # If any of the above stats return None, set them to an arbitrary
+        # default.
+        if not vitals["rem_latency_min"]:
+            vitals["rem_latency_min"] = 0
+        if not vitals["rem_latency_avg"]:
+            vitals["rem_latency_avg"] = 0
+        if not vitals["rem_latency_max"]:
+            vitals["rem_latency_max"] = 5999
+        if not vitals["rem_latency_stddev"]:
+            vitals["rem_latency_stddev"] = 0
+        if not vitals["rem_uptime_min"]:
+            vitals["rem_uptime_min"] = 0
+        if not vitals["rem_uptime_avg"]:
+            vitals["rem_uptime_avg"] = 0
+        if not vitals["rem_uptime_max"]:
+            vitals["rem_uptime_max"] = 0
+        if not vitals["rem_uptime_stddev"]:
+            vitals["rem_uptime_stddev"] = 0
+        vitals["active_pings"] = [snap.row(p) for p in active]
+        vitals["ignored_pings"] = [snap.row(p) for p in ignored]
+        vitals["dead_pings"] = [snap.row(p) for p in dead]
+        all_vitals[(name, addy)] = vitals
+    return all_vitals
+
+def partition_pings(snap, vitals, positions):
+    """Sort a remailer's pings into in-scope, out-of-scope and dead pings,
+    returned as a tuple of three lists of snapshot positions.  In-scope
+    pings are within the active window and fall inside the uptime and
+    latency ranges in vitals.  Out-of-scope pings are within the window but
+    outside a range, have a dead uptime history or an unknown latency.
+    Dead pings are those outside the window.  Each list is ordered by
+    uptime, highest first, and then pinger name."""
+    up_avg = float(vitals["rem_uptime_avg_all"])
+    up_range = vitals["rem_uptime_stddev_range"]
+    lat_avg = float(vitals["rem_latency_avg_all"])
+    lat_range = vitals["rem_latency_stddev_range"]
+    # The boundaries are rounded to integers, as the database always did.
+    up_min = int(round(up_avg - up_range))
+    up_max = int(round(up_avg + up_range))
+    lat_min = int(round(lat_avg - lat_range))
+    lat_max = int(round(lat_avg + lat_range))
+    active = []
+    ignored = []
+    dead = []
+    for position in positions:
+        if snap.timestamp[position] is None:
+            continue
+        if not snap.in_window[position]:
+            dead.append(position)
+            continue
+        lat_time = snap.lat_time[position]
+        up_time = snap.up_time[position]
+        in_range = up_min <= up_time <= up_max and \
+                   lat_min <= lat_time <= lat_max
+        dead_hist = snap.hist_dead[position]
+        if in_range and not dead_hist and lat_time < 5999:
+            active.append(position)
+        elif not in_range or dead_hist or lat_time == 5999:
+            ignored.append(position)
+    order = lambda position: (-snap.up_time[position],
+                              snap.ping_name(position))
+    for pings in active, ignored, dead:
+        pings.sort(key=order)
+    return active, ignored, dead
+
+def stats_filename(name, addy):
     noat = addy.replace('@',".")
-    filename = '%s/%s.%s.txt' % (config.reportdir, name, noat)
-    statfile = open("%s" % (filename,), 'w')
+    return '%s/%s.%s.txt' % (config.reportdir, name, noat)
+
+def write_remailer_stats(name, addy, vitals, total_pingers):
+    # Create a filename for the remailer details, open it and write a title and timestamp.
+    filename = stats_filename(name, addy)
+    statfile = output.ReportFile(filename)
     statfile.write("Pinger statistics for the %(rem_name)s remailer (%(rem_addy)s)\n" % vitals)
     statfile.write('Last update: %s (UTC)\n' % timefunc.utcnow())
 
     statfile.write("\nPingers\n")
-    statfile.write(" Known: %d\t" % db.count_total_pingers())
+    statfile.write(" Known: %d\t" % total_pingers)
     statfile.write("Alive: %d\t" % vitals["rem_count_all"])
     statfile.write("In-Scope: %d\t" % vitals["rem_active_count"])
     # Out of scope pings are total Alive pings minus In-Scope Pings
@@ -354,96 +442,171 @@ def write_remailer_stats(name, addy, vitals):
     statfile.write("StdDev: %d:%02d\n" % timefunc.hours_mins(vitals["rem_latency_stddev"]))
 
     statfile.write("\nIn-scope pings\n")
-    for row in db.remailer_active_pings(vitals):
+    for row in vitals["active_pings"]:
         entry = db_process(row)
         statfile.write(entry)
 
     statfile.write("\n\nOut of scope pings\n")
-    for row in db.remailer_ignored_pings(vitals):
+    for row in vitals["ignored_pings"]:
         entry = db_process(row)
         statfile.write(entry)
  
     statfile.write("\n\nDead pings\n")
-    for row in db.remailer_inactive_pings(vitals):
+    for row in vitals["dead_pings"]:
         entry = db_process(row)
         statfile.write(entry)
 
     statfile.close()
 
+# Log the time spent in each of the db.py functions this cycle, slowest first.
+# If config.query_stats_file is set, the same figures are written to it as
+# JSON, replacing those from the previous cycle.
+def write_query_stats():
+    summary = db.queries.summary()
+    for function, count, seconds, max_seconds, rows, commit in summary:
+        logger.info("Query stats for %s: %d queries, %.3f seconds (max %.3f, commit %.3f), %d rows", function, count, seconds, max_seconds, commit, rows)
+    if not hasattr(config, 'query_stats_file'):
+        return
+    functions = {}
+    for function, count, seconds, max_seconds, rows, commit in summary:
+        functions[function] = {'queries': count,
+                               'seconds': round(seconds, 6),
+                               'max_seconds': round(max_seconds, 6),
+                               'commit_seconds': round(commit, 6),
+                               'rows': rows}
+    tmpname = config.query_stats_file + '.tmp'
+    statsfile = open(tmpname, 'w')
+    json.dump({'generated': timefunc.utcnow(), 'functions': functions},
+              statsfile, indent=1, sort_keys=True)
+    statsfile.close()
+    os.rename(tmpname, config.query_stats_file)
+
 # ----- Start of main routine -----
 def main():
+    global all_vitals
     init_logging() # Before anything else, initialise logging.
     logger.info("Beginning process cycle at %s (UTC)", timefunc.utcnow())
     socket.setdefaulttimeout(config.timeout)
-    global stat_re, addy_re, chain_re
-    stat_re = re.compile('(\w{1,12})\s+([0-9A-H?]{12}\s.*)')
-    addy_re = re.compile('\$remailer\{\"([0-9a-z]{1,12})\"\}\s\=\s\"\<(.*)\>\s')
-    chain_re = re.compile('\((\S{1,12})\s(\S{1,12})\)')
+    options = parse_args(sys.argv[1:])
+
+    # Each phase of the cycle is timed and, with --profile, profiled.
+    profile_dir = None
+    if options.profile:
+        profile_dir = os.path.join(config.reportdir, 'profile')
+        logger.debug("Profiling each phase into %s", profile_dir)
+    prof = profiler.Profiler(profile_dir)
+
+    # Only the per-remailer reports that have changed since the last cycle
+    # are rewritten, unless --full is given.
+    tracker = dirty.load(options.full)
 
     # Are we running in testmode?  Testmode implies the script was executed
-    # without a --live argument.
-    testmode = live_or_test(sys.argv)
-
-    # If not in testmode, fetch url's and process them
-    if not testmode:                
-        pingers = db.pinger_names()
-        for row in pingers:
-            url = url_fetch(row[1])
-            if url:
-                url_process(row[0], url)
+    # without a --live argument.  If not in testmode, fetch url's and process
+    # them.
+    timings = []
+    if options.live:
+        logger.debug("Running with 'live' flag set, url's will be retreived")
+        # Pinger urls are fetched and parsed concurrently but written to the
+        # database one at a time as they arrive.
+        with prof.phase('fetch'):
+            timings = harvest(db.pinger_names(), url_parse, url_process)
         # Fetch pubring.mix files and write them to the DB
-        getkeystats()
+        with prof.phase('keys'):
+            getkeystats()
     else:
         logger.debug("Running in testmode, url's will not be retreived")
 
-
-    # We need to do some periodic housekeeping.  It's not very process
-    # intensive so might as well do it every time we run.
-    db.housekeeping(timefunc.hours_ago(config.dead_after_hours))
+    # Old stats are aged out periodically, unless housekeeping.py has done
+    # so recently.
+    with prof.phase('housekeeping'):
+        housekeeping.scheduled()
 
     # For a pinger to be considered active, it must appear in tables mlist2
     # and pingers.  This basically means, don't create empty pinger columns
     # in the index file.
     active_pingers = db.active_pinger_names()
 
-    # A boolean value to rotate row colours within the index 
-    rotate_color = 0
-
-    # The main loop.  This creates individual remailer text files and
-    # indexing data based on database values.
-    for name, addy in db.distinct_rem_names():
-        logger.debug("Generating statsistics for remailer %s", name)
-
-        # remailer_vitals is a dictionary of standard deviation and average
-        # values for a specific remailer.
-        remailer_vitals = gen_remailer_vitals(name, addy)
-
-        # remailer_active_pings: Based on the vitals generated above, we now
-        # extract stats lines for pingers considered active.  The up_hist
-        # part is used by the fail_recover routine.
-        remailer_active_pings = db.remailer_active_pings(remailer_vitals)
-        # If a remailers is perceived to be dead, timestamp it in the
-        # genealogy table.  Likewise, if it's not dead, unstamp it.
-        fail_recover(name, addy, remailer_active_pings)
-
-        # Write the remailer text file that contains pinger stats and averages
-        logger.debug("Writing stats file for %s %s", name, addy)
-        write_remailer_stats(name, addy, remailer_vitals)
-
-        # Rotate the colour used in index generation.
-        rotate_color = not rotate_color
-
-    db.gene_find_new()
-    index()
-    genealogy()
-    uptimes()
-    chainstats()
-    writekeystats()
+    # Read mlist2 and the broken chains into memory.  All the reports are
+    # produced from this snapshot.  all_vitals is a dictionary of standard
+    # deviation and average values for every remailer, calculated from the
+    # snapshot.
+    with prof.phase('snapshot'):
+        snap = snapshot.load(ago, ahead)
+        all_vitals = gen_all_vitals(snap)
+
+    # The main loop.  If a remailers is perceived to be dead, it's
+    # timestamped in the genealogy table.  Likewise, if it's not dead, it's
+    # unstamped.  The up_hist part of the active pings is used for this.
+    # The failures and recoveries are written to the genealogy table in one
+    # go.  Then the text files of the remailers whose stats have changed are
+    # written, shared between the report workers.
+    with prof.phase('remailers'):
+        failed = []
+        recovered = []
+        changed = []
+        for remailer in snap.remailers:
+            name, addy = remailer
+            logger.debug("Generating statsistics for remailer %s", name)
+            vitals = all_vitals[remailer]
+            is_failed, is_recovered = fail_recover(name, addy, vitals["active_pings"])
+            if is_failed:
+                failed.append(remailer)
+            if is_recovered:
+                recovered.append(remailer)
+            # The window moves on every cycle, but it isn't shown in the
+            # report, only which pings fall within it.
+            shown = [item for item in sorted(vitals.items())
+                     if item[0] not in ('max_age', 'max_future')]
+            if tracker.changed('stats', remailer, (len(snap.pingers), shown),
+                               stats_filename(name, addy)):
+                changed.append(remailer)
+        db.mark_genealogy(failed, recovered, timefunc.utcnow())
+        report_map(remailer_report, changed)
+        logger.info("Wrote stats files for %d of %d remailers", len(changed), len(snap.remailers))
+
+    with prof.phase('gene_find_new'):
+        db.gene_find_new()
+    with prof.phase('index'):
+        index()
+    with prof.phase('genealogy'):
+        genealogy()
+    with prof.phase('uptimes'):
+        uptimes()
+    with prof.phase('trends'):
+        trends()
+    with prof.phase('chainstats'):
+        chainstats()
+    with prof.phase('keystats'):
+        writekeystats()
+    with prof.phase('export'):
+        export.export(snap, all_vitals)
+    # Only now that every report has been written are their fingerprints
+    # kept for the next cycle.
+    tracker.save()
+    write_query_stats()
+    prof.log(logger)
+    if hasattr(config, 'prometheus_textfile'):
+        statuses = [timing[3] for timing in timings]
+        prof.write_textfile(config.prometheus_textfile, [
+            ('metastats_pingers_fetched',
+             'Pingers whose stats were fetched and processed in the last cycle.',
+             statuses.count('ok')),
+            ('metastats_pingers_unchanged',
+             'Pingers whose stats were unchanged since the previous cycle.',
+             statuses.count('unchanged')),
+            ('metastats_pingers_failed',
+             'Pingers whose stats could not be fetched in the last cycle.',
+             statuses.count('failed')),
+            ('metastats_rows_written',
+             'Stats entries written to the database in the last cycle.',
+             rows_written)])
     logger.info("Processing cycle completed at %s (UTC)", timefunc.utcnow())
 
 # Call main function.
 now = timefunc.utcnow()
 ago = timefunc.hours_ago(config.active_age)
 ahead = timefunc.hours_ahead(config.active_future)
+rows_written = 0
+all_vitals = {}
 if (__name__ == "__main__"):
     main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# tests/__init__.py -- Common setup for the metastats tests
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Usage, from the top of the tree: python -m unittest discover tests
+#
+# The tests never read a local config.py.  The config module is loaded from
+# config_sample.py instead and pointed at a SQLite database and a report
+# directory within a temporary directory, which is removed afterwards.
+# Optional features that write files elsewhere are switched off.
+
+import atexit
+import imp
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+if topdir not in sys.path:
+    sys.path.insert(0, topdir)
+
+tmpdir = tempfile.mkdtemp(prefix='metastats-test.')
+atexit.register(shutil.rmtree, tmpdir, True)
+
+config = imp.load_source('config', os.path.join(topdir, 'config_sample.py'))
+config.dbengine = 'sqlite'
+config.dbfile = os.path.join(tmpdir, 'metastats.db')
+config.reportdir = os.path.join(tmpdir, 'www')
+config.logfile = os.path.join(tmpdir, 'metalog')
+for setting in ('manifest', 'cachedir', 'statefile', 'slow_query_log',
+                'query_stats_file', 'prometheus_textfile', 'export_json',
+                'export_csv'):
+    if hasattr(config, setting):
+        delattr(config, setting)
+os.mkdir(config.reportdir)
+
+# Nothing the code under test logs is of interest here.
+logging.getLogger('stats').addHandler(logging.NullHandler())
+
+def empty_database():
+    """Bring the test database up to the latest schema and delete every
+    row from it, other than the schema version."""
+    import db
+    import schema
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        schema.upgrade()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    with db.transaction() as curs:
+        curs.execute(db.engine.tables_query)
+        for table in [row[0] for row in curs.fetchall()]:
+            if table != 'schema_version':
+                curs.execute("DELETE FROM " + table)
+
+def empty_reportdir():
+    for filename in os.listdir(config.reportdir):
+        os.unlink(os.path.join(config.reportdir, filename))
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# test_db.py -- Check that replacing a pinger's stats keeps its keys
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import datetime
+import unittest
+
+import tests
+import db
+
+def stat_line(ping_name, rem_name, up_time=1000):
+    """Return a parsed stats line, as build_stats would."""
+    return {'url_ping_name': ping_name,
+            'url_rem_name': rem_name,
+            'url_rem_addy': rem_name + '@example.net',
+            'url_lat_hist': '000000000000',
+            'url_lat_time': 10,
+            'url_up_hist': '++++++++++++',
+            'url_up_time': up_time,
+            'url_options': 'D',
+            'url_timestamp': '2011-10-18 10:15:02',
+            'url_hist_dead': False,
+            'url_lat_today': 0,
+            'url_up_today': 10}
+
+def key(rem_name):
+    return (rem_name, rem_name + '@example.net', rem_name.ljust(32, 'a'),
+            '3.0', '2011-01-01', '2012-01-01')
+
+class ReplaceStatsTest(unittest.TestCase):
+    def setUp(self):
+        tests.empty_database()
+
+    def keys(self):
+        """Return the key each pinger has for each remailer in mlist2."""
+        with db.transaction() as curs:
+            curs.execute("""SELECT ping_name, rem_name, key, version, valid,
+                            expire FROM mlist2""")
+            return dict([(tuple(row[0:2]), tuple(row[2:6]))
+                         for row in curs.fetchall()])
+
+    def test_replace(self):
+        db.replace_stats('p0', [stat_line('p0', 'alpha'),
+                                stat_line('p0', 'bravo')])
+        db.replace_stats('p0', [stat_line('p0', 'alpha', 500)])
+        with db.transaction() as curs:
+            curs.execute("""SELECT rem_name, up_time FROM mlist2
+                            ORDER BY rem_name""")
+            self.assertEqual(curs.fetchall(), [('alpha', 500),
+                                               ('bravo', 1000)])
+
+    def test_keys_kept(self):
+        db.replace_stats('p0', [stat_line('p0', 'alpha'),
+                                stat_line('p0', 'bravo')])
+        db.update_keys('p0', [key('alpha'), key('bravo')])
+        db.replace_stats('p0', [stat_line('p0', 'alpha', 500),
+                                stat_line('p0', 'bravo', 500)])
+        keys = self.keys()
+        self.assertEqual(keys[('p0', 'alpha')],
+                         ('alpha'.ljust(32, 'a'), '3.0',
+                          datetime.date(2011, 1, 1),
+                          datetime.date(2012, 1, 1)))
+        self.assertEqual(keys[('p0', 'bravo')][0], 'bravo'.ljust(32, 'a'))
+
+    def test_new_remailer(self):
+        # A remailer in the pinger's pubring, but not yet in its stats, is
+        # given its key as soon as it appears in them.
+        db.replace_stats('p0', [stat_line('p0', 'alpha')])
+        db.update_keys('p0', [key('alpha'), key('bravo')])
+        db.replace_stats('p0', [stat_line('p0', 'alpha'),
+                                stat_line('p0', 'bravo'),
+                                stat_line('p0', 'charlie')])
+        keys = self.keys()
+        self.assertEqual(keys[('p0', 'bravo')][0], 'bravo'.ljust(32, 'a'))
+        self.assertEqual(keys[('p0', 'charlie')], (None, None, None, None))
+
+    def test_other_pinger(self):
+        # Keys belong to the pinger whose pubring they came from.
+        db.replace_stats('p0', [stat_line('p0', 'alpha')])
+        db.update_keys('p0', [key('alpha')])
+        db.replace_stats('p1', [stat_line('p1', 'alpha')])
+        keys = self.keys()
+        self.assertEqual(keys[('p0', 'alpha')][0], 'alpha'.ljust(32, 'a'))
+        self.assertEqual(keys[('p1', 'alpha')], (None, None, None, None))
+
+if __name__ == '__main__':
+    unittest.main()
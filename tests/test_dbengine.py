@@ -0,0 +1,108 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# test_dbengine.py -- Check the SQLite translations of the PostgreSQL queries
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import unittest
+
+import tests
+import dbengine
+
+class TranslateTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = dbengine.SQLiteEngine()
+
+    def translate(self, query):
+        return self.engine.translate(query)
+
+    def test_parameters(self):
+        self.assertEqual(self.translate("ping_name = %(ping_name)s"),
+                         "ping_name = :ping_name")
+        self.assertEqual(self.translate("VALUES (%s,%s)"), "VALUES (?,?)")
+        self.assertEqual(self.translate("rem_name LIKE 'a%%'"),
+                         "rem_name LIKE 'a%'")
+
+    def test_casts(self):
+        self.assertEqual(self.translate("timestamp > cast(%s AS timestamp)"),
+                         "timestamp > ?")
+        self.assertEqual(self.translate("CAST(v.column5 AS date)"),
+                         "v.column5")
+        self.assertEqual(self.translate("cast(up_time / 10.0 AS int)"),
+                         "round(up_time / 10.0)")
+        # Casts to other types are left alone.
+        self.assertEqual(self.translate("cast(up_time AS float)"),
+                         "cast(up_time AS float)")
+
+    def test_regex(self):
+        self.assertEqual(self.translate("up_hist ~ %s"),
+                         "up_hist REGEXP ?")
+        self.assertEqual(self.translate("m.up_hist !~ '[1-9]'"),
+                         "NOT m.up_hist REGEXP '[1-9]'")
+
+    def test_cached(self):
+        query = "SELECT * FROM mlist2 WHERE ping_name = %s"
+        self.assertTrue(self.translate(query) is
+                        self.translate("".join(list(query))))
+
+    def test_postgres(self):
+        query = "timestamp > cast(%s AS timestamp)"
+        self.assertEqual(dbengine.PostgresEngine().translate(query), query)
+
+class FunctionTest(unittest.TestCase):
+    def test_regexp(self):
+        self.assertTrue(dbengine.regexp('[1-9]', '00100'))
+        self.assertFalse(dbengine.regexp('[1-9]', '00000'))
+        self.assertFalse(dbengine.regexp('[1-9]', None))
+
+    def test_stddev(self):
+        stddev = dbengine.StdDev()
+        for value in 2, 4, 4, 4, None, 5, 5, 7, 9:
+            stddev.step(value)
+        self.assertAlmostEqual(stddev.finalize(), 2.1380899)
+        stddev = dbengine.StdDev()
+        stddev.step(1)
+        self.assertEqual(stddev.finalize(), None)
+
+    def test_sqlite(self):
+        # The translated queries, run against SQLite, give the answers
+        # PostgreSQL would.
+        conn = dbengine.SQLiteEngine().connect()
+        curs = dbengine.Cursor(dbengine.SQLiteEngine(), conn.cursor())
+        curs.execute("CREATE TEMPORARY TABLE t (hist char(12), n int)")
+        curs.execute("INSERT INTO t VALUES (%s, %s)", ('000100', 5))
+        curs.execute("INSERT INTO t VALUES (%(hist)s, %(n)s)",
+                     {'hist': '000000', 'n': 6})
+        curs.execute("SELECT cast(n * 0.5 AS int) FROM t ORDER BY n")
+        self.assertEqual(curs.fetchall(), [(3,), (3,)])
+        curs.execute("SELECT stddev(n) FROM t")
+        self.assertAlmostEqual(curs.fetchone()[0], 0.7071068)
+        curs.execute("SELECT n FROM t WHERE hist !~ '[1-9]'")
+        self.assertEqual(curs.fetchall(), [(6,)])
+        conn.close()
+
+class QueryStatsTest(unittest.TestCase):
+    def test_totals(self):
+        queries = dbengine.QueryStats()
+        queries.record('pinger_names', 0.5, 3, 'SELECT', None)
+        queries.record('pinger_names', 1.5, 2, 'SELECT', None)
+        queries.record_commit('pinger_names', 0.25)
+        queries.record('count_pings', 0.1, 1, 'SELECT', None)
+        self.assertEqual(queries.summary(),
+                         [('pinger_names', 2, 2.25, 1.5, 5, 0.25),
+                          ('count_pings', 1, 0.1, 0.1, 1, 0.0)])
+
+if __name__ == '__main__':
+    unittest.main()
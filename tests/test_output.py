@@ -0,0 +1,133 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# test_output.py -- Check when reports are, and aren't, rewritten
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import os
+import time
+import unittest
+
+import tests
+import config
+import dirty
+import output
+
+PAGE = "<p>%s</p>\n<p>Last update: %s (UTC)</p>\n"
+
+def age(filename, hours):
+    """Make a file look as if it was last written hours ago."""
+    then = time.time() - hours * 3600
+    os.utime(filename, (then, then))
+
+class ReportFileTest(unittest.TestCase):
+    def setUp(self):
+        tests.empty_reportdir()
+        self.filename = os.path.join(config.reportdir, 'index.html')
+
+    def write(self, content):
+        report = output.ReportFile(self.filename)
+        report.write(content)
+        return report.close()
+
+    def read(self):
+        return open(self.filename).read()
+
+    def test_new(self):
+        self.assertTrue(self.write(PAGE % ('alpha', '2011-10-18 10:15:02')))
+        self.assertEqual(self.read(), PAGE % ('alpha', '2011-10-18 10:15:02'))
+        self.assertFalse(os.path.exists(self.filename + '.tmp'))
+
+    def test_timestamp_only(self):
+        self.write(PAGE % ('alpha', '2011-10-18 10:15:02'))
+        self.assertFalse(self.write(PAGE % ('alpha', '2011-10-18 10:20:02')))
+        self.assertEqual(self.read(), PAGE % ('alpha', '2011-10-18 10:15:02'))
+
+    def test_changed(self):
+        self.write(PAGE % ('alpha', '2011-10-18 10:15:02'))
+        self.assertTrue(self.write(PAGE % ('bravo', '2011-10-18 10:20:02')))
+        self.assertEqual(self.read(), PAGE % ('bravo', '2011-10-18 10:20:02'))
+
+    def test_stale(self):
+        self.write(PAGE % ('alpha', '2011-10-18 10:15:02'))
+        age(self.filename, config.report_refresh_hours + 1)
+        self.assertTrue(self.write(PAGE % ('alpha', '2011-10-19 11:15:02')))
+        self.assertEqual(self.read(), PAGE % ('alpha', '2011-10-19 11:15:02'))
+
+    def test_closed(self):
+        report = output.ReportFile(self.filename)
+        report.write(PAGE % ('alpha', '2011-10-18 10:15:02'))
+        self.assertTrue(report.close())
+        self.assertFalse(report.close())
+
+class TrackerTest(unittest.TestCase):
+    remailer = ('alpha', 'alpha@example.net')
+
+    def setUp(self):
+        tests.empty_reportdir()
+        self.statefile = os.path.join(tests.tmpdir, 'metastate.json')
+        if os.path.exists(self.statefile):
+            os.unlink(self.statefile)
+        self.filename = os.path.join(config.reportdir, 'alpha.txt')
+        open(self.filename, 'w').close()
+
+    def cycle(self, data, full=False):
+        """Run a cycle of one report, returning True if it's written."""
+        tracker = dirty.Tracker(self.statefile, full)
+        changed = tracker.changed('stats', self.remailer, data, self.filename)
+        tracker.save()
+        return changed
+
+    def test_first(self):
+        self.assertTrue(self.cycle([1, 2]))
+
+    def test_unchanged(self):
+        self.cycle([1, 2])
+        self.assertFalse(self.cycle([1, 2]))
+
+    def test_changed(self):
+        self.cycle([1, 2])
+        self.assertTrue(self.cycle([1, 3]))
+        self.assertFalse(self.cycle([1, 3]))
+
+    def test_full(self):
+        self.cycle([1, 2])
+        self.assertTrue(self.cycle([1, 2], full=True))
+
+    def test_missing(self):
+        self.cycle([1, 2])
+        os.unlink(self.filename)
+        self.assertTrue(self.cycle([1, 2]))
+
+    def test_stale(self):
+        self.cycle([1, 2])
+        age(self.filename, config.report_refresh_hours + 1)
+        self.assertTrue(self.cycle([1, 2]))
+
+    def test_corrupt(self):
+        open(self.statefile, 'w').write('{')
+        self.assertTrue(self.cycle([1, 2]))
+        self.assertFalse(self.cycle([1, 2]))
+
+    def test_no_statefile(self):
+        tracker = dirty.Tracker()
+        self.assertTrue(tracker.changed('stats', self.remailer, [1, 2],
+                                        self.filename))
+        tracker.save()
+        self.assertTrue(tracker.changed('stats', self.remailer, [1, 2],
+                                        self.filename))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# test_pages.py -- Check the HTML reports against those of earlier releases
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# The stats of three pingers, alpha, bravo and charlie, are loaded from
+# data/<pinger>.txt and the pubrings of the first two from data/<pinger>.mix.
+# The Generated timestamp of each is moved to an hour ago, so everything
+# falls within the active window.  The index, genealogy, uptimes and key
+# reports written from them must match those in data/pages byte for byte.
+#
+# data/pages was written by the tree as it was before the reports were
+# rendered from pages.py and the index from the uptime matrix, with
+# write_reports below.  The "Last update" timestamps are removed from the
+# pages and today's date, on which the remailers were first seen, replaced
+# with TODAY, both there and in the pages being checked.
+
+import os
+import re
+import time
+import unittest
+
+import tests
+import config
+import db
+import genealogy
+import index
+import keys
+import output
+import snapshot
+import statparse
+import stats
+import uptimes
+
+pingers = ['alpha', 'bravo', 'charlie']
+pagedir = os.path.join(tests.datadir, 'pages')
+generated_re = re.compile('^Generated: .*$', re.M)
+
+def read(filename):
+    datafile = open(filename)
+    try:
+        return datafile.read()
+    finally:
+        datafile.close()
+
+def load_pingers():
+    """Write the stats and keys of each pinger to the database."""
+    generated = time.strftime('Generated: %a, %d %b %Y %H:%M:%S GMT',
+                              time.gmtime(time.time() - 3600))
+    with db.transaction() as curs:
+        for ping_name in pingers:
+            curs.execute("""INSERT INTO pingers (ping_name, mlist2, pubring)
+                            VALUES (%s, %s, %s)""",
+                         (ping_name,
+                          'http://%s.example.net/mlist2.txt' % ping_name,
+                          'http://%s.example.net/pubring.mix' % ping_name))
+    for ping_name in pingers:
+        content = read(os.path.join(tests.datadir, ping_name + '.txt'))
+        content = generated_re.sub(generated, content)
+        stats.url_process(ping_name, statparse.parse_stats(content))
+        pubring = os.path.join(tests.datadir, ping_name + '.mix')
+        if os.path.exists(pubring):
+            content = read(pubring).splitlines(True)
+            keys.pubring_process(ping_name, keys.pubring_scan(content))
+
+def write_reports():
+    """Load the pingers into an empty database and write the reports."""
+    tests.empty_database()
+    tests.empty_reportdir()
+    load_pingers()
+    db.gene_find_new()
+    snapshot.load()
+    index.index()
+    genealogy.genealogy()
+    uptimes.uptimes()
+    keys.writekeystats()
+
+def normalise(content):
+    today = time.strftime('%Y-%m-%d', time.gmtime())
+    return output.timestamp_re.sub('', content).replace(today, 'TODAY')
+
+def html_files(directory):
+    return sorted([filename for filename in os.listdir(directory)
+                   if filename.endswith('.html')])
+
+class PagesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        write_reports()
+
+    def test_written(self):
+        self.assertEqual(html_files(config.reportdir), html_files(pagedir))
+
+    def test_identical(self):
+        for filename in html_files(pagedir):
+            page = read(os.path.join(config.reportdir, filename))
+            self.assertEqual(normalise(page),
+                             read(os.path.join(pagedir, filename)),
+                             filename + " differs")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# test_snapshot.py -- Check the uptime matrix and the partitioning of pings
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import datetime
+import unittest
+
+import tests
+import config
+import snapshot
+import stats
+
+MAX_AGE = '2011-10-18 02:15:02'
+MAX_FUTURE = '2011-10-18 12:15:02'
+IN_WINDOW = datetime.datetime(2011, 10, 18, 10, 15, 2)
+TOO_OLD = datetime.datetime(2011, 10, 17, 10, 15, 2)
+
+def row(ping_name, rem_name, up_time, lat_time=10, timestamp=IN_WINDOW,
+        hist_dead=False):
+    """Return an mlist2 row, in the order db.remailer_pings returns them."""
+    return (ping_name, rem_name, rem_name + '@example.net', '000000000000',
+            lat_time, '++++++++++++', up_time, 'D', timestamp, None, None,
+            None, None, hist_dead, 0, 10)
+
+class MatrixTest(unittest.TestCase):
+    def setUp(self):
+        rows = [row('p0', 'alpha', 1000),
+                row('p1', 'alpha', 0),
+                row('p2', 'bravo', 500),
+                row('p0', 'bravo', 900, timestamp=TOO_OLD),
+                row('p1', 'charlie', 800, timestamp=None)]
+        self.snap = snapshot.Snapshot(rows, [], MAX_AGE, MAX_FUTURE)
+
+    def test_matrix(self):
+        rows, counts = self.snap.uptime_matrix()
+        self.assertEqual(self.snap.remailers,
+                         [('alpha', 'alpha@example.net'),
+                          ('bravo', 'bravo@example.net'),
+                          ('charlie', 'charlie@example.net')])
+        self.assertEqual(self.snap.pingers, ['p0', 'p1', 'p2'])
+        # A zero uptime is shown, but left out of the summary.
+        self.assertEqual(rows[0], ([1000, 0, None],
+                                   (1, 1000, 1000.0, 1000, None)))
+        # Pings outside the window aren't in the matrix at all.
+        self.assertEqual(rows[1], ([None, None, 500],
+                                   (1, 500, 500.0, 500, None)))
+        self.assertEqual(rows[2], ([None, None, None],
+                                   (0, None, None, None, None)))
+        self.assertEqual(counts, [1, 1, 1])
+
+    def test_kept(self):
+        self.assertTrue(self.snap.uptime_matrix() is
+                        self.snap.uptime_matrix())
+
+class VitalsTest(unittest.TestCase):
+    def setUp(self):
+        self.multipliers = (config.latency_stddev_multiplier,
+                            config.uptime_stddev_multiplier)
+        config.latency_stddev_multiplier = 1.0
+        config.uptime_stddev_multiplier = 1.0
+        rows = [
+            # The uptimes of alpha average 1000 with a standard deviation
+            # of 1.63, so the in-scope range is 998.37 to 1001.63.  The
+            # boundaries are rounded, taking in 998 and 1002.
+            row('p0', 'alpha', 998),
+            row('p1', 'alpha', 1000),
+            row('p2', 'alpha', 1000),
+            row('p3', 'alpha', 1002),
+            # None of these count towards the averages.  The first two are
+            # out of scope, the third is dead and the last, with no
+            # timestamp, is left out altogether.
+            row('p4', 'alpha', 0),
+            row('p5', 'alpha', 1000, lat_time=5999),
+            row('p6', 'alpha', 1000, timestamp=TOO_OLD),
+            row('p7', 'alpha', 1000, timestamp=None),
+            # A dead history is out of scope, even within the range.
+            row('p0', 'bravo', 500, lat_time=20),
+            row('p1', 'bravo', 500, lat_time=20, hist_dead=True)]
+        self.snap = snapshot.Snapshot(rows, [], MAX_AGE, MAX_FUTURE)
+        self.vitals = stats.gen_all_vitals(self.snap)
+
+    def tearDown(self):
+        config.latency_stddev_multiplier, config.uptime_stddev_multiplier = \
+            self.multipliers
+
+    def pingers(self, vitals, pings):
+        return [(ping[0], ping[6]) for ping in vitals[pings]]
+
+    def test_ranges(self):
+        alpha = self.vitals[('alpha', 'alpha@example.net')]
+        self.assertEqual(alpha['rem_count_all'], 4)
+        self.assertEqual(alpha['rem_uptime_avg_all'], 1000.0)
+        self.assertAlmostEqual(alpha['rem_uptime_stddev_range'], 1.6329932)
+        self.assertEqual(alpha['rem_latency_avg_all'], 10.0)
+        self.assertEqual(alpha['rem_latency_stddev_range'], 0.0)
+
+    def test_partition(self):
+        alpha = self.vitals[('alpha', 'alpha@example.net')]
+        self.assertEqual(self.pingers(alpha, 'active_pings'),
+                         [('p3', 1002), ('p1', 1000), ('p2', 1000),
+                          ('p0', 998)])
+        self.assertEqual(self.pingers(alpha, 'ignored_pings'),
+                         [('p5', 1000), ('p4', 0)])
+        self.assertEqual(self.pingers(alpha, 'dead_pings'), [('p6', 1000)])
+        self.assertEqual(alpha['rem_active_count'], 4)
+        self.assertEqual(alpha['rem_uptime_min'], 998)
+        self.assertEqual(alpha['rem_uptime_max'], 1002)
+
+    def test_dead_history(self):
+        bravo = self.vitals[('bravo', 'bravo@example.net')]
+        self.assertEqual(bravo['rem_count_all'], 2)
+        self.assertEqual(self.pingers(bravo, 'active_pings'), [('p0', 500)])
+        self.assertEqual(self.pingers(bravo, 'ignored_pings'), [('p1', 500)])
+        self.assertEqual(bravo['rem_latency_min'], 20)
+
+if __name__ == '__main__':
+    unittest.main()
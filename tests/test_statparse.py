@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# test_statparse.py -- Check statparse against the original stats parser
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import logging
+import unittest
+
+import tests
+import bench_parse
+import statparse
+import stats
+
+logging.getLogger('bench_parse').addHandler(logging.NullHandler())
+
+def stat_line(name, lat_hist, latency, up_hist, uptime, options=''):
+    """Format a stats line the way the synthetic files do, 59 characters
+    after the name."""
+    return '%-8s %s  %5s   %s  %5s%%  %-15s\n' % (name, lat_hist, latency,
+                                                   up_hist, uptime, options)
+
+# Stats lines that the synthetic files don't produce: latencies under an
+# hour and over ten, an uptime of 100%, histories of nothing but '?', a line
+# of 60 characters, one that's too short and numeric columns that don't
+# convert.
+EDGES = ''.join([
+    "Generated: Tue, 18 Oct 2011 10:15:02 GMT\n",
+    "Mixmaster    Latent-Hist   Latent  Uptime-Hist   Uptime  Options\n",
+    "-" * 72 + "\n",
+    stat_line('alpha', 'GE7497E59BH9', ' 6:06', '3973+?9+38+8', ' 43.4'),
+    stat_line('bravo', '0000000000?0', '  :05', '++++++++++++', '100.0', 'D'),
+    stat_line('charlie', '????????????', '12:38', '????????????', '  0.0'),
+    stat_line('delta', '2ADAFA?BB8B7', '11:55', '632277519+?+', ' 54.1',
+              'D' + ' ' * 15),
+    stat_line('echo', '2ADAFA?BB8B7', '11:55', '632277519+?+', ' 54.1')[:50]
+        + '\n',
+    stat_line('foxtrot', '2ADAFA?BB8B7', '1x:55', '632277519+?+', ' 5y.1',
+              'D'),
+    "\n",
+    "Broken type-II remailer chains:\n",
+    "(alpha bravo)\n",
+    "(* charlie)\n",
+    "\n",
+    "Remailer-Capabilities:\n",
+    "\n",
+    '$remailer{"alpha"} = "<alpha@example.net> cpunk mix";\n',
+    '$remailer{"bravo"} = "<bravo@example.org> cpunk mix";\n',
+    '$remailer{"charlie"} = "<charlie@example.com> mix";\n',
+    '$remailer{"delta"} = "<delta@example.net> mix";\n',
+    '$remailer{"echo"} = "<echo@example.net> mix";\n',
+    '$remailer{"foxtrot"} = "<foxtrot@example.net> mix";\n'])
+
+class BaselineTest(unittest.TestCase):
+    """statparse and build_stats must produce the same rows and chains as
+    the slicing parser they replaced, kept in bench_parse."""
+    def test_synthetic(self):
+        for size in 1, 10, 100:
+            for seed in 1, 2, 3:
+                lines = bench_parse.synthetic_mlist2(size, seed)
+                self.assertTrue(bench_parse.agree(lines.splitlines(True)),
+                                "%d remailers, seed %d" % (size, seed))
+
+    def test_edges(self):
+        self.assertTrue(bench_parse.agree(EDGES.splitlines(True)))
+
+class ParseTest(unittest.TestCase):
+    def setUp(self):
+        genstamp, stat_lines, self.chains = \
+            stats.build_stats('test', statparse.parse_stats(EDGES))
+        self.genstamp = genstamp
+        self.stats = dict([(stat_line['url_rem_name'], stat_line)
+                           for stat_line in stat_lines])
+
+    def test_timestamp(self):
+        self.assertEqual(self.genstamp, '2011-10-18 10:15:02')
+
+    def test_values(self):
+        alpha = self.stats['alpha']
+        self.assertEqual(alpha['url_rem_addy'], 'alpha@example.net')
+        self.assertEqual(alpha['url_lat_hist'], 'GE7497E59BH9 ')
+        self.assertEqual(alpha['url_lat_time'], 366)
+        self.assertEqual(alpha['url_up_hist'], '3973+?9+38+8')
+        self.assertEqual(alpha['url_up_time'], 434)
+        self.assertEqual(alpha['url_timestamp'], '2011-10-18 10:15:02')
+        self.assertEqual(self.stats['bravo']['url_lat_time'], 5)
+        self.assertEqual(self.stats['bravo']['url_up_time'], 1000)
+        self.assertEqual(self.stats['bravo']['url_options'],
+                         'D              ')
+        self.assertEqual(self.stats['charlie']['url_lat_time'], 758)
+        self.assertEqual(self.stats['delta']['url_up_time'], 541)
+        # Unreadable columns count as zero.
+        self.assertEqual(self.stats['foxtrot']['url_lat_time'], 55)
+        self.assertEqual(self.stats['foxtrot']['url_up_time'], 1)
+
+    def test_wrong_length(self):
+        self.assertFalse('echo' in self.stats)
+
+    def test_histories(self):
+        self.assertEqual(self.stats['alpha']['url_hist_dead'], False)
+        self.assertEqual(self.stats['alpha']['url_lat_today'], 9)
+        self.assertEqual(self.stats['alpha']['url_up_today'], 8)
+        self.assertEqual(self.stats['bravo']['url_up_today'], 10)
+        self.assertEqual(self.stats['bravo']['url_lat_today'], 0)
+        self.assertEqual(self.stats['charlie']['url_hist_dead'], True)
+        self.assertEqual(self.stats['charlie']['url_lat_today'], None)
+        self.assertEqual(self.stats['charlie']['url_up_today'], 0)
+
+    def test_chains(self):
+        self.assertEqual(self.chains, [('alpha', 'bravo'), ('*', 'charlie')])
+
+    def test_no_chains(self):
+        # A file without a broken chains header reports no chains at all,
+        # rather than an empty list of them.
+        records = statparse.parse_stats(EDGES.split('\nBroken')[0])
+        self.assertEqual(stats.build_stats('test', records)[2], None)
+
+if __name__ == '__main__':
+    unittest.main()
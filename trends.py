@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# trends.py -- Long term uptime and latency averages from the rollups
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# The trends report averages each remailer's uptime and latency over spans
+# much longer than the active window.  The figures come from the hourly and
+# daily rollups kept by db.record_history, so only a few rows are read per
+# remailer however much history there is.  The report is only written if
+# config.trend_report_name is set.
+
+import config
+import db
+import output
+import pages
+import timefunc
+
+# Each span is a (heading, hours) tuple.  Spans of up to a day are read
+# from the hourly rollups and longer ones from the daily rollups.
+spans = [('Day', 24),
+         ('Week', 24 * 7),
+         ('Month', 24 * 30),
+         ('Year', 24 * 365)]
+
+def span_totals(kind, hours):
+    """Return the rollup totals of each remailer or pinger, as given by
+    kind, over the last number of hours."""
+    since = timefunc.hours_ago(hours)
+    if hours <= 24:
+        return db.rollup_totals(kind + '_hourly', since[0:13] + ':00:00')
+    return db.rollup_totals(kind + '_daily', since[0:10] + ' 00:00:00')
+
+def average(totals):
+    """Turn rollup totals into an (uptime, latency hours, latency minutes)
+    tuple.  Uptimes are held in tenths of a percent.  The latency is None
+    if none of the pings came back."""
+    pings, lat_pings, lat_total, up_total = totals
+    uptime = float(up_total) / pings / 10
+    if not lat_pings:
+        return uptime, None, None
+    lathrs, latmin = timefunc.hours_mins(float(lat_total) / lat_pings)
+    return uptime, lathrs, latmin
+
+def averages(kind):
+    """Return a list of (key, averages) for every remailer or pinger found
+    in any of the spans, in key order, where averages holds the average
+    for each span, or None."""
+    by_span = [span_totals(kind, hours) for heading, hours in spans]
+    keys = set()
+    for totals in by_span:
+        keys.update(totals.keys())
+    rows = []
+    for key in sorted(keys):
+        row = []
+        for totals in by_span:
+            if totals.get(key) and totals[key][0]:
+                row.append(average(totals[key]))
+            else:
+                row.append(None)
+        rows.append((key, row))
+    return rows
+
+def trends():
+    if not hasattr(config, 'trend_report_name'):
+        return
+    remailers = [(name, addy, row) for (name, addy), row
+                 in averages('remailer')]
+    pingers = averages('pinger')
+    filename = "%s/%s" % (config.reportdir, config.trend_report_name)
+    trendfile = output.ReportFile(filename)
+    trendfile.write(pages.trends_page([heading for heading, hours in spans],
+                                      remailers, pingers, timefunc.utcnow()))
+    trendfile.close()
+
+# Call main function.
+if (__name__ == "__main__"):
+    trends()
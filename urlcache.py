@@ -0,0 +1,188 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 autoindent
+#
+# urlcache.py -- Conditional retrieval of pinger urls
+#
+# Copyright (C) 2011 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import cPickle
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import urllib2
+
+import config
+
+logger = logging.getLogger('stats')
+
+# A response's cache entry isn't written when it's read, only once the
+# caller has stored what it read.  Otherwise a failure whilst storing it
+# would leave the url looking unchanged, and its content would never be
+# stored.  Entries waiting to be committed are held here, keyed by url.
+pending = {}
+pending_lock = threading.Lock()
+
+class Unchanged(object):
+    """Returned by fetch when a url hasn't changed since the last time it was
+    retrieved.  It tests False so callers that only check 'if content:'
+    will skip it, but it can be told apart from a failure by identity."""
+    def __nonzero__(self):
+        return False
+
+UNCHANGED = Unchanged()
+
+def cache_filename(url):
+    """Each url is cached in a file named after the md5 of the url."""
+    return os.path.join(config.cachedir, hashlib.md5(url).hexdigest())
+
+def cache_read(url):
+    """Return the cache entry for a url, or an empty dict if there isn't
+    one (or it can't be read)."""
+    try:
+        cachefile = open(cache_filename(url), 'rb')
+    except IOError:
+        return {}
+    try:
+        try:
+            entry = cPickle.load(cachefile)
+        except Exception:
+            logger.warn("Discarding unreadable cache entry for %s", url)
+            return {}
+    finally:
+        cachefile.close()
+    # Guard against md5 collisions, however unlikely.
+    if entry.get('url') != url:
+        return {}
+    return entry
+
+def cache_write(url, entry):
+    """Write a cache entry to a temporary file and then rename it into
+    place, so a concurrent reader never sees half an entry."""
+    fd, tmpname = tempfile.mkstemp(dir=config.cachedir)
+    try:
+        tmpfile = os.fdopen(fd, 'wb')
+        cPickle.dump(entry, tmpfile, cPickle.HIGHEST_PROTOCOL)
+        tmpfile.close()
+        os.rename(tmpname, cache_filename(url))
+    except:
+        os.unlink(tmpname)
+        raise
+
+class Response(object):
+    """Wraps a response whilst it's read a line at a time.  The md5 of the
+    body is calculated as it goes, so the body is never held in memory.
+    Once it's been read to the end, unchanged() says whether it's the same
+    as the last one retrieved and the new cache entry becomes pending."""
+    def __init__(self, url, opener, entry):
+        self.url = url
+        self.opener = opener
+        self.entry = entry
+        self.md5 = hashlib.md5()
+        self.digest = None
+
+    def readline(self):
+        line = self.opener.readline()
+        if line:
+            self.md5.update(line)
+        elif self.digest is None:
+            self.finish()
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def finish(self):
+        self.digest = self.md5.hexdigest()
+        new_entry = {'url': self.url, 'digest': self.digest}
+        headers = self.opener.info()
+        if headers.getheader('ETag'):
+            new_entry['etag'] = headers.getheader('ETag')
+        if headers.getheader('Last-Modified'):
+            new_entry['modified'] = headers.getheader('Last-Modified')
+        if new_entry != self.entry:
+            pending_lock.acquire()
+            try:
+                pending[self.url] = new_entry
+            finally:
+                pending_lock.release()
+
+    def unchanged(self):
+        """Some servers ignore the conditional headers, so the body itself
+        is compared with what we got last time."""
+        if self.digest is None or self.entry.get('digest') != self.digest:
+            return False
+        logger.debug("Content of %s is identical to the last retrieval",
+                     self.url)
+        return True
+
+def unchanged(content):
+    """True if content, as returned by fetch, has been read to the end and
+    is identical to the last retrieval."""
+    return isinstance(content, Response) and content.unchanged()
+
+def commit(url):
+    """Write the cache entry for a url once its content has been stored."""
+    pending_lock.acquire()
+    try:
+        entry = pending.pop(url, None)
+    finally:
+        pending_lock.release()
+    if entry is None:
+        return
+    try:
+        cache_write(url, entry)
+    except (IOError, OSError), e:
+        logger.warn("Unable to write cache entry for %s: %s", url, e)
+
+def discard(url):
+    """Forget the cache entry for a url whose content couldn't be stored,
+    so it's retrieved and stored again next time."""
+    pending_lock.acquire()
+    try:
+        pending.pop(url, None)
+    finally:
+        pending_lock.release()
+
+def fetch(url):
+    """Retrieve a url and return the open response so that the caller can
+    read it incrementally.  If a cachedir is configured, the request is
+    conditional on the ETag and Last-Modified headers of the previous
+    response, UNCHANGED is returned if the server replies 304, and the
+    response is wrapped in a Response.  The cache entry isn't written until
+    commit is called.  Failures return 0."""
+    caching = hasattr(config, 'cachedir')
+    entry = {}
+    request = urllib2.Request(url)
+    if caching:
+        entry = cache_read(url)
+        if entry.has_key('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        if entry.has_key('modified'):
+            request.add_header('If-Modified-Since', entry['modified'])
+    try:
+        opener = urllib2.urlopen(request)
+    except urllib2.HTTPError, e:
+        if e.code == 304 and entry:
+            logger.debug("%s is not modified since the last retrieval", url)
+            return UNCHANGED
+        logger.info("Retrieval of %s failed: %s", url, e)
+        return 0
+    except:
+        logger.info("Retrieval of %s failed", url)
+        return 0
+    if not caching:
+        return opener
+    return Response(url, opener, entry)